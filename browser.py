@@ -12,21 +12,36 @@ while True:
     # progressively nesting try/except blocks.
     try:
         """Try to import PyQt5"""
-        from PyQt5.QtGui import QIcon, QKeySequence
+        from PyQt5.QtGui import QIcon, QKeySequence, QPixmap, QImage
         from PyQt5.QtCore import (
             QUrl, QTimer, QObject, QT_VERSION_STR, QEvent,
             Qt, QTemporaryFile, QDir, QCoreApplication, qVersion, pyqtSignal,
-            QSizeF
+            QSizeF, QBuffer, QEventLoop, pyqtSlot
         )
         from PyQt5.QtWebKit import QWebSettings
         from PyQt5.QtWidgets import (
             QMainWindow, QAction, QWidget, QApplication, QSizePolicy,
-            QToolBar, QDialog, QMenu
+            QToolBar, QDialog, QMenu, QLabel
         )
         from PyQt5.QtPrintSupport import QPrinter, QPrintDialog
         from PyQt5.QtWebKitWidgets import QWebView, QWebPage
-        from PyQt5.QtNetwork import (QNetworkRequest, QNetworkAccessManager,
-                                     QNetworkProxy)
+        from PyQt5.QtNetwork import (
+            QNetworkRequest, QNetworkAccessManager, QNetworkProxy,
+            QNetworkReply, QNetworkDiskCache, QLocalServer,
+            QNetworkProxyFactory, QSslConfiguration
+        )
+        try:
+            from PyQt5.QtQml import QJSEngine as ScriptEngine
+        except ImportError:
+            ScriptEngine = None
+        # QtWebEngine is optional; see make_web_view()
+        try:
+            from PyQt5.QtWebEngineWidgets import (
+                QWebEngineView, QWebEnginePage, QWebEngineProfile,
+                QWebEngineSettings, QWebEngineScript
+            )
+        except ImportError:
+            QWebEngineView = None
         break
     except ImportError as e:
         print(f"PyQt5 not found: {e}")
@@ -37,16 +52,24 @@ while True:
         from PyQt4.QtGui import (
             QMainWindow, QAction, QIcon, QWidget,
             QApplication, QSizePolicy, QKeySequence, QToolBar, QPrinter,
-            QPrintDialog, QDialog, QMenu
+            QPrintDialog, QDialog, QMenu, QLabel, QPixmap, QImage
         )
         from PyQt4.QtCore import (
             QUrl, QTimer, QObject, QT_VERSION_STR, QEvent,
-            Qt, QTemporaryFile, QDir, QCoreApplication, qVersion, pyqtSignal
+            Qt, QTemporaryFile, QDir, QCoreApplication, qVersion, pyqtSignal,
+            QSizeF, QBuffer, QEventLoop, pyqtSlot
         )
         from PyQt4.QtWebKit import QWebView, QWebPage, QWebSettings
         from PyQt4.QtNetwork import (
-            QNetworkRequest, QNetworkAccessManager, QNetworkProxy
+            QNetworkRequest, QNetworkAccessManager, QNetworkProxy,
+            QNetworkReply, QNetworkDiskCache, QLocalServer,
+            QNetworkProxyFactory, QSslConfiguration
         )
+        try:
+            from PyQt4.QtScript import QScriptEngine as ScriptEngine
+        except ImportError:
+            ScriptEngine = None
+        QWebEngineView = None
         break
     except ImportError as e:
         print(f"PyQt4 not found: {e}")
@@ -57,18 +80,27 @@ while True:
         from PySide.QtGui import (
             QMainWindow, QAction, QIcon, QWidget,
             QApplication, QSizePolicy, QKeySequence, QToolBar, QPrinter,
-            QPrintDialog, QDialog, QMenu
+            QPrintDialog, QDialog, QMenu, QLabel, QPixmap, QImage
         )
         from PySide.QtCore import (
             QUrl, QTimer, QObject, QEvent, Qt, QTemporaryFile,
-            QDir, QCoreApplication, qVersion, Signal
+            QDir, QCoreApplication, qVersion, Signal, Slot, QSizeF, QBuffer,
+            QEventLoop
         )
         from PySide.QtWebKit import QWebView, QWebPage, QWebSettings
         from PySide.QtNetwork import (
-            QNetworkRequest, QNetworkAccessManager, QNetworkProxy
+            QNetworkRequest, QNetworkAccessManager, QNetworkProxy,
+            QNetworkReply, QNetworkDiskCache, QLocalServer,
+            QNetworkProxyFactory, QSslConfiguration
         )
+        try:
+            from PySide.QtScript import QScriptEngine as ScriptEngine
+        except ImportError:
+            ScriptEngine = None
+        QWebEngineView = None
         QT_VERSION_STR = qVersion()
         pyqtSignal = Signal
+        pyqtSlot = Slot
 
         break
     except ImportError as e:
@@ -87,7 +119,32 @@ import re
 import subprocess
 import datetime
 import socket
-from functools import partial
+import time
+import signal
+import inspect
+import traceback
+import shlex
+import shutil
+import hashlib
+import json
+import base64
+import gc
+import ctypes
+import ctypes.util
+import mimetypes
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from xml.sax.saxutils import escape
+import tempfile
+import threading
+import itertools
+import fnmatch
+from collections import Counter, defaultdict, deque
+from functools import partial, wraps, lru_cache
+import queue
+
+# Local imports
+from peer_cache import static_asset
+from request_log import RequestLog
 
 # MESSAGE STRINGS
 # You can override this string with the "page_unavailable_html" setting.
@@ -154,18 +211,42 @@ def debug(message):
     if not DEBUG and not DEBUG_LOG:
         pass
     else:
-        message = message.__str__()
-        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        debug_message = ts + ":: " + message
-        if DEBUG:
-            print(debug_message)
-        if DEBUG_LOG:
-            try:
-                fh = open(DEBUG_LOG, 'a')
+        debug_lines([message])
+
+
+def debug_lines(messages):
+    """Log or print several messages, with one write to the log file."""
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    debug_message = "\n".join(
+        ts + ":: " + message.__str__() for message in messages)
+    if DEBUG:
+        print(debug_message)
+    if DEBUG_LOG:
+        try:
+            with open(DEBUG_LOG, 'a') as fh:
                 fh.write(debug_message + "\n")
-                fh.close
-            except:
-                print("unable to write to log file {}".format(DEBUG_LOG))
+        except:
+            print("unable to write to log file {}".format(DEBUG_LOG))
+
+
+def profiled(slot):
+    """Return the slot wrapped for timing if profiling is enabled.
+
+    When the global PROFILER is None this just returns the slot unchanged,
+    so there is no overhead unless --profile was given.
+    """
+    if PROFILER is None or slot is None:
+        return slot
+    return PROFILER.wrap(slot)
+
+
+def is_start_url(url, config):
+    """Return True if the QUrl url points to the configured start_url."""
+    start_url = QUrl(config.get("start_url"))
+    return (
+        url.host() == start_url.host()
+        and str(url.path()).rstrip("/") == str(start_url.path()).rstrip("/")
+    )
 
 
 def get_ip():
@@ -182,14 +263,448 @@ def get_ip():
     return s.getsockname()[0]
 
 
+def get_rss():
+    """Return the resident set size of this process in kilobytes.
+
+    Reads /proc where it exists, otherwise falls back to the
+    peak RSS reported by getrusage().
+    """
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
+def get_tree_rss():
+    """Return the resident set size of this process and its descendants.
+
+    QtWebEngine renders pages in helper processes, which get_rss()
+    doesn't count.  Where there's no /proc, this is just get_rss().
+    """
+    try:
+        pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return get_rss()
+    children = defaultdict(list)
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as fh:
+                stat = fh.read()
+        except (IOError, OSError):
+            continue
+        # The command name can have spaces in it; the parent's pid is
+        # the second field after it.
+        children[int(stat.rsplit(")", 1)[1].split()[1])].append(pid)
+    total = 0
+    pending = [os.getpid()]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open("/proc/{}/statm".format(pid)) as fh:
+                pages = int(fh.read().split()[1])
+            total += pages * os.sysconf("SC_PAGE_SIZE") // 1024
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        pending.extend(children[pid])
+    return total
+
+
+# glibc's malloc_trim(), which returns freed heap memory to the system;
+# None where it isn't available.
+try:
+    MALLOC_TRIM = ctypes.CDLL(
+        ctypes.util.find_library("c") or "libc.so.6").malloc_trim
+except (OSError, AttributeError):
+    MALLOC_TRIM = None
+
+# Request logs, shared by everything logging to the same file; see
+# get_request_log().
+REQUEST_LOGS = {}
+
+
+def get_request_log(config):
+    """Return the RequestLog configured in config, or None.
+
+    Every network access manager logging to the same file shares one
+    RequestLog, since each one keeps its own place in the ring buffer.
+    """
+    filename = config.get("request_log")
+    if not filename:
+        return None
+    if filename not in REQUEST_LOGS:
+        try:
+            REQUEST_LOGS[filename] = RequestLog(
+                filename, config.get("request_log_size") or 1024,
+                config.get("request_log_sampling"))
+        except (IOError, OSError, ValueError) as e:
+            debug("Can't open request log {}: {}".format(filename, e))
+            REQUEST_LOGS[filename] = None
+    return REQUEST_LOGS[filename]
+
+
+# Learned zoom levels, shared by every window using the same store file;
+# see get_zoom_store().
+ZOOM_STORES = {}
+
+
+def get_zoom_store(config):
+    """Return the ZoomStore configured in config, or None.
+
+    The store is written out when the application quits.
+    """
+    filename = config.get("zoom_store")
+    if not filename:
+        return None
+    if filename not in ZOOM_STORES:
+        ZOOM_STORES[filename] = ZoomStore(filename)
+        if QCoreApplication.instance() is not None:
+            QCoreApplication.instance().aboutToQuit.connect(
+                ZOOM_STORES[filename].flush)
+    return ZOOM_STORES[filename]
+
+
+# Compiled whitelist patterns, shared by every window in the process
+# and keyed by the frozenset of whitelisted hosts.
+WHITELIST_PATTERNS = {}
+
+
+def whitelist_pattern(whitelist):
+    """Return a compiled regex matching hosts in or under whitelist."""
+    key = frozenset(whitelist)
+    if key not in WHITELIST_PATTERNS:
+        WHITELIST_PATTERNS[key] = re.compile(str("(^|.*\\.)(" + "|".join(
+            [re.escape(w) for w in sorted(key)]
+        ) + ")$"))
+        debug("Whitelist pattern: {}".format(
+            WHITELIST_PATTERNS[key].pattern))
+    return WHITELIST_PATTERNS[key]
+
+
+# How often credentials were sent before being asked for ("preemptive"),
+# refused anyway ("rejected"), and asked for by a server ("challenged").
+AUTH_COUNTS = Counter()
+
+
+def credential_origin(url):
+    """Return the (scheme, host, port) that preemptive credentials are for."""
+    scheme = str(url.scheme())
+    return scheme, str(url.host()), url.port(
+        {"http": 80, "https": 443}.get(scheme, -1))
+
+
+def credential_origins(credentials):
+    """Return a "credentials" dict's host settings keyed by origin.
+
+    Each host's credentials are for HTTPS on the default port (or on
+    "port"), and for plain HTTP as well only if "allow_http" is set.
+    """
+    origins = {}
+    for host, settings in (credentials or {}).items():
+        for scheme in ["https"] + (
+                ["http"] if settings.get("allow_http") else []):
+            url = QUrl("{}://{}".format(scheme, host))
+            if settings.get("port"):
+                url.setPort(int(settings["port"]))
+            origins[credential_origin(url)] = settings
+    return origins
+
+
+def preemptive_headers(credentials):
+    """Return Authorization headers by origin for a "credentials" dict.
+
+    Hosts with "preemptive: false" are left out.
+    """
+    return {
+        origin: basic_authorization(settings)
+        for origin, settings in credential_origins(credentials).items()
+        if settings.get("preemptive", True)
+    }
+
+
+def basic_authorization(credentials):
+    """Return a Basic Authorization header value for a credentials dict."""
+    user_pass = "{}:{}".format(
+        credentials.get("user") or "", credentials.get("password") or "")
+    return b"Basic " + base64.b64encode(user_pass.encode("utf-8"))
+
+
+# QNetworkRequest's HTTP/2 attributes, or None where Qt is too old for
+# them (5.8, or 5.11 for Http2DirectAttribute).
+HTTP2_ALLOWED = getattr(QNetworkRequest, "HTTP2AllowedAttribute", None)
+HTTP2_DIRECT = getattr(QNetworkRequest, "Http2DirectAttribute", None)
+HTTP2_WAS_USED = getattr(QNetworkRequest, "HTTP2WasUsedAttribute", None)
+
+# Finished HTTP(S) requests by host: "requests", "http2" (the ones made
+# over HTTP/2), "https", "handshakes" (the HTTPS ones that needed a new
+# connection), and "ms" (their total time).  See connection_summary().
+CONNECTION_STATS = defaultdict(Counter)
+MAX_CONNECTION_HOSTS = 200
+
+
+def connection_summary(hosts=20):
+    """Return the connection counts, in total and for the busiest hosts.
+
+    "reused" is the HTTPS requests that went over a connection that was
+    already open; Qt doesn't say for plain HTTP.
+    """
+    def summarize(stats):
+        summary = dict(
+            (key, stats[key])
+            for key in ("requests", "http2", "https", "handshakes"))
+        summary["reused"] = stats["https"] - stats["handshakes"]
+        summary["mean_ms"] = round(
+            stats["ms"] / stats["requests"], 1) if stats["requests"] else 0
+        return summary
+    total = Counter()
+    for stats in CONNECTION_STATS.values():
+        total.update(stats)
+    busiest = sorted(
+        CONNECTION_STATS.items(), key=lambda item: -item[1]["requests"])
+    return {
+        "total": summarize(total),
+        "hosts": dict(
+            (host, summarize(stats)) for host, stats in busiest[:hosts])
+    }
+
+
+# Link prefetches: "prefetched" links, of which "fetched" pages, "hits"
+# (fetched pages followed before they expired), "skipped" (over the
+# concurrency or byte limits), and the bytes fetched that were
+# "used_bytes" or "wasted_bytes".
+PREFETCH_COUNTS = Counter()
+
+
+def prefetch_summary():
+    """Return the link prefetch counts, with the hit rate."""
+    summary = dict(
+        (key, PREFETCH_COUNTS[key]) for key in (
+            "prefetched", "fetched", "hits", "skipped", "used_bytes",
+            "wasted_bytes"))
+    summary["hit_rate"] = round(
+        summary["hits"] / float(summary["fetched"]), 3
+    ) if summary["fetched"] else 0
+    return summary
+
+
+# Peer cache clients, shared by every window using the same service; see
+# get_peer_cache().
+PEER_CACHES = {}
+
+
+def get_peer_cache(config):
+    """Return the PeerCacheClient configured in config, or None.
+
+    The start_url, bookmark and whitelisted hosts of every config using
+    the service are shared through it.
+    """
+    settings = config.get("peer_cache") or {}
+    if not settings.get("url"):
+        return None
+    if settings["url"] not in PEER_CACHES:
+        PEER_CACHES[settings["url"]] = PeerCacheClient(settings)
+    peer_cache = PEER_CACHES[settings["url"]]
+    peer_cache.hosts.update(
+        host for host in [QUrl(config.get("start_url")).host()] + [
+            QUrl(bookmark.get("url", "")).host()
+            for bookmark in (config.get("bookmarks") or {}).values()
+        ] if host
+    )
+    peer_cache.whitelist.update(config.get("whitelist") or [])
+    # Credentials mustn't be shared, so neither are those hosts' assets
+    peer_cache.private_hosts.update(config.get("credentials") or {})
+    return peer_cache
+
+
+# Redirect caches, shared by every window using the same file; see
+# get_redirect_cache().
+REDIRECT_CACHES = {}
+
+
+def get_redirect_cache(config):
+    """Return the RedirectCache configured in config, or None.
+
+    The start_url and bookmark hosts of every config sharing the cache
+    are in its scope.
+    """
+    filename = config.get("redirect_cache")
+    if not filename:
+        return None
+    if filename not in REDIRECT_CACHES:
+        REDIRECT_CACHES[filename] = RedirectCache(
+            filename, (config.get("redirect_cache_ttl") or 30) * 86400)
+    hosts = [QUrl(config.get("start_url")).host()] + [
+        QUrl(bookmark.get("url", "")).host()
+        for bookmark in (config.get("bookmarks") or {}).values()
+    ]
+    REDIRECT_CACHES[filename].hosts.update(host for host in hosts if host)
+    return REDIRECT_CACHES[filename]
+
+
+# The TimeoutWheel shared by every network access manager; see
+# get_timeout_wheel().
+TIMEOUT_WHEEL = None
+
+
+def get_timeout_wheel():
+    """Return the process's TimeoutWheel, creating it if need be."""
+    global TIMEOUT_WHEEL
+    if TIMEOUT_WHEEL is None:
+        TIMEOUT_WHEEL = TimeoutWheel()
+    return TIMEOUT_WHEEL
+
+
+def host_setting(settings, host):
+    """Return the value in settings for host, or for a domain above it.
+
+    Like the whitelist, a setting for "example.com" also covers
+    "foo.example.com".  Returns None if nothing matches.
+    """
+    labels = host.split(".")
+    for i in range(len(labels)):
+        domain = ".".join(labels[i:])
+        if domain in settings:
+            return settings[domain]
+    return None
+
+
+# Icons are only looked up once; see cached_icon()
+ICON_CACHE = {}
+
+
+def cached_icon(name):
+    """Return a QIcon for an image filename or a theme icon name.
+
+    Each icon is loaded once per theme and then reused, so rebuilding
+    the navigation bar doesn't search the icon theme again.
+    """
+    key = (name, QIcon.themeName())
+    if key not in ICON_CACHE:
+        if os.path.isfile(name):
+            ICON_CACHE[key] = QIcon(name)
+        else:
+            ICON_CACHE[key] = QIcon.fromTheme(
+                name, QIcon(":/{}.png".format(name)))
+    return ICON_CACHE[key]
+
+
+# The global event loop profiler, set up from the command line (--profile).
+PROFILER = None
+
+# The global session recorder and replay archive, set up from the command
+# line (--record_session and --replay_session).
+SESSION_RECORDER = None
+SESSION_REPLAY = None
+
+
+# WebKit settings for each "performance_profile".  "settings" are
+# QWebSettings attribute names, which are skipped if the binding doesn't
+# have them.  "max_frame_rate" limits requestAnimationFrame, and
+# "stop_animations" turns off CSS animations and transitions.
+PERFORMANCE_PROFILES = {
+    "default": {},
+    "low_power": {
+        "settings": {
+            "TiledBackingStoreEnabled": True,
+            "FrameFlatteningEnabled": True,
+            "AcceleratedCompositingEnabled": False,
+            "Accelerated2dCanvasEnabled": False,
+            "WebGLEnabled": False,
+            "ScrollAnimatorEnabled": False
+        },
+        "max_frame_rate": 30,
+        "stop_animations": True
+    }
+}
+
+NO_ANIMATIONS_CSS = "data:text/css;charset=utf-8;base64," + base64.b64encode(
+    b"*, *::before, *::after { animation: none !important;"
+    b" -webkit-animation: none !important; transition: none !important;"
+    b" -webkit-transition: none !important; }"
+).decode("ascii")
+
+# Replaces requestAnimationFrame with a timer running at most {fps} times
+# a second.
+FRAME_RATE_LIMIT_JS = """(function () {{
+    var interval = 1000 / {fps}, next = 0;
+    window.requestAnimationFrame = window.webkitRequestAnimationFrame =
+        function (callback) {{
+            var now = Date.now(), wait = Math.max(0, next - now);
+            next = now + wait + interval;
+            return setTimeout(function () {{ callback(Date.now()); }}, wait);
+        }};
+    window.cancelAnimationFrame = window.webkitCancelAnimationFrame =
+        function (id) {{ clearTimeout(id); }};
+}})();"""
+
+# Adds a style sheet to a page; QtWebEngine has no user style sheet
+# setting.
+STYLE_SHEET_JS = """(function () {{
+    var link = document.createElement("link");
+    link.rel = "stylesheet";
+    link.href = {url};
+    (document.head || document.documentElement).appendChild(link);
+}})();"""
+
+# The standard functions available to proxy auto-config (PAC) scripts.
+# The ones that need the network call the PacFunctions object, "wcg".
+# Since decisions are cached per host, the date and time functions
+# always match.
+PAC_FUNCTIONS_JS = r"""
+function isPlainHostName(host) { return host.indexOf(".") < 0; }
+function dnsDomainIs(host, domain) {
+    return host.length >= domain.length
+        && host.substring(host.length - domain.length) == domain;
+}
+function localHostOrDomainIs(host, hostdom) {
+    return host == hostdom || hostdom.lastIndexOf(host + ".", 0) == 0;
+}
+function dnsResolve(host) { return wcg.dnsResolve(host) || null; }
+function isResolvable(host) { return !!dnsResolve(host); }
+function myIpAddress() { return wcg.myIpAddress() || "127.0.0.1"; }
+function dnsDomainLevels(host) { return host.split(".").length - 1; }
+function shExpMatch(str, pattern) {
+    return new RegExp("^" + pattern.replace(/[.+^${}()|[\]\\]/g, "\\$&")
+        .replace(/\*/g, ".*").replace(/\?/g, ".") + "$").test(str);
+}
+function convert_addr(ip) {
+    var parts = ip.split(".");
+    return ((parts[0] << 24) | (parts[1] << 16) | (parts[2] << 8)
+        | parts[3]) >>> 0;
+}
+function isInNet(host, pattern, mask) {
+    var ip = /^\d+\.\d+\.\d+\.\d+$/.test(host) ? host : dnsResolve(host);
+    if (!ip) return false;
+    mask = convert_addr(mask);
+    return ((convert_addr(ip) & mask) >>> 0)
+        == ((convert_addr(pattern) & mask) >>> 0);
+}
+function weekdayRange() { return true; }
+function dateRange() { return true; }
+function timeRange() { return true; }
+"""
+
+
 # Define our default configuration settings
 CONFIG_OPTIONS = {
     "allow_external_content": {"default": False, "type": bool},
     "allow_plugins":          {"default": False, "type": bool},
     "allow_popups":           {"default": False, "type": bool},
     "allow_printing":         {"default": False, "type": bool},
+    "asset_dir":              {"default": None, "type": str},
     "bookmarks":              {"default": {}, "type": dict},
+    "compact_memory":         {"default": False, "type": bool},
+    "connections":            {"default": {}, "type": dict},
+    "console_log_rate":       {"default": 10, "type": int},
     "content_handlers":       {"default": {}, "type": dict},
+    "control_socket":         {"default": None, "type": str},
+    "credentials":            {"default": {}, "type": dict},
     "default_encoding":       {"default": "utf-8", "type": str},
     "default_password":       {"default": None, "type": str},
     "default_user":           {"default": None, "type": str},
@@ -197,7 +712,13 @@ CONFIG_OPTIONS = {
     "force_js_confirm":       {"default": "ask", "type": str,
                                "values": ("ask", "accept", "deny")},
     "fullscreen":             {"default": False, "type": bool},
+    "icon_dir":               {"default": None, "type": str},
     "icon_theme":             {"default": None, "type": str},
+    "link_prefetch":          {"default": {}, "type": dict},
+    "max_handlers":           {"default": 4, "type": int},
+    "max_image_size":         {"default": 0, "type": int},
+    "max_requests":           {"default": 0, "type": int},
+    "max_requests_per_host":  {"default": 6, "type": int},
     "navigation":             {"default": True, "type": bool},
     "navigation_layout":      {"default":
                                ['back', 'forward', 'refresh', 'stop',
@@ -206,16 +727,36 @@ CONFIG_OPTIONS = {
                                 'quit'], "type": list},
     "network_down_html":      {"default": DEFAULT_NETWORK_DOWN,
                                "type": str, "is_file": True},
+    "offline_cache_dir":      {"default": None, "type": str},
+    "offline_retry":          {"default": 5, "type": int},
+    "offline_retry_max":      {"default": 300, "type": int},
     "page_unavailable_html":  {"default": DEFAULT_404, "type": str,
                                "is_file": True},
+    "peer_cache":             {"default": {}, "type": dict},
+    "performance_profile":    {"default": "default", "type": str,
+                               "values": ["default", "low_power"]},
     "print_settings":         {"default": {}, "type": dict},
     "privacy_mode":           {"default": True, "type": bool},
+    "proxy_pac":              {"default": None, "type": str},
+    "proxy_rules":            {"default": [], "type": list},
     "proxy_server":           {"default": None, "type": str,
                                "env": "http_proxy"},
     "quit_button_mode":       {"default": "reset", "type": str,
                                "values": ["reset", "close"]},
     "quit_button_text":       {"default": "I'm &Finished", "type": str},
+    "redirect_cache":         {"default": None, "type": str},
+    "redirect_cache_ttl":     {"default": 30, "type": int},
+    "rendering_engine":       {"default": "webkit", "type": str,
+                               "values": ["webkit", "webengine"]},
+    "request_log":            {"default": None, "type": str},
+    "request_log_sampling":   {"default": {}, "type": dict},
+    "request_log_size":       {"default": 1024, "type": int},
+    "request_timeouts":       {"default": {}, "type": dict},
+    "screen":                 {"default": None, "type": int},
+    "screensaver_snapshot":   {"default": False, "type": bool},
     "screensaver_url":        {"default": "about:blank", "type": str},
+    "seats":                  {"default": [], "type": list},
+    "site_zoom":              {"default": {}, "type": dict},
     "ssl_mode":               {"default": "strict", "type": str,
                                "values": ["strict", "ignore"]},
     "start_url":              {"default": "about:blank", "type": str},
@@ -228,15 +769,104 @@ CONFIG_OPTIONS = {
     "user_css":               {"default": None, "type": str},
     "whitelist":              {"default": None},  # don't check type here
     "window_size":            {"default": None},  # don't check type
-    "zoom_factor":            {"default": 1.0, "type": float}
+    "zoom_factor":            {"default": 1.0, "type": float},
+    "zoom_store":             {"default": None, "type": str}
 }
 
 
-class MainWindow(QMainWindow):
+# Use libyaml's C loader when it's available; it's much faster.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-    """This is the main application window class
 
-    it defines the GUI window for the browser
+def load_yaml(filename):
+    """Return the contents of a YAML file, or an empty dict."""
+    with open(filename, 'r') as fh:
+        return yaml.load(fh, Loader=YAML_LOADER) or {}
+
+
+def config_cache_key(options, seat=None):
+    """Return a key identifying everything the resolved config depends on.
+
+    That's the command line options, the relevant environment variables,
+    the seat, and the modification times of this script, the config file
+    and any HTML template files.
+    """
+    options = vars(options)
+    files = [__file__, options.get("config_file")]
+    env = []
+    for key, metadata in sorted(CONFIG_OPTIONS.items()):
+        env_val = os.environ.get(metadata.get("env", ''))
+        env.append(env_val)
+        if metadata.get("is_file"):
+            files.append(options.get(key) or env_val)
+    stats = []
+    for filename in files:
+        try:
+            st = os.stat(filename)
+            stats.append((filename, st.st_mtime, st.st_size))
+        except (TypeError, OSError):
+            stats.append((filename, None, None))
+    return hashlib.sha1(repr(
+        (sorted(options.items()), env, seat, stats)
+    ).encode("utf-8")).hexdigest()
+
+
+def read_config_cache(filename, key):
+    """Return the value cached under key in filename, or None."""
+    try:
+        with open(filename, 'r') as fh:
+            entries = json.load(fh)
+    except (IOError, OSError, ValueError) as e:
+        # A missing or corrupt cache just means we parse again.
+        if os.path.exists(filename):
+            debug("Ignoring config cache {}: {}".format(filename, e))
+        return None
+    return entries.get(key) if isinstance(entries, dict) else None
+
+
+def write_config_cache(filename, key, value):
+    """Store the JSON-compatible value under key in the cache file filename.
+
+    A few entries are kept, so that every seat can be cached.  Values
+    that wouldn't come back the same from JSON aren't cached.  The file
+    is replaced in one step, so a reader never sees half of it.
+    """
+    try:
+        if json.loads(json.dumps(value)) != value:
+            debug("Config can't be cached as JSON; not caching it")
+            return
+    except (TypeError, ValueError) as e:
+        debug("Config can't be cached as JSON ({}); not caching it".format(e))
+        return
+    try:
+        with open(filename, 'r') as fh:
+            entries = json.load(fh)
+    except (IOError, OSError, ValueError):
+        entries = {}
+    if not isinstance(entries, dict) or len(entries) >= 16:
+        entries = {}
+    entries[key] = value
+    try:
+        fd, temp_name = tempfile.mkstemp(
+            prefix=".config_cache_",
+            dir=os.path.dirname(os.path.abspath(filename)))
+    except (IOError, OSError) as e:
+        debug("Unable to write config cache {}: {}".format(filename, e))
+        return
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(entries, fh)
+        os.replace(temp_name, filename)
+    except (IOError, OSError) as e:
+        debug("Unable to write config cache {}: {}".format(filename, e))
+        os.remove(temp_name)
+
+
+class ConfigLoader(object):
+    """Builds a config dict from the config file, options and environment.
+
+    MainWindow mixes this in; the benchmarks use it on its own, so they
+    can run without a window loading the start page.
     """
 
     def parse_config(self, file_config, options):
@@ -282,6 +912,83 @@ class MainWindow(QMainWindow):
                 self.config[key] = metadata.get("type")(self.config[key])
         debug(repr(self.config))
 
+    def load_config(self, options, seat=None):
+        """Load the config file and set self.config and self.seat.
+
+        If a config cache file was given (--config_cache), the resolved
+        config is stored there and reused as long as the config file,
+        HTML templates, options and environment haven't changed.
+        """
+        cache_file = getattr(options, "config_cache", None)
+        if cache_file:
+            cache_key = config_cache_key(options, seat)
+            cached = read_config_cache(cache_file, cache_key)
+            if cached:
+                self.seat, self.config = cached["seat"], cached["config"]
+                if self.config.get("whitelist"):
+                    self.config["whitelist"] = set(self.config["whitelist"])
+                debug("Using cached configuration from '{}'".format(
+                    cache_file))
+                return
+
+        debug("loading configuration from '{}'".format(options.config_file))
+        configfile = {}
+        if options.config_file:
+            configfile = load_yaml(options.config_file)
+        # In multi-seat mode, the seat's settings override the file's.
+        seats = configfile.get("seats")
+        if seats and seat is None:
+            seat = 0
+        self.seat = seat
+        if seat is not None:
+            configfile = dict(configfile)
+            configfile.update(seats[seat] or {})
+            debug("Configuring seat {}".format(seat + 1))
+        self.parse_config(configfile, options)
+
+        # If the whitelist is activated, add the bookmarks and start_url
+        if self.config.get("whitelist"):
+            # we can just specify whitelist = True,
+            # which should whitelist just the start_url and bookmark urls.
+            whitelist = self.config.get("whitelist")
+            if type(whitelist) is not list:
+                whitelist = []
+            whitelist.append(str(QUrl(
+                self.config.get("start_url")
+            ).host()))
+            bookmarks = self.config.get("bookmarks")
+            if bookmarks:
+                whitelist += [
+                    str(QUrl(b.get("url")).host())
+                    for k, b in bookmarks.items()
+                ]
+            # uniquify and optimize
+            self.config["whitelist"] = set(whitelist)
+            debug("Generated whitelist: " + str(whitelist))
+
+        if cache_file:
+            config = dict(self.config)
+            if config.get("whitelist"):
+                config["whitelist"] = sorted(config["whitelist"])
+            write_config_cache(
+                cache_file, cache_key, {"seat": self.seat, "config": config})
+
+
+class MainWindow(ConfigLoader, QMainWindow):
+
+    """This is the main application window class
+
+    it defines the GUI window for the browser
+    """
+
+    # The navigation bar items that are the web view's own actions
+    PAGE_ACTIONS = (
+        ("back", QWebPage.Back),
+        ("forward", QWebPage.Forward),
+        ("refresh", QWebPage.Reload),
+        ("stop", QWebPage.Stop)
+    )
+
     def createAction(self, text, slot=None, shortcut=None, icon=None, tip=None,
                      checkable=False, signal="triggered"):
         """Return a QAction given a number of common QAction attributes
@@ -291,9 +998,7 @@ class MainWindow(QMainWindow):
         """
         action = QAction(text, self)
         if icon is not None:
-            action.setIcon(QIcon.fromTheme(
-                icon, QIcon(":/{}.png".format(icon))
-            ))
+            action.setIcon(cached_icon(icon))
         if shortcut is not None and not shortcut.isEmpty():
             action.setShortcut(shortcut)
             tip += " ({})".format(shortcut.toString())
@@ -301,21 +1006,48 @@ class MainWindow(QMainWindow):
             action.setToolTip(tip)
             action.setStatusTip(tip)
         if slot is not None:
-            getattr(action, signal).connect(slot)
+            getattr(action, signal).connect(profiled(slot))
         if checkable:
             action.setCheckable()
         return action
 
-    def __init__(self, options, parent=None):
-        """Construct a MainWindow Object."""
+    def __init__(self, options, parent=None, seat=None):
+        """Construct a MainWindow Object.
+
+        args:
+          options -- the parsed command line options
+          seat -- index into the "seats" config list for this window
+        """
         super(MainWindow, self).__init__(parent)
-        # Load config file
-        self.setWindowTitle("Browser")
-        debug("loading configuration from '{}'".format(options.config_file))
-        configfile = {}
-        if options.config_file:
-            configfile = yaml.safe_load(open(options.config_file, 'r'))
-        self.parse_config(configfile, options)
+        self.options = options
+        self.load_config(options, seat)
+        if self.seat is not None:
+            self.setWindowTitle("Browser (seat {})".format(self.seat + 1))
+        else:
+            self.setWindowTitle("Browser")
+        # The printer settings are only validated once, here.
+        self.print_queue = (
+            self.config.get("allow_printing")
+            and PrintQueue(self.config.get("print_settings"))
+            or None
+        )
+        self.page_cache = PageCache(self.config)
+        self.asset_bundle = (
+            self.config.get("asset_dir")
+            and AssetBundle(self.config.get("asset_dir"), self.config)
+            or None
+        )
+        self.handler_launcher = HandlerLauncher(
+            self.config.get("max_handlers"))
+        self.console_capture = ConsoleCapture(
+            self.config.get("console_log_rate"))
+        self.request_scheduler = self.make_request_scheduler()
+        self.proxy_router = make_proxy_router(self.config)
+        self.zoom_store = get_zoom_store(self.config)
+        self.offline_store = None
+        if self.config.get("offline_cache_dir"):
+            self.offline_store = OfflineStore(self.config, self)
+            self.offline_store.online.connect(self.back_online)
         # self.popup will hold a reference to the popup window
         # if it gets opened
         self.popup = None
@@ -332,26 +1064,17 @@ class MainWindow(QMainWindow):
                     .format(self.config.get("stylesheet"))
                 )
         self.setObjectName("global")
-
-        # If the whitelist is activated, add the bookmarks and start_url
-        if self.config.get("whitelist"):
-            # we can just specify whitelist = True,
-            # which should whitelist just the start_url and bookmark urls.
-            whitelist = self.config.get("whitelist")
-            if type(whitelist) is not list:
-                whitelist = []
-            whitelist.append(str(QUrl(
-                self.config.get("start_url")
-            ).host()))
-            bookmarks = self.config.get("bookmarks")
-            if bookmarks:
-                whitelist += [
-                    str(QUrl(b.get("url")).host())
-                    for k, b in bookmarks.items()
-                ]
-                # uniquify and optimize
-                self.config["whitelist"] = set(whitelist)
-            debug("Generated whitelist: " + str(whitelist))
+        self.compactor = (
+            self.config.get("compact_memory") and MemoryCompactor(parent=self)
+            or None
+        )
+        # These are replaced by build_ui() on every reset
+        self.browser_window = None
+        self.event_filter = None
+        # The navigation bar is built by build_ui(), and kept across resets
+        self.navigation_bar = None
+        self.navigation_key = None
+        self.really_quit = None
 
         # If diagnostic is enabled:
         #   connect CTRL+ALT+? to show some diagnistic info
@@ -382,21 +1105,46 @@ class MainWindow(QMainWindow):
 
         debug("build_ui")
         inactivity_timeout = self.config.get("timeout")
-        quit_button_tooltip = (
-            self.config.get("quit_button_mode") == 'close'
-            and "Click here to quit the browser."
-            or """Click here when you are done.
-            It will clear your browsing history"""
-            """ and return you to the start page.""")
-        qb_mode_callbacks = {'close': self.close, 'reset': self.reset_browser}
         to_mode_callbacks = {'close': self.close,
                              'reset': self.reset_browser,
                              'screensaver': self.screensaver}
         self.screensaver_active = False
+        self.snapshot_label = None
+
+        # Throw away what's left of the last session
+        if self.browser_window is not None:
+            if getattr(self.browser_window, "popup", None) is not None:
+                self.browser_window.popup.close()
+                self.browser_window.popup.deleteLater()
+            self.browser_window.popup = None
+        if self.event_filter is not None:
+            QCoreApplication.instance().removeEventFilter(self.event_filter)
+            self.event_filter.stop()
+            self.event_filter.deleteLater()
+            self.event_filter = None
 
         # ##Start GUI configuration## #
-        self.browser_window = WcgWebView(self.config)
+        self.browser_window = make_web_view(
+            self.config,
+            print_queue=self.print_queue,
+            page_cache=self.page_cache,
+            offline_store=self.offline_store,
+            asset_bundle=self.asset_bundle,
+            handler_launcher=self.handler_launcher,
+            console_capture=self.console_capture,
+            request_scheduler=self.request_scheduler,
+            proxy_router=self.proxy_router,
+            zoom_store=self.zoom_store,
+            seat=self.seat
+        )
         self.browser_window.setObjectName("web_content")
+        # Get connections to the sites patrons will go to ready for them
+        nam = getattr(self.browser_window, "nam", None)
+        if (self.config.get("connections") or {}).get("keep_warm") and nam:
+            nam.preconnect([self.config.get("start_url")] + [
+                bookmark.get("url", "")
+                for bookmark in (self.config.get("bookmarks") or {}).values()
+            ])
 
         if (
             self.config.get("icon_theme") is not None
@@ -406,6 +1154,14 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(self.browser_window)
         debug("loading {}".format(self.config.get("start_url")))
         self.browser_window.setUrl(QUrl(self.config.get("start_url")))
+        if self.config.get("screen") is not None:
+            desktop = QApplication.desktop()
+            if self.config.get("screen") < desktop.screenCount():
+                self.move(desktop.screenGeometry(
+                    self.config.get("screen")).topLeft())
+            else:
+                debug("Ignoring invalid screen {}".format(
+                    self.config.get("screen")))
         if self.config.get("fullscreen"):
             self.showFullScreen()
         elif (
@@ -423,116 +1179,219 @@ class MainWindow(QMainWindow):
                     self.config.get("window_size")
                 ))
 
-        # Set up the top navigation bar if it's configured to exist
+        # Set up the top navigation bar if it's configured to exist.
+        # It's only built again if its configuration has changed.
         if self.config.get("navigation"):
-            self.navigation_bar = QToolBar("Navigation")
-            self.navigation_bar.setObjectName("navigation")
-            self.addToolBar(Qt.TopToolBarArea, self.navigation_bar)
-            self.navigation_bar.setMovable(False)
-            self.navigation_bar.setFloatable(False)
-
-            #  Standard navigation tools
-            self.nav_items = {}
-            self.nav_items["back"] = self.browser_window.pageAction(QWebPage.Back)
-            self.nav_items["forward"] = self.browser_window.pageAction(QWebPage.Forward)
-            self.nav_items["refresh"] = self.browser_window.pageAction(QWebPage.Reload)
-            self.nav_items["stop"] = self.browser_window.pageAction(QWebPage.Stop)
-            # The "I'm finished" button.
-            self.nav_items["quit"] = self.createAction(
-                self.config.get("quit_button_text"),
-                qb_mode_callbacks.get(self.config.get("quit_button_mode"), self.reset_browser),
-                QKeySequence("Alt+F"),
-                None,
-                quit_button_tooltip)
-            # Zoom buttons
-            self.nav_items["zoom_in"] = self.createAction(
-                "Zoom In",
-                self.zoom_in,
-                QKeySequence("Alt++"),
-                "zoom-in",
-                "Increase the size of the text and images on the page")
-            self.nav_items["zoom_out"] = self.createAction(
-                "Zoom Out",
-                self.zoom_out,
-                QKeySequence("Alt+-"),
-                "zoom-out",
-                "Decrease the size of text and images on the page")
-            if self.config.get("allow_printing"):
-                self.nav_items["print"] = self.createAction(
-                    "Print",
-                    self.browser_window.print_webpage,
-                    QKeySequence("Ctrl+p"),
-                    "document-print",
-                    "Print this page")
-
-            # Add all the actions to the navigation bar.
-            for item in self.config.get("navigation_layout"):
-                if item == "separator":
-                    self.navigation_bar.addSeparator()
-                elif item == "spacer":
-                    # an expanding spacer.
-                    spacer = QWidget()
-                    spacer.setSizePolicy(
-                        QSizePolicy.Expanding, QSizePolicy.Preferred)
-                    self.navigation_bar.addWidget(spacer)
-                elif item == "bookmarks":
-                    # Insert bookmarks buttons here.
-                    self.bookmark_buttons = []
-                    for bookmark in self.config.get("bookmarks", {}).items():
-                        debug("Bookmark:\n" + bookmark.__str__())
-                        # bookmark name will use the "name" attribute, if present
-                        # or else just the key:
-                        bookmark_name = bookmark[1].get("name") or bookmark[0]
-                        # Create a button for the bookmark as a QAction,
-                        # which we'll add to the toolbar
-                        bookmark_url = bookmark[1].get("url", "about:blank")
-                        bookmark_callback = partial(
-                            self.browser_window.load,
-                            QUrl(bookmark_url)
-                        )
-                        button = self.createAction(
-                            bookmark_name,
-                            bookmark_callback,
-                            QKeySequence.mnemonic(bookmark_name),
-                            None,
-                            bookmark[1].get("description")
-                            )
-                        self.navigation_bar.addAction(button)
-                        self.navigation_bar.widgetForAction(button).setObjectName("navigation_button")
-                else:
-                    action = self.nav_items.get(item, None)
-                    if action:
-                        self.navigation_bar.addAction(action)
-                        self.navigation_bar.widgetForAction(action).setObjectName("navigation_button")
-
-            # This removes the ability to toggle off the navigation bar:
-            self.nav_toggle = self.navigation_bar.toggleViewAction()
-            self.nav_toggle.setVisible(False)
-            # End "if show_navigation is True" block
+            if (
+                self.navigation_bar is None
+                or self.navigation_key != self.make_navigation_key()
+            ):
+                self.build_navigation_bar()
+            else:
+                self.attach_navigation_bar()
+        elif self.navigation_bar is not None:
+            self.removeToolBar(self.navigation_bar)
+            self.navigation_bar.deleteLater()
+            self.navigation_bar = None
 
         # set hidden quit action
         # For reasons I haven't adequately ascertained,
         # this shortcut fails now and then claiming
         # "Ambiguous shortcut overload".
         # No idea why, as it isn't consistent.
-        self.really_quit = self.createAction(
-            "", self.close, QKeySequence("Ctrl+Alt+Q"), None, ""
-        )
-        self.addAction(self.really_quit)
+        if self.really_quit is None:
+            self.really_quit = self.createAction(
+                "", self.close, QKeySequence("Ctrl+Alt+Q"), None, ""
+            )
+            self.addAction(self.really_quit)
 
         # Call a reset function after timeout
         if inactivity_timeout != 0:
-            self.event_filter = InactivityFilter(inactivity_timeout)
+            self.event_filter = InactivityFilter(
+                inactivity_timeout,
+                window=(self if self.seat is not None else None)
+            )
             QCoreApplication.instance().installEventFilter(self.event_filter)
             self.browser_window.page().installEventFilter(self.event_filter)
-            self.event_filter.timeout.connect(
+            self.event_filter.timeout.connect(profiled(
                 to_mode_callbacks.get(self.config.get("timeout_mode"),
-                                      self.reset_browser))
+                                      self.reset_browser)))
         else:
             self.event_filter = None
 
         # ##END OF UI SETUP## #
 
+    def make_navigation_key(self):
+        """Return the settings the navigation bar is built from."""
+        return repr([
+            self.config.get(key) for key in (
+                "navigation_layout", "bookmarks", "quit_button_text",
+                "quit_button_mode", "allow_printing", "icon_theme",
+                "icon_dir"
+            )
+        ])
+
+    def build_navigation_bar(self):
+        """Create the navigation bar, with its actions and icons."""
+        debug("Building the navigation bar")
+        if self.navigation_bar is not None:
+            self.removeToolBar(self.navigation_bar)
+            self.navigation_bar.deleteLater()
+        self.navigation_key = self.make_navigation_key()
+        quit_button_tooltip = (
+            self.config.get("quit_button_mode") == 'close'
+            and "Click here to quit the browser."
+            or """Click here when you are done.
+            It will clear your browsing history"""
+            """ and return you to the start page.""")
+        qb_mode_callbacks = {'close': self.close, 'reset': self.reset_browser}
+        self.navigation_bar = QToolBar("Navigation")
+        self.navigation_bar.setObjectName("navigation")
+        self.addToolBar(Qt.TopToolBarArea, self.navigation_bar)
+        self.navigation_bar.setMovable(False)
+        self.navigation_bar.setFloatable(False)
+
+        #  Standard navigation tools
+        self.nav_items = {}
+        for name, web_action in self.PAGE_ACTIONS:
+            self.nav_items[name] = self.browser_window.pageAction(web_action)
+        # The "I'm finished" button.
+        self.nav_items["quit"] = self.createAction(
+            self.config.get("quit_button_text"),
+            qb_mode_callbacks.get(
+                self.config.get("quit_button_mode"), self.reset_browser),
+            QKeySequence("Alt+F"),
+            None,
+            quit_button_tooltip)
+        # Zoom buttons
+        self.nav_items["zoom_in"] = self.createAction(
+            "Zoom In",
+            self.zoom_in,
+            QKeySequence("Alt++"),
+            "zoom-in",
+            "Increase the size of the text and images on the page")
+        self.nav_items["zoom_out"] = self.createAction(
+            "Zoom Out",
+            self.zoom_out,
+            QKeySequence("Alt+-"),
+            "zoom-out",
+            "Decrease the size of text and images on the page")
+        if self.config.get("allow_printing"):
+            self.nav_items["print"] = self.createAction(
+                "Print",
+                self.print_webpage,
+                QKeySequence("Ctrl+p"),
+                "document-print",
+                "Print this page")
+
+        # Add all the actions to the navigation bar.
+        for item in self.config.get("navigation_layout"):
+            if item == "separator":
+                self.navigation_bar.addSeparator()
+            elif item == "spacer":
+                # an expanding spacer.
+                spacer = QWidget()
+                spacer.setSizePolicy(
+                    QSizePolicy.Expanding, QSizePolicy.Preferred)
+                self.navigation_bar.addWidget(spacer)
+            elif item == "bookmarks":
+                # Insert bookmarks buttons here.
+                self.bookmark_buttons = []
+                for bookmark in self.config.get("bookmarks", {}).items():
+                    debug("Bookmark:\n" + bookmark.__str__())
+                    # bookmark name will use the "name" attribute, if present
+                    # or else just the key:
+                    bookmark_name = bookmark[1].get("name") or bookmark[0]
+                    # Create a button for the bookmark as a QAction,
+                    # which we'll add to the toolbar
+                    bookmark_url = bookmark[1].get("url", "about:blank")
+                    bookmark_callback = partial(
+                        self.load_url, QUrl(bookmark_url))
+                    button = self.createAction(
+                        bookmark_name,
+                        bookmark_callback,
+                        QKeySequence.mnemonic(bookmark_name),
+                        None,
+                        bookmark[1].get("description")
+                        )
+                    icon = self.bookmark_icon(bookmark[1])
+                    if icon is not None:
+                        button.setIcon(icon)
+                    self.navigation_bar.addAction(button)
+                    self.navigation_bar.widgetForAction(
+                        button).setObjectName("navigation_button")
+                    self.bookmark_buttons.append(button)
+            else:
+                action = self.nav_items.get(item, None)
+                if action:
+                    self.navigation_bar.addAction(action)
+                    self.navigation_bar.widgetForAction(
+                        action).setObjectName("navigation_button")
+
+        # This removes the ability to toggle off the navigation bar:
+        self.nav_toggle = self.navigation_bar.toggleViewAction()
+        self.nav_toggle.setVisible(False)
+
+    def attach_navigation_bar(self):
+        """Point the existing navigation bar at a new browser window.
+
+        Only the back/forward/refresh/stop actions belong to the web view,
+        so they're swapped for the new view's; everything else is reused.
+        """
+        toolbar_actions = self.navigation_bar.actions()
+        for name, web_action in self.PAGE_ACTIONS:
+            old_action = self.nav_items[name]
+            new_action = self.browser_window.pageAction(web_action)
+            if old_action in toolbar_actions:
+                self.navigation_bar.insertAction(old_action, new_action)
+                self.navigation_bar.removeAction(old_action)
+                self.navigation_bar.widgetForAction(
+                    new_action).setObjectName("navigation_button")
+            self.nav_items[name] = new_action
+        self.nav_items["zoom_in"].setEnabled(True)
+        self.nav_items["zoom_out"].setEnabled(True)
+        self.navigation_bar.show()
+
+    def bookmark_icon(self, bookmark):
+        """Return the icon for a bookmark from the icon_dir, or None.
+
+        The icon is the bookmark's "icon" file if it has one, or else the
+        first of "<host>.png", "<host>.ico" or "<host>.svg" found in the
+        icon_dir.  Theme icons and the network are never consulted.
+        """
+        icon_dir = self.config.get("icon_dir") or ""
+        if bookmark.get("icon"):
+            candidates = [bookmark.get("icon")]
+        elif icon_dir:
+            host = QUrl(bookmark.get("url", "")).host()
+            candidates = [
+                host + extension for extension in (".png", ".ico", ".svg")
+            ]
+        else:
+            return None
+        for candidate in candidates:
+            path = os.path.join(icon_dir, candidate)
+            if os.path.isfile(path):
+                return cached_icon(path)
+        return None
+
+    def make_request_scheduler(self):
+        """Return a RequestScheduler for the config, or None."""
+        if not self.config.get("max_requests"):
+            return None
+        return RequestScheduler(
+            self.config.get("max_requests"),
+            self.config.get("max_requests_per_host")
+        )
+
+    def load_url(self, url):
+        """Load url in the browser window; used by the bookmark buttons."""
+        self.browser_window.load(url)
+
+    def print_webpage(self):
+        """Print the browser window's page; used by the print button."""
+        self.browser_window.print_webpage()
+
     def screensaver(self):
         """Enter "screensaver" mode
 
@@ -547,9 +1406,53 @@ class MainWindow(QMainWindow):
         if self.config.get("navigation"):
             self.navigation_bar.hide()
         self.browser_window.setZoomFactor(self.config.get("zoom_factor"))
+        if (
+            self.config.get("screensaver_snapshot")
+            and self.page_cache.screensaver_snapshot is not None
+        ):
+            # Show the last rendering of the screensaver page right away,
+            # while the live page loads behind it.
+            self.snapshot_label = QLabel(self.browser_window)
+            self.snapshot_label.setPixmap(self.page_cache.screensaver_snapshot)
+            self.snapshot_label.setGeometry(self.browser_window.rect())
+            self.snapshot_label.show()
+        self.browser_window.loadFinished.connect(self.screensaver_loaded)
         self.browser_window.load(QUrl(self.config.get("screensaver_url")))
         self.event_filter.timeout.disconnect()
-        self.event_filter.activity.connect(self.reset_browser)
+        self.event_filter.activity.connect(profiled(self.reset_browser))
+
+    def screensaver_loaded(self, ok):
+        """Handle the screensaver page finishing loading.
+
+        Removes the snapshot, if one is displayed, and takes a new one
+        once the page has had a moment to finish painting.
+        """
+        if self.snapshot_label is not None:
+            self.snapshot_label.deleteLater()
+            self.snapshot_label = None
+        if ok and self.config.get("screensaver_snapshot"):
+            QTimer.singleShot(1000, self.take_screensaver_snapshot)
+        if self.compactor is not None and self.screensaver_active:
+            self.compactor.schedule()
+
+    def take_screensaver_snapshot(self):
+        """Save an image of the screensaver page for next time."""
+        if not self.screensaver_active:
+            return
+        if hasattr(self.browser_window, "grab"):
+            snapshot = self.browser_window.grab()
+        else:  # Qt4
+            snapshot = QPixmap.grabWidget(self.browser_window)
+        self.page_cache.screensaver_snapshot = snapshot
+        debug("Saved screensaver snapshot")
+
+    def back_online(self):
+        """Reload the live start page once the network is back."""
+        if (
+            is_start_url(self.browser_window.url(), self.config)
+            or self.browser_window.url().isEmpty()
+        ):
+            self.browser_window.load(QUrl(self.config.get("start_url")))
 
     def reset_browser(self):
         """Clear the history and reset the UI.
@@ -559,10 +1462,15 @@ class MainWindow(QMainWindow):
         'reset' mode.
         """
         # Clear out the memory cache
-        QWebSettings.clearMemoryCaches()
+        self.browser_window.clear_caches()
+        # Close any external viewers the last patron opened
+        self.handler_launcher.kill_all()
+        if self.zoom_store is not None:
+            self.zoom_store.record(
+                self.browser_window.session_zooms(),
+                self.config.get("zoom_factor")
+            )
         self.browser_window.history().clear()
-        # self.navigation_bar.clear() doesn't do its job,
-        # so remove the toolbar first, then rebuild the UI.
         debug("RESET BROWSER")
         if self.event_filter:
             self.event_filter.blockSignals(True)
@@ -571,9 +1479,9 @@ class MainWindow(QMainWindow):
             self.event_filter.activity.disconnect()
         if self.event_filter:
             self.event_filter.blockSignals(False)
-        if hasattr(self, "navigation_bar"):
-            self.removeToolBar(self.navigation_bar)
         self.build_ui()
+        if self.compactor is not None:
+            self.compactor.schedule()
 
     def zoom_in(self):
         """Zoom in action callback.
@@ -584,6 +1492,7 @@ class MainWindow(QMainWindow):
             self.browser_window.setZoomFactor(
                 self.browser_window.zoomFactor() + 0.1
             )
+            self.browser_window.remember_zoom()
             self.nav_items["zoom_out"].setEnabled(True)
         else:
             self.nav_items["zoom_in"].setEnabled(False)
@@ -597,6 +1506,7 @@ class MainWindow(QMainWindow):
             self.browser_window.setZoomFactor(
                 self.browser_window.zoomFactor() - 0.1
             )
+            self.browser_window.remember_zoom()
             self.nav_items["zoom_in"].setEnabled(True)
         else:
             self.nav_items["zoom_out"].setEnabled(False)
@@ -625,10 +1535,97 @@ class MainWindow(QMainWindow):
                 "<li><b>{}</b>: {}</li>".format(k, v)
                 for k, v in data.items()
             ]),
+            "</ul>",
+            "<h2>JavaScript Console</h2>",
+            "<ul>",
+            "\n".join([
+                "<li><b>{}</b>: {} messages, {} errors; from {}</li>".format(
+                    escape(url), page["messages"], page["errors"],
+                    ", ".join(
+                        "{} ({})".format(escape(source or "(unknown)"), n)
+                        for source, n in page["top_sources"]
+                    )
+                )
+                for url, page in self.console_capture.summary().items()
+            ]),
             "</ul>"
         ])
         self.browser_window.setHtml(html)
 
+    def reload_config(self):
+        """Re-read the configuration and reset the browser with it."""
+        self.load_config(self.options, self.seat)
+        self.print_queue = (
+            self.config.get("allow_printing")
+            and PrintQueue(self.config.get("print_settings"))
+            or None
+        )
+        self.page_cache = PageCache(self.config)
+        self.asset_bundle = (
+            self.config.get("asset_dir")
+            and AssetBundle(self.config.get("asset_dir"), self.config)
+            or None
+        )
+        self.handler_launcher.max_handlers = self.config.get("max_handlers")
+        self.console_capture.rate = self.config.get("console_log_rate")
+        self.request_scheduler = self.make_request_scheduler()
+        self.proxy_router = make_proxy_router(self.config)
+        self.zoom_store = get_zoom_store(self.config)
+        if self.config.get("compact_memory") and self.compactor is None:
+            self.compactor = MemoryCompactor(parent=self)
+        elif not self.config.get("compact_memory"):
+            self.compactor = None
+        if self.offline_store is not None:
+            self.offline_store.deleteLater()
+            self.offline_store = None
+        if self.config.get("offline_cache_dir"):
+            self.offline_store = OfflineStore(self.config, self)
+            self.offline_store.online.connect(self.back_online)
+        self.reset_browser()
+
+    def status(self):
+        """Return a dict describing what this window is doing."""
+        return {
+            "seat": self.seat,
+            "url": self.browser_window.url().toString(),
+            "title": self.browser_window.title(),
+            "idle": (
+                self.event_filter
+                and round(time.time() - self.event_filter.last_activity, 1)
+            ),
+            "screensaver": self.screensaver_active,
+            "rss_kb": get_rss()
+        }
+
+    def metrics(self):
+        """Return the statistics collected by the browser's subsystems."""
+        metrics = {"rss_kb": get_rss()}
+        if PROFILER is not None:
+            metrics["profiler"] = PROFILER.metrics()
+        if self.print_queue is not None:
+            metrics["print_queue"] = self.print_queue.status()
+        if self.offline_store is not None:
+            metrics["offline"] = self.offline_store.stats()
+        metrics["content_handlers"] = self.handler_launcher.status()
+        metrics["javascript_console"] = self.console_capture.summary()
+        if self.request_scheduler is not None:
+            metrics["request_scheduler"] = self.request_scheduler.status()
+        if self.config.get("credentials"):
+            metrics["authentication"] = dict(AUTH_COUNTS)
+        if self.config.get("connections"):
+            metrics["connections"] = connection_summary()
+        if self.config.get("link_prefetch"):
+            metrics["link_prefetch"] = prefetch_summary()
+        peer_cache = get_peer_cache(self.config)
+        if peer_cache is not None:
+            metrics["peer_cache"] = peer_cache.status()
+        if self.config.get("redirect_cache"):
+            metrics["redirect_cache"] = get_redirect_cache(
+                self.config).status()
+        if self.compactor is not None:
+            metrics["memory_compaction"] = self.compactor.last_run
+        return metrics
+
 
 # ## END Main Application Window Class def ## #
 
@@ -641,25 +1638,41 @@ class InactivityFilter(QTimer):
     """
     activity = pyqtSignal()
 
-    def __init__(self, timeout=0, parent=None):
+    def __init__(self, timeout=0, parent=None, window=None):
         """Constructor for the class.
 
         args:
           timeout -- number of seconds before timer times out (integer)
+          window -- if set, only count activity in this window (and its
+                    popups), so seats in multi-seat mode time out separately
         """
         super(InactivityFilter, self).__init__(parent)
+        self.window = window
+        self.last_activity = time.time()
         # timeout needs to be converted from seconds to milliseconds
         self.timeout_time = timeout * 1000
         self.setInterval(self.timeout_time)
         self.start()
 
+    def is_our_window(self, object):
+        """Return True if object belongs to the window we're watching."""
+        if self.window is None:
+            return True
+        if not object.isWidgetType():
+            # Non-widgets (e.g. QWindow) can't be told apart between seats,
+            # but the same events are also delivered to the widgets.
+            return False
+        top = object.window()
+        return getattr(top, "main_window", top) is self.window
+
     def eventFilter(self, object, event):
         """Overridden from QTimer.eventFilter"""
         if event.type() in (
             QEvent.MouseMove, QEvent.MouseButtonPress,
             QEvent.HoverMove, QEvent.KeyPress,
             QEvent.KeyRelease
-        ):
+        ) and self.is_our_window(object):
+            self.last_activity = time.time()
             self.activity.emit()
             self.start(self.timeout_time)
             # commented this debug code,
@@ -674,48 +1687,3505 @@ class InactivityFilter(QTimer):
         return QObject.eventFilter(self, object, event)
 
 
-class WcgNetworkAccessManager(QNetworkAccessManager):
-    """Overridden so we can get debug info from responses"""
+class ControlServer(QObject):
+    """Remote control and status server on a local (Unix) socket.
 
-    def __init__(self):
-        super(WcgNetworkAccessManager, self).__init__()
-        # add event listener on "load finished" event
-        self.finished.connect(self._finished)
+    Clients send one JSON object per line, like {"command": "status"},
+    and get one JSON object per line back: {"ok": true, "result": ...}
+    or {"ok": false, "error": "..."}.  Any "id" in the request is echoed.
+    In multi-seat mode, "seat" (starting at 0) picks the window to
+    control; commands go to the first seat by default.
+    """
+
+    def __init__(self, path, windows, parent=None):
+        """Constructor for the class.
+
+        args:
+          path -- the socket name or filename to listen on
+          windows -- a list of the MainWindow objects to control
+        """
+        super(ControlServer, self).__init__(parent)
+        self.windows = windows
+        self.commands = {
+            "navigate": self.navigate,
+            "reset_browser": self.reset_browser,
+            "screensaver": self.screensaver,
+            "reload_config": self.reload_config,
+            "metrics": self.metrics,
+            "status": self.status
+        }
+        self.server = QLocalServer(self)
+        if hasattr(QLocalServer, "UserAccessOption"):
+            self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.new_connection)
+        QLocalServer.removeServer(path)
+        if self.server.listen(path):
+            debug("Control server listening on {}".format(
+                self.server.fullServerName()))
+        else:
+            debug("Control server could not listen on {}: {}".format(
+                path, self.server.errorString()))
+
+    def new_connection(self):
+        """Accept pending client connections."""
+        while self.server.hasPendingConnections():
+            client = self.server.nextPendingConnection()
+            client.readyRead.connect(partial(self.read_requests, client))
+            client.disconnected.connect(client.deleteLater)
+
+    def read_requests(self, client):
+        """Answer every complete line the client has sent."""
+        while client.canReadLine():
+            line = bytes(client.readLine()).decode("utf-8").strip()
+            if line:
+                client.write(
+                    (json.dumps(self.handle(line)) + "\n").encode("utf-8"))
+        client.flush()
+
+    def handle(self, line):
+        """Run the command in a request line and return the response."""
+        try:
+            request = json.loads(line)
+            command = self.commands[request["command"]]
+        except (ValueError, KeyError, TypeError):
+            return {"ok": False, "error": "invalid request: {}".format(line)}
+        response = {"ok": True}
+        if "id" in request:
+            response["id"] = request["id"]
+        try:
+            seat = int(request.get("seat") or 0)
+            if not 0 <= seat < len(self.windows):
+                response.update(ok=False, error="no such seat")
+            else:
+                response["result"] = command(self.windows[seat], request)
+        except Exception as e:
+            response.update(ok=False, error=str(e))
+        debug("Control command {}: {}".format(line, response["ok"]))
+        return response
+
+    def navigate(self, window, request):
+        """Load request["url"] in the window."""
+        url = QUrl(request.get("url", ""))
+        if not url.isValid() or url.isEmpty():
+            raise ValueError("invalid url")
+        window.browser_window.load(url)
+
+    def reset_browser(self, window, request):
+        """Reset the window, as if the patron clicked "finished"."""
+        window.reset_browser()
+
+    def screensaver(self, window, request):
+        """Put the window into screensaver mode."""
+        if window.event_filter is None:
+            raise ValueError("screensaver mode needs a timeout")
+        if not window.screensaver_active:
+            window.screensaver()
+
+    def reload_config(self, window, request):
+        """Re-read the config file and reset the window."""
+        window.reload_config()
+
+    def metrics(self, window, request):
+        """Return the window's collected statistics."""
+        return window.metrics()
+
+    def status(self, window, request):
+        """Return the status of the process and every seat."""
+        return {
+            "pid": os.getpid(),
+            "rss_kb": get_rss(),
+            "seats": [w.status() for w in self.windows]
+        }
+
+
+class EventLoopProfiler(QObject):
+    """Measures event loop latency and times Python slots.
+
+    A high-frequency probe timer measures how late the event loop is
+    in servicing it; any lag not accounted for by an instrumented Python
+    slot is blamed on Qt/WebKit.  Slots wrapped with wrap() are timed,
+    and on Unix their stacks are sampled with SIGPROF while they run.
+    Everything is written out as collapsed stacks ("a;b;c 12"), which
+    is the input format for flamegraph.pl and speedscope.  The lag
+    percentiles are over the last MAX_LAGS probes.
+    """
+
+    # About ten minutes of probes at the default interval
+    MAX_LAGS = 60000
+
+    def __init__(self, output_file, threshold=50, interval=10,
+                 sample_interval=5, parent=None):
+        """Constructor for the class.
+
+        args:
+          output_file -- filename for the collapsed-stack profile
+          threshold -- milliseconds before a callback or lag is "slow"
+          interval -- milliseconds between event loop probes
+          sample_interval -- milliseconds between stack samples in a slot
+        """
+        super(EventLoopProfiler, self).__init__(parent)
+        self.output_file = output_file
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_interval = sample_interval
+        # collapsed stack -> milliseconds
+        self.stacks = Counter()
+        self.lags = deque(maxlen=self.MAX_LAGS)
+        self.probes = 0
+        self.max_lag = 0.0
+        # slot name -> [calls, total ms, max ms]
+        self.slot_stats = defaultdict(lambda: [0, 0.0, 0.0])
+        self.slow_callbacks = 0
+        self._slot_depth = 0
+        self._slot_samples = []
+        self._slot_time = 0.0
+        self._last_probe = None
+        self.probe = QTimer(self)
+        self.probe.setInterval(self.interval)
+        self.probe.timeout.connect(self._probe)
+
+    def start(self):
+        """Start the probe timer and the stack sampler."""
+        self._last_probe = time.time()
+        self.probe.start()
+        if hasattr(signal, "setitimer"):
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(
+                signal.ITIMER_PROF,
+                self.sample_interval / 1000.0,
+                self.sample_interval / 1000.0
+            )
+        else:
+            debug("Stack sampling is not available on this platform")
+        self.check_builtin_slots()
+        debug("Event loop profiler started, writing to {}".format(
+            self.output_file))
+
+    def check_builtin_slots(self):
+        """Check that a profiled Qt method still takes surplus signal args.
+
+        The quit actions connect QMainWindow.close to triggered(bool);
+        if wrap() passed it the bool, PyQt would abort on the TypeError.
+        """
+        window = QMainWindow()
+        action = QAction(window)
+        action.triggered.connect(self.wrap(window.close, "slot_check"))
+        action.trigger()
+        window.deleteLater()
+        self.slot_stats.pop("slot_check", None)
+        self.stacks.pop("slot;slot_check", None)
+
+    def stop(self):
+        """Stop probing and write out the profile."""
+        self.probe.stop()
+        if hasattr(signal, "setitimer"):
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        self.write_profile()
+
+    def _probe(self):
+        """Measure how late this timer fired.
+
+        Time spent in instrumented slots since the last probe is
+        subtracted, so what's left is time blocked outside of Python.
+        """
+        now = time.time()
+        elapsed = (now - self._last_probe) * 1000
+        self._last_probe = now
+        lag = max(elapsed - self.interval, 0)
+        self.lags.append(lag)
+        self.probes += 1
+        self.max_lag = max(self.max_lag, lag)
+        outside = max(lag - self._slot_time, 0)
+        self._slot_time = 0.0
+        if outside > self.threshold:
+            self.stacks["event_loop;qt_webkit (outside python)"] += (
+                int(outside))
+            debug("Event loop blocked outside Python for {:.1f} ms"
+                  .format(outside))
+
+    def _sample(self, signum, frame):
+        """SIGPROF handler; record the stack if we're inside a slot."""
+        if self._slot_depth and frame is not None:
+            self._slot_samples.append(self._collapse(
+                traceback.extract_stack(frame)))
+
+    @staticmethod
+    def _collapse(stack):
+        """Turn a list of frame summaries into a collapsed stack string."""
+        return ";".join(
+            "{}:{}".format(os.path.basename(f[0]), f[2]) for f in stack
+        )
+
+    @staticmethod
+    def _arity(slot):
+        """Return the number of positional args slot takes, or None.
+
+        PyQt drops surplus signal arguments for slots that take fewer;
+        our wrapper has to do the same thing.
+        """
+        try:
+            params = inspect.signature(slot).parameters.values()
+        except (TypeError, ValueError):
+            return None
+        count = 0
+        for param in params:
+            if param.kind == param.VAR_POSITIONAL:
+                return None
+            if param.kind in (param.POSITIONAL_ONLY,
+                              param.POSITIONAL_OR_KEYWORD):
+                count += 1
+        return count
+
+    def wrap(self, slot, name=None):
+        """Return a timing wrapper around slot."""
+        name = name or getattr(
+            slot, "__qualname__",
+            getattr(getattr(slot, "func", None), "__qualname__", repr(slot))
+        )
+        arity = self._arity(slot)
+        try:
+            inspect.signature(slot)
+            trim = False
+        except (TypeError, ValueError):
+            # sip-wrapped Qt methods (like QMainWindow.close) have no
+            # signature to read; like PyQt, retry them with fewer args
+            trim = True
+
+        @wraps(slot)
+        def timed_slot(*args):
+            if arity is not None:
+                args = args[:arity]
+            self._slot_depth += 1
+            samples_before = len(self._slot_samples)
+            start = time.time()
+            try:
+                while True:
+                    try:
+                        return slot(*args)
+                    except TypeError:
+                        if not trim or not args:
+                            raise
+                        args = args[:-1]
+            finally:
+                duration = (time.time() - start) * 1000
+                self._slot_depth -= 1
+                samples = self._slot_samples[samples_before:]
+                if not self._slot_depth:
+                    self._slot_samples = []
+                    self._slot_time += duration
+                self._record(name, duration, samples)
+        return timed_slot
+
+    def _record(self, name, duration, samples):
+        """Record one slot call."""
+        stats = self.slot_stats[name]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        if samples:
+            weight = duration / len(samples)
+            for stack in samples:
+                self.stacks[stack] += int(round(weight)) or 1
+        else:
+            self.stacks["slot;{}".format(name)] += int(round(duration))
+        if duration > self.threshold:
+            self.slow_callbacks += 1
+            top = Counter(samples).most_common(1)
+            debug("Slow callback {} took {:.1f} ms; stack:\n{}".format(
+                name, duration,
+                top and top[0][0].replace(";", "\n")
+                or "".join(traceback.format_stack()[:-2])
+            ))
+
+    def metrics(self):
+        """Return a summary of what has been measured so far."""
+        lags = sorted(self.lags)
+        return {
+            "probes": self.probes,
+            "lag_max_ms": round(self.max_lag, 1),
+            "lag_p50_ms": lags and round(lags[len(lags) // 2], 1) or 0,
+            "lag_p99_ms": lags and round(lags[int(len(lags) * .99)], 1) or 0,
+            "slow_callbacks": self.slow_callbacks,
+            "slots": dict(
+                (k, {"calls": v[0], "total_ms": round(v[1], 1),
+                     "max_ms": round(v[2], 1)})
+                for k, v in self.slot_stats.items()
+            )
+        }
+
+    def write_profile(self):
+        """Write the collapsed stacks to the output file."""
+        try:
+            with open(self.output_file, 'w') as fh:
+                for stack, weight in self.stacks.most_common():
+                    if weight:
+                        fh.write("{} {}\n".format(stack, weight))
+        except IOError:
+            print("unable to write profile to {}".format(self.output_file))
+        debug("Profile summary: {}".format(self.metrics()))
+
+
+class MemoryCompactor(QObject):
+    """Gives memory back to the system while the kiosk is idle.
+
+    Scheduled after the browser is reset and once the screensaver is
+    showing, it works through its stages one pass of the event loop at
+    a time, so the GUI stays responsive: deleting the Qt objects left
+    over from the last session, a full garbage collection, clearing
+    WebKit's memory caches, and handing freed heap memory back with
+    malloc_trim() (glibc only).  RSS is logged before and after each stage.
+    """
+    STAGES = ("delete_objects", "collect_garbage", "clear_caches",
+              "trim_heap")
+
+    def __init__(self, delay=2000, parent=None):
+        """Constructor for the class.
+
+        args:
+          delay -- milliseconds to wait before compacting, so the page
+                   being shown can finish loading first
+        """
+        super(MemoryCompactor, self).__init__(parent)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.run)
+        self.stages = []
+        self.last_run = None
+
+    def schedule(self):
+        """Compact memory after the delay, unless already scheduled."""
+        if not self.timer.isActive() and not self.stages:
+            self.timer.start()
+
+    def run(self):
+        """Start working through the stages."""
+        self.stages = list(self.STAGES)
+        self.last_run = {"before_kb": get_rss(), "stages": {}}
+        self.next_stage()
+
+    def next_stage(self):
+        """Run the next stage, and schedule the one after it."""
+        if not self.stages:
+            self.last_run["after_kb"] = get_rss()
+            debug("Memory compaction finished: RSS {before_kb} kB -> "
+                  "{after_kb} kB".format(**self.last_run))
+            return
+        stage = self.stages.pop(0)
+        before = get_rss()
+        start = time.time()
+        getattr(self, stage)()
+        after = get_rss()
+        self.last_run["stages"][stage] = {
+            "after_kb": after, "ms": round((time.time() - start) * 1000, 1)
+        }
+        debug("Memory compaction {}: RSS {} kB -> {} kB".format(
+            stage, before, after))
+        QTimer.singleShot(0, self.next_stage)
+
+    def delete_objects(self):
+        """Carry out deletions queued with deleteLater()."""
+        QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+
+    def collect_garbage(self):
+        """Run a full garbage collection."""
+        gc.collect()
+
+    def clear_caches(self):
+        """Empty WebKit's in-memory caches."""
+        QWebSettings.clearMemoryCaches()
+
+    def trim_heap(self):
+        """Return free heap memory to the system, where we can."""
+        if MALLOC_TRIM is not None:
+            MALLOC_TRIM(0)
+
+
+class ConsoleCapture(object):
+    """Collects JavaScript console messages without flooding the log.
+
+    Repeats of a source's last message are counted instead of logged,
+    each source may log at most rate messages a second (the rest are
+    counted as dropped), and messages are written to the debug log in
+    batches by a background thread, and whatever is left is written
+    when the application quits.  Every message, logged or not, counts
+    toward the summary for its page.
+    """
+
+    MAX_PAGES = 20
+    MAX_SOURCES = 500
+    FLUSH_INTERVAL = 1.0
+    ERROR_PATTERN = re.compile(r"^(Uncaught )?\w*(Error|Exception)\b")
+
+    def __init__(self, rate=10):
+        """Constructor for the class.
+
+        args:
+          rate -- messages a second to log from each source; 0 is no limit
+        """
+        self.rate = rate
+        # {page url: {"messages": n, "errors": n, "sources": Counter}}
+        self.pages = {}
+        # the rate limit and repeat state of each source
+        self.sources = {}
+        self.lines = []
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.thread = None
+
+    def message(self, page_url, source, line, text):
+        """Count a console message, and queue it for the log."""
+        page = self.pages.get(page_url)
+        if page is None:
+            if len(self.pages) >= self.MAX_PAGES:
+                del self.pages[next(iter(self.pages))]
+            page = self.pages[page_url] = {
+                "messages": 0, "errors": 0, "sources": Counter()}
+        page["messages"] += 1
+        page["sources"][source] += 1
+        if self.ERROR_PATTERN.match(text):
+            page["errors"] += 1
+        if not DEBUG and not DEBUG_LOG:
+            return
+        now = time.time()
+        with self.lock:
+            state = self.sources.get(source)
+            if state is None:
+                if len(self.sources) >= self.MAX_SOURCES:
+                    self.flush_counts()
+                    self.sources.clear()
+                state = self.sources[source] = {
+                    "tokens": self.rate * 2, "time": now, "last": None,
+                    "repeats": 0, "dropped": 0
+                }
+            if (line, text) == state["last"]:
+                state["repeats"] += 1
+            else:
+                state["tokens"] = min(
+                    self.rate * 2,
+                    state["tokens"] + (now - state["time"]) * self.rate)
+                state["time"] = now
+                if self.rate and state["tokens"] < 1:
+                    state["dropped"] += 1
+                else:
+                    self.flush_counts(source)
+                    state["tokens"] -= 1
+                    state["last"] = (line, text)
+                    self.lines.append(
+                        'Javascript Error in "{}" line {}: {}'.format(
+                            source, line, text))
+        self.pending.set()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write)
+            self.thread.daemon = True
+            self.thread.start()
+            if QCoreApplication.instance() is not None:
+                QCoreApplication.instance().aboutToQuit.connect(self.flush)
+
+    def flush_counts(self, source=None):
+        """Queue the repeat and drop counts of a source, or every source.
+
+        Call with the lock held.
+        """
+        sources = [source] if source is not None else list(self.sources)
+        for name in sources:
+            state = self.sources[name]
+            if state["repeats"]:
+                self.lines.append(
+                    'Last message from "{}" repeated {} times'.format(
+                        name, state["repeats"]))
+                state["repeats"] = 0
+            if state["dropped"]:
+                self.lines.append(
+                    'Dropped {} messages from "{}"'.format(
+                        state["dropped"], name))
+                state["dropped"] = 0
+
+    def flush(self):
+        """Write the queued messages and counts to the log now."""
+        with self.lock:
+            self.flush_counts()
+            lines, self.lines = self.lines, []
+        if lines:
+            debug_lines(lines)
+
+    def _write(self):
+        while True:
+            self.pending.wait()
+            # Let a batch build up
+            time.sleep(self.FLUSH_INTERVAL)
+            self.pending.clear()
+            self.flush()
+
+    def summary(self):
+        """Return the message and error counts and top sources by page."""
+        return dict(
+            (url, {
+                "messages": page["messages"],
+                "errors": page["errors"],
+                "top_sources": page["sources"].most_common(3)
+            })
+            for url, page in self.pages.items()
+        )
+
+
+class PageCache(object):
+    """Pre-rendered error pages and the screensaver snapshot.
+
+    The error page templates are formatted against the config once,
+    rather than every time one is shown.  One PageCache is made per
+    config and shared by the windows that use it.
+    """
+
+    def __init__(self, config):
+        """Constructor for the class.
+
+        args:
+          config -- the browser config dict
+        """
+        self.config = config
+        self.pages = {}
+        self.certificate_errors = {}
+        # a QPixmap of the last rendered screensaver page
+        self.screensaver_snapshot = None
+        for key in ("page_unavailable_html", "network_down_html"):
+            self.page(key)
+
+    def page(self, key):
+        """Return the template in config[key], formatted against config."""
+        if key not in self.pages:
+            self.pages[key] = self.config.get(key).format(**self.config)
+        return self.pages[key]
+
+    def certificate_error(self, url):
+        """Return the certificate error page for url."""
+        if url not in self.certificate_errors:
+            if len(self.certificate_errors) > 50:
+                self.certificate_errors.clear()
+            self.certificate_errors[url] = CERTIFICATE_ERROR.format(
+                url=url, start_url=self.config.get("start_url")
+            )
+        return self.certificate_errors[url]
+
+
+class ZoomStore(object):
+    """The zoom levels patrons have chosen for each host, in aggregate.
+
+    For each host, only the number of sessions that ended at each zoom
+    level is kept, and a level is only suggested once MIN_SESSIONS
+    sessions have settled on it.  Nothing is recorded about individual
+    sessions.  Changes are written to disk in batches, at most every
+    FLUSH_INTERVAL seconds, and when the browser quits.
+    """
+
+    MIN_SESSIONS = 3
+    MAX_HOSTS = 500
+    # When a host has this many votes, they're all halved, so that
+    # recent sessions count for more than old ones.
+    MAX_VOTES = 100
+    FLUSH_INTERVAL = 300
+
+    def __init__(self, filename):
+        """Constructor for the class.
+
+        args:
+          filename -- the JSON file the store is kept in
+        """
+        self.filename = filename
+        # {host: {zoom level in tenths: number of sessions}}
+        self.levels = {}
+        self.dirty = False
+        self.last_flush = time.time()
+        try:
+            with open(filename) as store_file:
+                self.levels = json.load(store_file).get("levels", {})
+        except (IOError, OSError, ValueError, AttributeError) as e:
+            debug("Starting a new zoom store in {}: {}".format(filename, e))
+
+    def zoom(self, host):
+        """Return the learned zoom factor for host, or None."""
+        votes = self.levels.get(host)
+        if not votes:
+            return None
+        level, count = max(votes.items(), key=lambda x: x[1])
+        if count < self.MIN_SESSIONS:
+            return None
+        return int(level) / 10.0
+
+    def record(self, zooms, default_zoom):
+        """Count the zoom each host was left at at the end of a session.
+
+        Hosts that aren't in the store yet are only added once a patron
+        changes their zoom from default_zoom.
+        """
+        for host, factor in zooms.items():
+            if host not in self.levels:
+                if not host or abs(factor - default_zoom) < 0.05:
+                    continue
+                if len(self.levels) >= self.MAX_HOSTS:
+                    del self.levels[min(
+                        self.levels,
+                        key=lambda h: sum(self.levels[h].values())
+                    )]
+                self.levels[host] = {}
+            votes = self.levels[host]
+            level = str(int(round(factor * 10)))
+            votes[level] = votes.get(level, 0) + 1
+            if sum(votes.values()) > self.MAX_VOTES:
+                for key in list(votes):
+                    votes[key] //= 2
+                    if not votes[key]:
+                        del votes[key]
+            self.dirty = True
+        if self.dirty and time.time() - self.last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write the store to disk, if it's changed."""
+        if not self.dirty:
+            return
+        temp_name = self.filename + ".tmp"
+        try:
+            with open(temp_name, "w") as store_file:
+                json.dump({"levels": self.levels}, store_file)
+            os.rename(temp_name, self.filename)
+        except (IOError, OSError) as e:
+            debug("Can't write zoom store {}: {}".format(self.filename, e))
+        self.dirty = False
+        self.last_flush = time.time()
+
+
+class PrintQueue(QObject):
+    """Validated printer configuration and a background print spooler.
+
+    The print_settings are resolved to Qt values once, when the queue is
+    created at config load.  Silent print jobs are rendered to a PDF spool
+    file and handed to a worker thread, which sends them to the printer
+    with the spool command (by default, CUPS' "lp").  Rendering the PDF
+    still happens on the GUI thread, since QtWebKit can only paint a page
+    there; only the handoff to the printer is in the background.  If an
+    output_file is configured, jobs are just written there instead.  With no spool
+    command, or one that isn't installed, jobs are printed straight to
+    the QPrinter, as before there was a spooler.
+    """
+
+    def __init__(self, print_settings, parent=None):
+        """Constructor for the class.
+
+        args:
+          print_settings -- the "print_settings" dict from the config
+        """
+        super(PrintQueue, self).__init__(parent)
+        print_settings = print_settings or {}
+        self.silent = bool(print_settings.get("silent"))
+        self.output_file = print_settings.get("output_file")
+        self.printer_name = print_settings.get("printer_name")
+        self.mode = (
+            QPrinter.HighResolution if print_settings.get("mode") == "high"
+            else QPrinter.ScreenResolution
+        )
+
+        # Set the units
+        unit_name = print_settings.get("size_unit", 'Millimeter').title()
+        self.unit = getattr(QPrinter, unit_name, None)
+        if self.unit is None:
+            debug(
+                "Specified print size unit '{}' not found, using default."
+                .format(unit_name)
+            )
+            self.unit = QPrinter.Millimeter
+
+        # Margins; if None, we leave them at the printer's default
+        self.margins = print_settings.get("margins")
+        if self.margins is not None:
+            self.margins = [float(m) for m in self.margins]
+            if len(self.margins) != 4:
+                debug("Ignoring invalid print margins {}".format(
+                    self.margins))
+                self.margins = None
+
+        # Orientation
+        orientation = print_settings.get("orientation", 'Portrait').title()
+        self.orientation = getattr(QPrinter, orientation, None)
+        if self.orientation is None:
+            debug("Unknown print orientation '{}', using Portrait".format(
+                orientation))
+            self.orientation = QPrinter.Portrait
+
+        # The paper size; if None, we leave it at the printer's default
+        paper_size = print_settings.get("paper_size")
+        if type(paper_size) in (list, tuple):
+            # Assume it's a width/height spec
+            self.paper_size = QSizeF(*paper_size)
+        elif paper_size is not None:  # Assume it's a size name
+            self.paper_size = getattr(QPrinter, paper_size, None)
+            if self.paper_size is None:
+                debug("Unknown paper size '{}', using AnsiA".format(
+                    paper_size))
+                self.paper_size = QPrinter.AnsiA
+        else:
+            self.paper_size = None
+
+        resolution = print_settings.get("resolution")
+        self.resolution = resolution and int(resolution)
+
+        spool_command = print_settings.get("spool_command", "lp")
+        if spool_command and not isinstance(spool_command, list):
+            spool_command = shlex.split(spool_command)
+        if spool_command and not shutil.which(spool_command[0]):
+            debug("Spool command {} not found; printing directly".format(
+                spool_command[0]))
+            spool_command = None
+        if self.printer_name and spool_command and spool_command[0] == "lp":
+            spool_command += ["-d", self.printer_name]
+        self.spool_command = spool_command or None
+
+        self.jobs = []
+        self.job_count = 0
+        self.spool = queue.Queue()
+        self.worker = None
+
+    def make_printer(self, output_file=None):
+        """Return a QPrinter set up with the configured settings.
+
+        If output_file is given, the printer writes a PDF to it.
+        """
+        printer = QPrinter(mode=self.mode)
+        # FIXME: This isn't documented, because it doesn't seem to work...
+        if self.printer_name and not output_file:
+            debug("Setting printer to: {}".format(self.printer_name))
+            printer.setPrinterName(self.printer_name)
+        if output_file:
+            printer.setOutputFormat(QPrinter.PdfFormat)
+            printer.setOutputFileName(output_file)
+        if self.margins is not None:
+            printer.setPageMargins(*(self.margins + [self.unit]))
+        printer.setOrientation(self.orientation)
+        if isinstance(self.paper_size, QSizeF):
+            printer.setPaperSize(self.paper_size, self.unit)
+        elif self.paper_size is not None:
+            printer.setPaperSize(self.paper_size)
+        if self.resolution:
+            printer.setResolution(self.resolution)
+        return printer
+
+    def submit(self, view):
+        """Render view's page to a spool file and queue it for printing."""
+        self.job_count += 1
+        job = {"id": self.job_count, "url": view.url().toString(),
+               "state": "rendering", "render_ms": None, "spool_ms": None}
+        self.jobs = self.jobs[-19:] + [job]
+        if not self.output_file and self.spool_command is None:
+            start = time.time()
+            view.print_(self.make_printer())
+            job["render_ms"] = round((time.time() - start) * 1000, 1)
+            job["state"] = "done"
+            debug("Print job {} printed in {} ms".format(
+                job["id"], job["render_ms"]))
+            return job
+        if self.output_file:
+            filename = self.output_file.replace("{job}", str(job["id"]))
+        else:
+            fd, filename = tempfile.mkstemp(
+                prefix="wcgbrowser_print_", suffix=".pdf")
+            os.close(fd)
+        start = time.time()
+        view.print_(self.make_printer(filename))
+        job["render_ms"] = round((time.time() - start) * 1000, 1)
+        debug("Print job {} rendered to {} in {} ms".format(
+            job["id"], filename, job["render_ms"]))
+        if self.output_file:
+            job["state"] = "done"
+            return job
+        job["state"] = "queued"
+        self.spool.put((job, filename))
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._spool_jobs)
+            self.worker.daemon = True
+            self.worker.start()
+        return job
+
+    def _spool_jobs(self):
+        """Worker thread: send queued spool files to the printer.
+
+        It runs for as long as the browser does, so no job can be put
+        on the queue just as the worker gives up waiting.
+        """
+        while True:
+            job, filename = self.spool.get()
+            job["state"] = "printing"
+            start = time.time()
+            try:
+                subprocess.check_call(self.spool_command + [filename])
+                job["state"] = "done"
+            except (OSError, subprocess.CalledProcessError) as e:
+                job["state"] = "failed"
+                debug("Print job {} failed: {}".format(job["id"], e))
+            job["spool_ms"] = round((time.time() - start) * 1000, 1)
+            debug("Print job {} {} after {} ms in the spooler".format(
+                job["id"], job["state"], job["spool_ms"]))
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def status(self):
+        """Return the state of the queue and its recent jobs."""
+        return {
+            "queued": self.spool.qsize(),
+            "submitted": self.job_count,
+            "jobs": [dict(job) for job in self.jobs]
+        }
+
+
+class HandlerLauncher(object):
+    """Starts, reaps and closes external content handlers.
+
+    All the work is done by a worker thread, so the GUI never waits on a
+    fork or a dying process.  At most max_handlers handlers are kept
+    running; when another is needed, the oldest is closed to make room.
+    Handlers configured with "reuse" hand their files to a copy of
+    themselves that's already running, so only the first copy counts.
+    kill_all() closes every handler (and anything it started) and deletes
+    the files they were given, so the next patron starts clean.
+    """
+
+    def __init__(self, max_handlers=4):
+        """Constructor for the class.
+
+        args:
+          max_handlers -- the most handlers to run at once; 0 for no limit
+        """
+        self.max_handlers = max_handlers
+        self.requests = queue.Queue()
+        self.handlers = []
+        self.files = []
+        self.launched = 0
+        self.worker = None
+
+    @staticmethod
+    def handler_command(handler):
+        """Return the command and reuse flag for a content handler.
+
+        A handler is either a program name, or a dict with a "command"
+        (a string or list of arguments) and an optional "reuse" flag.
+        Raises ValueError if the handler has no command.
+        """
+        if isinstance(handler, dict):
+            command = handler.get("command")
+            if isinstance(command, str):
+                command = shlex.split(command)
+            if not isinstance(command, list) or not command:
+                raise ValueError(
+                    "content handler {} has no command".format(handler))
+            return [str(arg) for arg in command], bool(handler.get("reuse"))
+        if not isinstance(handler, str) or not handler:
+            raise ValueError("invalid content handler {}".format(handler))
+        return [handler], False
+
+    def launch(self, handler, filename):
+        """Open filename with the content handler."""
+        self._request(("launch", handler, filename))
+
+    def kill_all(self):
+        """Close all the handlers and delete their files."""
+        self._request(("kill_all",))
+
+    def _request(self, request):
+        self.requests.put(request)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _run(self):
+        """Worker thread: carry out requests and reap finished handlers."""
+        while True:
+            try:
+                # Poll for exited children while any are running
+                request = self.requests.get(
+                    timeout=1 if self.running() else None)
+            except queue.Empty:
+                request = None
+            if request is None:
+                continue
+            if request[0] == "launch":
+                self._launch(*request[1:])
+            else:
+                self._kill_all()
+
+    def running(self, command=None):
+        """Return the running handlers, optionally just for command.
+
+        Checking on a handler also reaps it, if it has exited.
+        """
+        return [
+            handler for handler in self.handlers
+            if handler["process"].poll() is None
+            and command in (None, handler["command"])
+        ]
+
+    def _launch(self, handler, filename):
+        self.files.append(filename)
+        try:
+            command, reuse = self.handler_command(handler)
+        except ValueError as e:
+            debug("Can't open {}: {}".format(filename, e))
+            return
+        reusing = reuse and self.running(command)
+        if not reusing:
+            counted = [h for h in self.running() if h["counted"]]
+            while self.max_handlers and len(counted) >= self.max_handlers:
+                debug("Too many handlers open; closing {}".format(
+                    counted[0]["command"]))
+                self._close([counted.pop(0)])
+        try:
+            process = subprocess.Popen(
+                command + [filename],
+                close_fds=True,
+                # a session of its own, so we can kill anything it starts
+                start_new_session=True
+            )
+        except OSError as e:
+            debug("Couldn't start content handler {}: {}".format(command, e))
+            return
+        self.launched += 1
+        self.handlers.append({
+            "command": command, "process": process, "counted": not reusing
+        })
+        debug("Opened {} with {} (pid {})".format(
+            filename, command, process.pid))
+
+    @staticmethod
+    def _signal(handler, signum):
+        """Send signum to the handler and everything it started.
+
+        Handlers that have been reaped are skipped, since their pid may
+        belong to another process by now.
+        """
+        if handler["process"].poll() is not None:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(handler["process"].pid, signum)
+            else:
+                handler["process"].terminate()
+        except OSError:
+            pass
+
+    def _close(self, handlers, wait=2):
+        """Terminate handlers, killing any still running after wait secs."""
+        for handler in handlers:
+            self._signal(handler, signal.SIGTERM)
+        deadline = time.time() + wait
+        while time.time() < deadline and any(
+                h["process"].poll() is None for h in handlers):
+            time.sleep(0.1)
+        for handler in handlers:
+            if handler["process"].poll() is None:
+                self._signal(
+                    handler, getattr(signal, "SIGKILL", signal.SIGTERM))
+                handler["process"].wait()
+            self.handlers.remove(handler)
+
+    def _kill_all(self):
+        # Exited handlers are only dropped from the list
+        if self.handlers:
+            debug("Closing {} content handlers".format(len(self.running())))
+            self._close(list(self.handlers))
+        for filename in self.files:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.files = []
+
+    def status(self):
+        """Return the number of handlers running and launched."""
+        return {
+            "running": len(self.running()),
+            "launched": self.launched,
+            "max_handlers": self.max_handlers
+        }
+
+
+class OfflineStore(QObject):
+    """Serves the start page from disk while the network is down.
+
+    Each network access manager gets a disk cache, which only saves the
+    requests made while loading the start page.  When the start page can't
+    be loaded, the browser goes "offline" and loads it from that cache.
+    Meanwhile the start URL is probed with exponential backoff; once it
+    answers, the online signal is emitted so the live page can be swapped
+    back in.  A probe that gets no answer within PROBE_TIMEOUT seconds, or
+    whose network access manager is destroyed, counts as a failed one.
+    """
+    online = pyqtSignal()
+    PROBE_TIMEOUT = 30
+    # Set on the requests we make ourselves, so that
+    # WcgNetworkAccessManager leaves their cache settings alone
+    PROBE_ATTRIBUTE = QNetworkRequest.Attribute(QNetworkRequest.User + 1)
+
+    def __init__(self, config, parent=None):
+        """Constructor for the class.
+
+        args:
+          config -- the browser config dict
+        """
+        super(OfflineStore, self).__init__(parent)
+        self.directory = config.get("offline_cache_dir")
+        self.start_url = QUrl(config.get("start_url"))
+        self.initial_delay = max(config.get("offline_retry") or 5, 1)
+        self.max_delay = max(
+            config.get("offline_retry_max") or 300, self.initial_delay)
+        self.offline = False
+        self.nam = None
+        self.delay = self.initial_delay
+        self.outage_start = None
+        self.retry_attempts = 0
+        self.outages = []
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.probe)
+        self.probe_reply = None
+        self.probe_timer = QTimer(self)
+        self.probe_timer.setSingleShot(True)
+        self.probe_timer.timeout.connect(self.probe_timed_out)
+
+    def attach(self, nam):
+        """Give a network access manager a cache in our directory."""
+        cache = QNetworkDiskCache(nam)
+        cache.setCacheDirectory(self.directory)
+        nam.setCache(cache)
+        nam.offline_store = self
+        self.nam = nam
+
+    def has_start_page(self):
+        """Return True if we have a saved copy of the start page."""
+        return bool(
+            self.nam and self.nam.cache()
+            and self.nam.cache().metaData(self.start_url).isValid()
+        )
+
+    def go_offline(self):
+        """Start serving from the cache and probing the network."""
+        if self.offline:
+            return
+        self.offline = True
+        self.outage_start = time.time()
+        self.delay = self.initial_delay
+        debug("Network down; serving the start page from {}".format(
+            self.directory))
+        self.timer.start(self.delay * 1000)
+
+    def probe(self):
+        """Check whether the start URL is reachable again."""
+        self.retry_attempts += 1
+        if self.nam is None:
+            self.retry()
+            return
+        request = QNetworkRequest(self.start_url)
+        request.setAttribute(self.PROBE_ATTRIBUTE, True)
+        request.setAttribute(
+            QNetworkRequest.CacheLoadControlAttribute,
+            QNetworkRequest.AlwaysNetwork
+        )
+        request.setAttribute(
+            QNetworkRequest.CacheSaveControlAttribute, False)
+        reply = self.nam.head(request)
+        self.probe_reply = reply
+        reply.finished.connect(partial(self.probe_finished, reply))
+        reply.destroyed.connect(self.probe_lost)
+        self.probe_timer.start(self.PROBE_TIMEOUT * 1000)
+
+    def probe_timed_out(self):
+        """Give up on a probe that hasn't been answered."""
+        if self.probe_reply is not None:
+            debug("Start URL probe timed out")
+            # Emits finished, so probe_finished() schedules the next one
+            self.probe_reply.abort()
+
+    def probe_lost(self):
+        """Schedule another probe when ours went with its access manager."""
+        if self.probe_reply is None:
+            return
+        self.probe_timer.stop()
+        self.probe_reply = None
+        self.retry()
+
+    def probe_finished(self, reply):
+        """Go back online if the probe worked, or schedule another."""
+        self.probe_timer.stop()
+        self.probe_reply = None
+        reply.destroyed.disconnect(self.probe_lost)
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        reply.deleteLater()
+        if reply.error() == QNetworkReply.NoError or (
+                status is not None and status < 500):
+            duration = time.time() - self.outage_start
+            self.outages.append(round(duration, 1))
+            debug("Network is back after {:.1f} seconds".format(duration))
+            self.offline = False
+            self.outage_start = None
+            self.online.emit()
+        else:
+            self.retry()
+
+    def retry(self):
+        """Probe again after a longer delay."""
+        self.delay = min(self.delay * 2, self.max_delay)
+        debug("Start URL still unreachable; retrying in {} seconds"
+              .format(self.delay))
+        self.timer.start(self.delay * 1000)
+
+    def stats(self):
+        """Return the outage and retry statistics."""
+        return {
+            "offline": self.offline,
+            "current_outage": (
+                self.outage_start and round(time.time() - self.outage_start, 1)
+            ),
+            "retry_attempts": self.retry_attempts,
+            "outages": self.outages[-20:]
+        }
+
+
+def emit_reply_error(reply, code, message):
+    """Set an error on reply and emit its error signal(s)."""
+    reply.setError(code, message)
+    # Qt 5.15 renamed the error signal to errorOccurred
+    if hasattr(reply, "errorOccurred"):
+        reply.errorOccurred.emit(code)
+    reply.error.emit(code)
+
+
+class ForwardingReply(QNetworkReply):
+    """A reply that passes another reply through, so it can be watched.
+
+    The inner reply's metadata, data and signals are copied to this one
+    as they arrive.  Each function in taps is called with this reply and
+    every chunk of data received.
+    """
+    COPIED_ATTRIBUTES = (
+        QNetworkRequest.HttpStatusCodeAttribute,
+        QNetworkRequest.HttpReasonPhraseAttribute,
+        QNetworkRequest.RedirectionTargetAttribute,
+        QNetworkRequest.ConnectionEncryptedAttribute,
+        QNetworkRequest.SourceIsFromCacheAttribute
+    )
+
+    def __init__(self, reply=None, parent=None):
+        """Constructor for the class.
+
+        args:
+          reply -- the QNetworkReply to pass through, or None to attach()
+                   one later
+        """
+        super(ForwardingReply, self).__init__(parent)
+        self.reply = None
+        self.buffer = bytearray()
+        self.taps = []
+        self.open(self.ReadOnly | self.Unbuffered)
+        if reply is not None:
+            self.attach(reply)
+
+    def attach(self, reply):
+        """Start passing reply through."""
+        self.reply = reply
+        reply.setParent(self)
+        self.setRequest(reply.request())
+        self.setUrl(reply.url())
+        self.setOperation(reply.operation())
+        reply.metaDataChanged.connect(self._metadata_changed)
+        reply.readyRead.connect(self._ready_read)
+        reply.finished.connect(self._finished)
+        reply.sslErrors.connect(self.sslErrors)
+        reply.downloadProgress.connect(self.downloadProgress)
+        reply.uploadProgress.connect(self.uploadProgress)
+
+    def copy_metadata(self):
+        """Copy the inner reply's status and headers to this one."""
+        for attribute in self.COPIED_ATTRIBUTES:
+            value = self.reply.attribute(attribute)
+            if value is not None:
+                self.setAttribute(attribute, value)
+        for name, value in self.reply.rawHeaderPairs():
+            self.setRawHeader(name, value)
+
+    def _metadata_changed(self):
+        self.copy_metadata()
+        self.metaDataChanged.emit()
+
+    def _ready_read(self):
+        data = bytes(self.reply.readAll())
+        if not data:
+            return
+        for tap in self.taps:
+            tap(self, data)
+        self.buffer.extend(data)
+        self.readyRead.emit()
+
+    def _finished(self):
+        if self.isFinished():
+            return
+        self._metadata_changed()
+        self._ready_read()
+        if self.reply.error() != QNetworkReply.NoError:
+            emit_reply_error(
+                self, self.reply.error(), self.reply.errorString())
+        self.setFinished(True)
+        self.finished.emit()
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return (
+            len(self.buffer)
+            + super(ForwardingReply, self).bytesAvailable()
+        )
+
+    def readData(self, maxlen):
+        data = bytes(self.buffer[:maxlen])
+        del self.buffer[:maxlen]
+        return data
+
+    def abort(self):
+        self.reply.abort()
+
+    def ignoreSslErrors(self, *args):
+        self.reply.ignoreSslErrors(*args)
+
+
+class PeerCacheReply(ForwardingReply):
+    """A reply for an asset asked of the branch's peer cache.
+
+    Nothing is passed on until the peer cache has answered in full.  If
+    it can't be reached, takes too long, or answers with anything but
+    200 or 304, the request is sent directly instead, and that reply is
+    passed through.
+    """
+
+    def __init__(self, peer_cache, request, send, parent=None):
+        """Constructor for the class.
+
+        args:
+          peer_cache -- the PeerCacheClient to ask
+          request -- the QNetworkRequest for the asset
+          send -- a function that sends request directly and returns
+                  its QNetworkReply
+        """
+        super(PeerCacheReply, self).__init__(parent=parent)
+        self.peer_cache = peer_cache
+        self.send = send
+        self.canceled = False
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(QNetworkAccessManager.GetOperation)
+        self.peer = peer_cache.get(request)
+        self.peer.finished.connect(self._peer_finished)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.peer.abort)
+        self.timer.start(peer_cache.timeout)
+
+    def _peer_finished(self):
+        self.timer.stop()
+        peer, self.peer = self.peer, None
+        peer.deleteLater()
+        if self.canceled:
+            emit_reply_error(
+                self, QNetworkReply.OperationCanceledError,
+                "Operation canceled")
+            self.setFinished(True)
+            self.finished.emit()
+            return
+        status = peer.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if peer.error() != QNetworkReply.NoError or status not in (200, 304):
+            self.peer_cache.failed(peer, status)
+            self.attach(self.send())
+            return
+        body = bytes(peer.readAll())
+        self.peer_cache.served(peer, len(body))
+        self.setAttribute(QNetworkRequest.HttpStatusCodeAttribute, status)
+        self.setAttribute(
+            QNetworkRequest.HttpReasonPhraseAttribute,
+            peer.attribute(QNetworkRequest.HttpReasonPhraseAttribute))
+        for name, value in peer.rawHeaderPairs():
+            if bytes(name).lower() != b"x-peer-cache":
+                self.setRawHeader(name, value)
+        self.buffer.extend(body)
+        self.metaDataChanged.emit()
+        if body:
+            self.readyRead.emit()
+            self.downloadProgress.emit(len(body), len(body))
+        self.setFinished(True)
+        self.finished.emit()
+
+    def abort(self):
+        if self.reply is not None:
+            self.reply.abort()
+        elif self.peer is not None:
+            self.canceled = True
+            self.peer.abort()
+
+
+class PeerCacheClient(object):
+    """Asks the branch's peer cache (peer_cache.py) for static assets.
+
+    Only GETs of static file types from trusted hosts (the start_url,
+    bookmark and whitelisted hosts) go to the peer cache, and not for
+    hosts with credentials.  HTTPS assets only go to a peer cache that's
+    reached over HTTPS itself, so a device on the LAN can't answer for
+    an HTTPS site.  If the peer cache can't be reached, it's left alone
+    for RETRY seconds.
+    """
+
+    RETRY = 30
+
+    def __init__(self, settings):
+        """Constructor for the class.
+
+        args:
+          settings -- the "peer_cache" config dict
+        """
+        self.url = settings["url"].rstrip("/") + "/"
+        self.secure = QUrl(self.url).scheme() == "https"
+        self.timeout = int((settings.get("timeout") or 5) * 1000)
+        self.hosts = set()
+        self.whitelist = set()
+        self.private_hosts = set()
+        self.down_until = 0
+        self.counts = Counter()
+        # The peer cache is on the LAN, so it's asked without proxies
+        self.nam = QNetworkAccessManager()
+        self.nam.setProxy(QNetworkProxy(QNetworkProxy.NoProxy))
+
+    def handles(self, request):
+        """Return True if request should be asked of the peer cache."""
+        url = request.url()
+        host = url.host()
+        return (
+            time.time() >= self.down_until
+            and (url.scheme() == "http" or self.secure)
+            and static_asset(str(url.toString()))
+            and host not in self.private_hosts
+            and not request.hasRawHeader(b"Authorization")
+            and (host in self.hosts or bool(
+                self.whitelist
+                and whitelist_pattern(self.whitelist).match(host)))
+        )
+
+    def get(self, request):
+        """Ask the peer cache for request's asset."""
+        peer_request = QNetworkRequest(QUrl(
+            self.url + "?url=" + bytes(QUrl.toPercentEncoding(
+                request.url().toString(QUrl.RemoveFragment)
+            )).decode("ascii")
+        ))
+        for name in (b"Accept", b"Accept-Language", b"If-Modified-Since",
+                     b"If-None-Match", b"User-Agent"):
+            if request.hasRawHeader(name):
+                peer_request.setRawHeader(name, request.rawHeader(name))
+        return self.nam.get(peer_request)
+
+    def served(self, reply, size):
+        """Count an asset the peer cache served."""
+        state = bytes(reply.rawHeader(b"X-Peer-Cache")).decode("latin-1")
+        self.counts[state or "hit"] += 1
+        self.counts["bytes"] += size
+
+    def failed(self, reply, status):
+        """Count a failed request, and stop asking if it's unreachable."""
+        self.counts["fallbacks"] += 1
+        debug("Peer cache failed for {} ({}); fetching it directly".format(
+            reply.url().toString(), status or reply.errorString()))
+        if status is None:
+            self.down_until = time.time() + self.RETRY
+
+    def status(self):
+        """Return the peer cache's counts, and whether it's reachable."""
+        status = dict(self.counts)
+        status["reachable"] = time.time() >= self.down_until
+        return status
+
+
+class QueuedReply(ForwardingReply):
+    """A reply for a request that's waiting its turn to be sent.
+
+    Once the RequestScheduler sends the request, the real reply is
+    attached and passed through.  Until then, aborting the reply just
+    finishes it with an error.
+    """
+
+    def __init__(self, request, operation, parent=None):
+        """Constructor for the class.
+
+        args:
+          request -- the QNetworkRequest waiting to be sent
+          operation -- its QNetworkAccessManager operation
+        """
+        super(QueuedReply, self).__init__(parent=parent)
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+
+    def abort(self):
+        if self.reply is not None:
+            self.reply.abort()
+        elif not self.isFinished():
+            emit_reply_error(
+                self, QNetworkReply.OperationCanceledError,
+                "Operation canceled")
+            self.setFinished(True)
+            self.finished.emit()
+
+
+class RequestScheduler(object):
+    """Sends requests in priority order within limits on requests in flight.
+
+    Requests are sorted into classes: documents (pages and frames),
+    blocking (stylesheets and scripts), images, and other.  Documents
+    and uploads are always sent right away.  The rest are held back
+    while max_requests are in flight, or max_per_host to their host,
+    and sent in class order as requests finish.  Every request sent is
+    also given a Qt priority for its class, which Qt uses to order its
+    own per-connection queue.
+
+    The scheduler outlives the network access managers it sends for,
+    which are replaced at every reset.  When one is destroyed, the
+    requests still queued for it are dropped rather than sent.
+    """
+
+    CLASSES = ("document", "blocking", "image", "other")
+    PRIORITIES = {
+        "document": QNetworkRequest.HighPriority,
+        "blocking": QNetworkRequest.HighPriority,
+        "image": QNetworkRequest.NormalPriority,
+        "other": QNetworkRequest.LowPriority
+    }
+    EXTENSIONS = {
+        "css": "blocking", "js": "blocking",
+        "png": "image", "jpg": "image", "jpeg": "image", "gif": "image",
+        "webp": "image", "svg": "image", "ico": "image", "bmp": "image"
+    }
+
+    def __init__(self, max_requests, max_per_host=6):
+        """Constructor for the class.
+
+        args:
+          max_requests -- the most requests to have in flight at once
+          max_per_host -- the most requests to have in flight to one host
+        """
+        self.max_requests = max_requests
+        self.max_per_host = max_per_host
+        self.in_flight = 0
+        self.hosts = Counter()
+        self.queues = dict((name, deque()) for name in self.CLASSES)
+        # ids of the network access managers whose destroyed signal is
+        # connected to forget()
+        self.owners = set()
+        # requests sent, total and longest queue wait (ms) by class
+        self.waits = dict((name, [0, 0.0, 0.0]) for name in self.CLASSES)
+
+    @classmethod
+    def classify(cls, request):
+        """Return the class of a QNetworkRequest."""
+        accept = bytes(request.rawHeader(b"Accept")).decode("latin-1")
+        if accept.startswith(("text/html", "application/xhtml")):
+            return "document"
+        frame = request.originatingObject()
+        if (
+                hasattr(frame, "requestedUrl")
+                and frame.requestedUrl() == request.url()
+        ):
+            return "document"
+        if accept.startswith("text/css"):
+            return "blocking"
+        if accept.startswith("image/"):
+            return "image"
+        extension = request.url().path().rpartition(".")[2].lower()
+        return cls.EXTENSIONS.get(extension, "other")
+
+    def has_room(self, host):
+        return (
+            (not self.max_requests or self.in_flight < self.max_requests)
+            and (not self.max_per_host
+                 or self.hosts[host] < self.max_per_host)
+        )
+
+    def request(self, op, request, iodata, send, parent=None):
+        """Return a reply for request, which is sent when its turn comes.
+
+        args:
+          op, request, iodata -- as passed to createRequest()
+          send -- a function taking op, request and iodata that sends
+                  the request and returns its QNetworkReply
+        """
+        category = self.classify(request)
+        request = QNetworkRequest(request)
+        request.setPriority(self.PRIORITIES[category])
+        reply = QueuedReply(request, op, parent)
+        entry = (reply, op, request, iodata, send, category, time.time(),
+                 id(parent))
+        if parent is not None and id(parent) not in self.owners:
+            self.owners.add(id(parent))
+            parent.destroyed.connect(partial(self.forget, id(parent)))
+        if (
+                category == "document" or iodata is not None
+                or self.has_room(request.url().host())
+        ):
+            self.send(entry)
+        else:
+            self.queues[category].append(entry)
+            reply.finished.connect(partial(self.cancel, entry))
+            reply.destroyed.connect(partial(self.cancel, entry))
+        return reply
+
+    def send(self, entry):
+        reply, op, request, iodata, send, category, queued, owner = entry
+        host = request.url().host()
+        self.in_flight += 1
+        self.hosts[host] += 1
+        wait = (time.time() - queued) * 1000
+        stats = self.waits[category]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+        sent = send(op, request, iodata)
+        # A reply can be destroyed without finishing (when its network
+        # access manager goes at a reset); either way frees its slot once,
+        # but only a finished one sends the next requests right away
+        released = []
+        sent.finished.connect(partial(self.release, host, released))
+        sent.destroyed.connect(partial(self.discard, host, released))
+        reply.attach(sent)
+
+    def forget(self, owner, *args):
+        """Drop the queued requests of a destroyed network access manager."""
+        self.owners.discard(owner)
+        for queue in self.queues.values():
+            for entry in [e for e in queue if e[7] == owner]:
+                queue.remove(entry)
+
+    def cancel(self, entry, *args):
+        """Drop a request that was aborted before it was sent."""
+        try:
+            self.queues[entry[5]].remove(entry)
+        except ValueError:
+            pass
+
+    def release(self, host, released, *args):
+        """Send the next requests in line, now that one has finished.
+
+        released is a list shared by a request's signals, so its slot
+        is only freed once.
+        """
+        if released:
+            return
+        self.free(host, released)
+        self.dispatch()
+
+    def discard(self, host, released, *args):
+        """Free a destroyed request's slot.
+
+        Its network access manager may be going too, so the next
+        requests are sent once control is back in the event loop, after
+        forget() has dropped that manager's queued ones.
+        """
+        if released:
+            return
+        self.free(host, released)
+        QTimer.singleShot(0, self.dispatch)
+
+    def free(self, host, released):
+        released.append(True)
+        self.in_flight -= 1
+        self.hosts[host] -= 1
+        if not self.hosts[host]:
+            del self.hosts[host]
+
+    def dispatch(self):
+        """Send queued requests in class order while there's room."""
+        for category in self.CLASSES:
+            queue = self.queues[category]
+            for entry in list(queue):
+                if not self.has_room(entry[2].url().host()):
+                    if self.max_requests and (
+                            self.in_flight >= self.max_requests):
+                        return
+                    continue
+                queue.remove(entry)
+                self.send(entry)
+
+    def status(self):
+        """Return the requests in flight and waiting, and the queue waits."""
+        return {
+            "in_flight": self.in_flight,
+            "queued": dict(
+                (name, len(queue)) for name, queue in self.queues.items()),
+            "wait_ms": dict(
+                (name, {
+                    "requests": count,
+                    "mean": round(total / count, 1) if count else 0,
+                    "max": round(longest, 1)
+                })
+                for name, (count, total, longest) in self.waits.items()
+            )
+        }
+
+
+class DownscalingReply(ForwardingReply):
+    """A reply that shrinks large images before WebKit gets them.
+
+    JPEG and PNG images are held back until they've downloaded, and if
+    they're wider or taller than max_size pixels, scaled down to fit.
+    Everything else passes straight through.
+    """
+    FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG"}
+
+    def __init__(self, reply, max_size, parent=None):
+        """Constructor for the class.
+
+        args:
+          reply -- the QNetworkReply to pass through
+          max_size -- the largest width or height, in pixels, to allow
+        """
+        self.max_size = max_size
+        self.image_format = None
+        self.held = bytearray()
+        super(DownscalingReply, self).__init__(reply, parent)
+
+    def copy_metadata(self):
+        super(DownscalingReply, self).copy_metadata()
+        mime_type = self.header(QNetworkRequest.ContentTypeHeader) or ""
+        self.image_format = self.FORMATS.get(
+            mime_type.split(";")[0].strip().lower())
+        if self.image_format:
+            # We don't know the length until we've scaled the image
+            self.setHeader(QNetworkRequest.ContentLengthHeader, None)
+
+    def _ready_read(self):
+        if not self.image_format:
+            return super(DownscalingReply, self)._ready_read()
+        data = bytes(self.reply.readAll())
+        for tap in self.taps:
+            tap(self, data)
+        self.held.extend(data)
+
+    def _finished(self):
+        if not self.isFinished():
+            self.copy_metadata()
+            self._ready_read()
+            if self.held:
+                self.buffer.extend(self.downscale(bytes(self.held)))
+                self.held = bytearray()
+                self.readyRead.emit()
+        super(DownscalingReply, self)._finished()
+
+    def downscale(self, data):
+        """Return the image data scaled to fit max_size, if it's bigger."""
+        image = QImage.fromData(data)
+        if image.isNull() or (
+                image.width() <= self.max_size
+                and image.height() <= self.max_size
+        ):
+            return data
+        scaled = image.scaled(
+            self.max_size, self.max_size,
+            Qt.KeepAspectRatio, Qt.SmoothTransformation
+        )
+        output = QBuffer()
+        output.open(QBuffer.WriteOnly)
+        scaled.save(
+            output, self.image_format,
+            85 if self.image_format == "JPEG" else -1
+        )
+        debug("Scaled {} from {}x{} to {}x{}".format(
+            self.url().toString(), image.width(), image.height(),
+            scaled.width(), scaled.height()))
+        return bytes(output.data())
+
+
+class BufferReply(QNetworkReply):
+    """A reply that serves a response we already have in memory.
+
+    The response is delivered from the event loop after delay
+    milliseconds, just as a network reply would be.
+    """
+
+    def __init__(self, request, operation, status=200, reason="OK",
+                 headers=(), body=b"", error=None, error_string="",
+                 delay=0, parent=None):
+        """Constructor for the class.
+
+        args:
+          request -- the QNetworkRequest being answered
+          operation -- the QNetworkAccessManager operation
+          status -- the HTTP status code, or None
+          headers -- a list of (name, value) header pairs
+          body -- the response body, as bytes or another buffer
+          error -- a QNetworkReply.NetworkError to report, if any
+          delay -- milliseconds to wait before delivering the response
+        """
+        super(BufferReply, self).__init__(parent)
+        # body can be any buffer; it's only copied as it's read
+        self.body = memoryview(body)
+        self.offset = 0
+        self.error_code = error
+        self.error_string = error_string
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.open(self.ReadOnly | self.Unbuffered)
+        if status is not None:
+            self.setAttribute(QNetworkRequest.HttpStatusCodeAttribute, status)
+            self.setAttribute(
+                QNetworkRequest.HttpReasonPhraseAttribute, reason)
+        for name, value in headers:
+            self.setRawHeader(name.encode("latin-1"), value.encode("latin-1"))
+            if name.lower() == "location" and 300 <= (status or 0) < 400:
+                self.setAttribute(
+                    QNetworkRequest.RedirectionTargetAttribute, QUrl(value))
+        self.setHeader(QNetworkRequest.ContentLengthHeader, len(self.body))
+        QTimer.singleShot(delay, self._deliver)
+
+    def _deliver(self):
+        if self.isFinished():
+            return
+        self.metaDataChanged.emit()
+        if self.body:
+            self.readyRead.emit()
+            self.downloadProgress.emit(len(self.body), len(self.body))
+        if self.error_code is not None:
+            emit_reply_error(self, self.error_code, self.error_string)
+        self.setFinished(True)
+        self.finished.emit()
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return (
+            len(self.body) - self.offset
+            + super(BufferReply, self).bytesAvailable()
+        )
+
+    def readData(self, maxlen):
+        data = self.body[self.offset:self.offset + maxlen].tobytes()
+        self.offset += len(data)
+        return data
+
+    def abort(self):
+        if self.isFinished():
+            return
+        self.offset = len(self.body)
+        emit_reply_error(
+            self, QNetworkReply.OperationCanceledError, "Operation canceled")
+        self.setFinished(True)
+        self.finished.emit()
+
+
+def operation_name(op, request):
+    """Return the HTTP method name for a network access operation."""
+    if op == QNetworkAccessManager.CustomOperation:
+        verb = request.attribute(QNetworkRequest.CustomVerbAttribute)
+        return bytes(verb).decode("latin-1") if verb else "GET"
+    return {
+        QNetworkAccessManager.HeadOperation: "HEAD",
+        QNetworkAccessManager.GetOperation: "GET",
+        QNetworkAccessManager.PutOperation: "PUT",
+        QNetworkAccessManager.PostOperation: "POST",
+        QNetworkAccessManager.DeleteOperation: "DELETE"
+    }.get(op, "GET")
+
+
+def header_list(pairs):
+    """Convert Qt header pairs to a HAR header list."""
+    return [
+        {"name": bytes(name).decode("latin-1"),
+         "value": bytes(value).decode("latin-1")}
+        for name, value in pairs
+    ]
+
+
+class SessionRecorder(object):
+    """Records HTTP requests and responses to a HAR-like archive.
+
+    Each completed request is appended to the archive as one line of JSON,
+    in the format of a HAR 1.2 "entry", and flushed to disk straight away,
+    so a long session doesn't build up in memory.  Response bodies are
+    base64 encoded and cut off after body_limit bytes.
+    """
+
+    def __init__(self, filename, body_limit=512 * 1024):
+        """Constructor for the class.
+
+        args:
+          filename -- the file to append the archive to
+          body_limit -- the largest response body, in bytes, to save
+        """
+        self.filename = filename
+        self.body_limit = body_limit
+        self.archive = open(filename, "a")
+        self.entries = 0
+        debug("Recording session to {}".format(filename))
+
+    def record(self, op, request, reply, parent=None):
+        """Return a reply that records reply when it finishes."""
+        forward = ForwardingReply(reply, parent)
+        exchange = {
+            "method": operation_name(op, request),
+            "started": datetime.datetime.utcnow(),
+            "start": time.time(),
+            "wait": None,
+            "body": bytearray(),
+            "size": 0,
+            "request_headers": header_list(
+                (name, request.rawHeader(name))
+                for name in request.rawHeaderList()
+            )
+        }
+        forward.taps.append(partial(self._received, exchange))
+        forward.metaDataChanged.connect(
+            partial(self._first_byte, exchange))
+        forward.finished.connect(partial(self._write, forward, exchange))
+        return forward
+
+    def _received(self, exchange, reply, data):
+        exchange["size"] += len(data)
+        room = self.body_limit - len(exchange["body"])
+        if room > 0:
+            exchange["body"].extend(data[:room])
+
+    def _first_byte(self, exchange):
+        if exchange["wait"] is None:
+            exchange["wait"] = (time.time() - exchange["start"]) * 1000
+
+    def _write(self, reply, exchange):
+        total = (time.time() - exchange["start"]) * 1000
+        wait = exchange["wait"] if exchange["wait"] is not None else total
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        reason = reply.attribute(QNetworkRequest.HttpReasonPhraseAttribute)
+        mime_type = reply.header(QNetworkRequest.ContentTypeHeader)
+        entry = {
+            "startedDateTime": exchange["started"].isoformat() + "Z",
+            "time": round(total, 1),
+            "request": {
+                "method": exchange["method"],
+                "url": reply.url().toString(),
+                "httpVersion": "HTTP/1.1",
+                "headers": exchange["request_headers"],
+                "headersSize": -1,
+                "bodySize": -1
+            },
+            "response": {
+                "status": status or 0,
+                "statusText": reason or "",
+                "httpVersion": "HTTP/1.1",
+                "headers": header_list(reply.rawHeaderPairs()),
+                "content": {
+                    "size": exchange["size"],
+                    "mimeType": mime_type or "",
+                    "text": base64.b64encode(
+                        bytes(exchange["body"])).decode("ascii"),
+                    "encoding": "base64",
+                    "_truncated": exchange["size"] > len(exchange["body"])
+                },
+                "redirectURL": "",
+                "headersSize": -1,
+                "bodySize": exchange["size"]
+            },
+            "cache": {},
+            "timings": {
+                "send": 0,
+                "wait": round(wait, 1),
+                "receive": round(total - wait, 1)
+            }
+        }
+        if reply.error() != QNetworkReply.NoError:
+            entry["response"]["_error"] = int(reply.error())
+            entry["response"]["_errorString"] = reply.errorString()
+        self.archive.write(json.dumps(entry) + "\n")
+        self.archive.flush()
+        self.entries += 1
+        exchange["body"] = None
+
+    def close(self):
+        """Close the archive file."""
+        self.archive.close()
+        debug("Recorded {} requests to {}".format(
+            self.entries, self.filename))
+
+
+class ReplayArchive(object):
+    """Serves responses from an archive made by the SessionRecorder.
+
+    Only the offset of each entry is kept in memory; entries are read back
+    from the file as they're requested.  Each response is delivered after
+    the time it originally took, so loads can be reproduced and timed
+    without a network.  A URL requested more than once is answered with
+    its recorded responses in order, the last one being repeated.
+    """
+
+    # These describe the original transfer, not the body we serve
+    DROPPED_HEADERS = ("content-encoding", "content-length",
+                       "transfer-encoding")
+
+    def __init__(self, filename):
+        """Constructor for the class.
+
+        args:
+          filename -- the archive file to replay
+        """
+        self.filename = filename
+        self.index = defaultdict(list)
+        self.served = Counter()
+        self.misses = 0
+        with open(filename, "rb") as archive:
+            offset = 0
+            for line in archive:
+                if line.strip():
+                    request = json.loads(line.decode("utf-8"))["request"]
+                    self.index[(request["method"], request["url"])].append(
+                        offset)
+                offset += len(line)
+        debug("Replaying {} requests from {}".format(
+            sum(len(x) for x in self.index.values()), filename))
+
+    def read_entry(self, offset):
+        """Read the archive entry at offset."""
+        with open(self.filename, "rb") as archive:
+            archive.seek(offset)
+            return json.loads(archive.readline().decode("utf-8"))
+
+    def reply(self, op, request, parent=None):
+        """Return a reply for request from the archive."""
+        key = (operation_name(op, request), request.url().toString())
+        offsets = self.index.get(key)
+        if not offsets:
+            self.misses += 1
+            debug("Replay: {} {} is not in the archive".format(*key))
+            return BufferReply(
+                request, op, status=None,
+                error=QNetworkReply.ContentNotFoundError,
+                error_string="Not in the replay archive", parent=parent
+            )
+        position = min(self.served[key], len(offsets) - 1)
+        entry = self.read_entry(offsets[position])
+        self.served[key] += 1
+        response = entry["response"]
+        content = response["content"]
+        return BufferReply(
+            request, op,
+            status=response["status"] or None,
+            reason=response["statusText"],
+            headers=[
+                (header["name"], header["value"])
+                for header in response["headers"]
+                if header["name"].lower() not in self.DROPPED_HEADERS
+            ],
+            body=base64.b64decode(content.get("text", "")),
+            error=response.get("_error"),
+            error_string=response.get("_errorString", ""),
+            delay=int(entry["time"]),
+            parent=parent
+        )
+
+
+class AssetBundle(object):
+    """Local kiosk pages and files, served from memory on kiosk:// URLs.
+
+    Every file under the asset directory is read into memory once, and
+    served from there without touching the disk or the network;
+    "kiosk:///help/index.html" is the file "help/index.html" in the
+    directory.  Files ending in ".tmpl" are templates: each "{{name}}"
+    in them is replaced with the config setting "name" when the bundle
+    is built, and they're served without the ".tmpl".  Responses carry
+    an ETag and Last-Modified date, so conditional requests are answered
+    with "304 Not Modified".
+    """
+    SCHEME = "kiosk"
+    TEMPLATE_FIELD = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+    @classmethod
+    def render(cls, template, config):
+        """Return template with its {{name}} fields filled from config.
+
+        Fields that aren't config settings are left as they are.
+        """
+        def field(match):
+            if match.group(1) not in config:
+                debug("No setting {} for a kiosk template".format(
+                    match.group(1)))
+                return match.group(0)
+            return str(config[match.group(1)])
+        return cls.TEMPLATE_FIELD.sub(field, template)
+
+    def __init__(self, directory, config):
+        """Constructor for the class.
+
+        args:
+          directory -- the directory of assets to serve
+          config -- the browser config dict, for rendering templates
+        """
+        self.directory = directory
+        self.assets = {}
+        size = 0
+        for root, dirs, files in os.walk(directory):
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                name = "/" + os.path.relpath(path, directory).replace(
+                    os.sep, "/")
+                try:
+                    with open(path, "rb") as asset_file:
+                        content = asset_file.read()
+                    if name.endswith(".tmpl"):
+                        name = name[:-len(".tmpl")]
+                        content = self.render(
+                            content.decode("utf-8"), config).encode("utf-8")
+                    mtime = os.path.getmtime(path)
+                except (IOError, OSError, ValueError) as e:
+                    debug("Skipping kiosk asset {}: {}".format(path, e))
+                    continue
+                size += len(content)
+                self.add(name, content, mtime)
+        debug("Loaded {} kiosk assets ({} bytes) from {}".format(
+            len(self.assets), size, directory))
+
+    def add(self, name, content, mtime):
+        """Add an asset's content, served as name."""
+        mime_type = (
+            mimetypes.guess_type(name)[0] or "application/octet-stream"
+        )
+        if mime_type.startswith("text/"):
+            mime_type += "; charset=utf-8"
+        self.assets[name] = {
+            "body": content,
+            "mime_type": mime_type,
+            "etag": '"{}"'.format(hashlib.sha1(content).hexdigest()[:16]),
+            "mtime": int(mtime),
+            "last_modified": formatdate(mtime, usegmt=True)
+        }
+
+    @staticmethod
+    def not_modified(request, asset):
+        """Return True if request already has the current asset."""
+        etags = bytes(request.rawHeader(b"If-None-Match")).decode("latin-1")
+        if etags:
+            return etags.strip() == "*" or asset["etag"] in etags
+        since = parsedate_tz(
+            bytes(request.rawHeader(b"If-Modified-Since")).decode("latin-1"))
+        return since is not None and mktime_tz(since) >= asset["mtime"]
+
+    def reply(self, op, request, parent=None):
+        """Return a reply for a kiosk:// request."""
+        path = request.url().path() or "/"
+        if path.endswith("/"):
+            path += "index.html"
+        asset = self.assets.get(path)
+        if op not in (QNetworkAccessManager.GetOperation,
+                      QNetworkAccessManager.HeadOperation):
+            return BufferReply(
+                request, op, status=405, reason="Method Not Allowed",
+                error=QNetworkReply.ContentOperationNotPermittedError,
+                error_string="Kiosk assets are read-only", parent=parent
+            )
+        if asset is None:
+            debug("No kiosk asset {}".format(path))
+            return BufferReply(
+                request, op, status=404, reason="Not Found",
+                error=QNetworkReply.ContentNotFoundError,
+                error_string="No such kiosk asset", parent=parent
+            )
+        headers = [
+            ("Content-Type", asset["mime_type"]),
+            ("ETag", asset["etag"]),
+            ("Last-Modified", asset["last_modified"]),
+            ("Cache-Control", "no-cache")
+        ]
+        if self.not_modified(request, asset):
+            return BufferReply(
+                request, op, status=304, reason="Not Modified",
+                headers=headers, parent=parent
+            )
+        return BufferReply(
+            request, op, headers=headers,
+            body=(
+                asset["body"]
+                if op == QNetworkAccessManager.GetOperation else b""
+            ),
+            parent=parent
+        )
+
+
+class TimeoutWheel(QObject):
+    """Deadlines for any number of requests, checked by a single timer.
+
+    Deadlines are rounded up to the next TICK milliseconds and kept in a
+    bucket for that tick, so each tick only looks at the buckets that
+    have come due, however many requests are in flight.  The timer only
+    runs while there are deadlines pending.
+    """
+
+    TICK = 250
+
+    def __init__(self, parent=None):
+        """Constructor for the class."""
+        super(TimeoutWheel, self).__init__(parent)
+        # {tick: {key: (callback, args)}}
+        self.buckets = {}
+        self.keys = itertools.count()
+        self.clock = getattr(time, "monotonic", time.time)
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.TICK)
+        self.timer.timeout.connect(self.advance)
+
+    def current_tick(self):
+        return int(self.clock() * 1000) // self.TICK
+
+    def schedule(self, ms, callback, *args):
+        """Call callback(*args) in ms milliseconds; returns a handle."""
+        # round up, so callbacks are never early
+        tick = -(-int(self.clock() * 1000 + ms) // self.TICK)
+        key = next(self.keys)
+        self.buckets.setdefault(tick, {})[key] = (callback, args)
+        if not self.timer.isActive():
+            self.timer.start()
+        return tick, key
+
+    def cancel(self, handle):
+        """Cancel a callback scheduled with schedule()."""
+        tick, key = handle
+        bucket = self.buckets.get(tick)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self.buckets[tick]
+        if not self.buckets:
+            self.timer.stop()
+
+    def advance(self):
+        """Run the callbacks that have come due."""
+        now = self.current_tick()
+        for tick in sorted(t for t in self.buckets if t <= now):
+            for callback, args in self.buckets.pop(tick).values():
+                callback(*args)
+        if not self.buckets:
+            self.timer.stop()
+
+
+class ReplyTimeouts(object):
+    """The connect, first byte, and total deadlines of a network reply.
+
+    The connect deadline is met when the request has been sent (Qt 5.15
+    and later) or the TLS handshake is done, the first byte deadline
+    when the response starts, and the total deadline when the reply
+    finishes.  A reply that misses one is aborted.
+    """
+
+    PHASES = ("connect", "first_byte", "total")
+
+    def __init__(self, reply, timeouts, wheel, on_timeout=None):
+        """Constructor for the class.
+
+        args:
+          reply -- the QNetworkReply to watch
+          timeouts -- a dict of seconds by phase; missing or 0 is no limit
+          wheel -- the TimeoutWheel to keep the deadlines in
+          on_timeout -- called with the reply before it's aborted
+        """
+        self.reply = reply
+        self.wheel = wheel
+        self.on_timeout = on_timeout
+        # The wheel holds the only references to this object, through
+        # these handles, so it goes away when the last one is cancelled.
+        self.handles = {}
+        for phase in self.PHASES:
+            if timeouts.get(phase):
+                self.handles[phase] = wheel.schedule(
+                    timeouts[phase] * 1000, self.expire, phase)
+        for name in ("requestSent", "encrypted"):
+            signal = getattr(reply, name, None)
+            if signal is not None:
+                signal.connect(self.connected)
+        reply.metaDataChanged.connect(self.responding)
+        reply.readyRead.connect(self.responding)
+        reply.finished.connect(self.finished)
+
+    def clear(self, *phases):
+        for phase in phases:
+            handle = self.handles.pop(phase, None)
+            if handle is not None:
+                self.wheel.cancel(handle)
+
+    def connected(self, *args):
+        self.clear("connect")
+
+    def responding(self):
+        self.clear("connect", "first_byte")
+
+    def finished(self):
+        self.clear(*self.PHASES)
+
+    def expire(self, phase):
+        """Abort the reply, which missed its deadline for phase."""
+        self.handles.pop(phase, None)
+        self.clear(*self.PHASES)
+        if self.reply.isFinished():
+            return
+        debug("{} timeout for {}, aborting".format(
+            phase, self.reply.url().toString()))
+        if self.on_timeout is not None:
+            self.on_timeout(self.reply)
+        self.reply.abort()
+
+
+def host_pattern(hosts):
+    """Return a compiled regex matching any of a list of host patterns.
+
+    A plain name matches that host and its subdomains, like the
+    whitelist; a name with * or ? in it is a shell-style wildcard.
+    """
+    if not isinstance(hosts, (list, tuple)):
+        hosts = [hosts]
+    patterns = []
+    for host in hosts:
+        host = str(host).lower()
+        if "*" in host or "?" in host:
+            patterns.append(fnmatch.translate(host))
+        else:
+            patterns.append("(^|.*\\.){}$".format(re.escape(host)))
+    return re.compile("|".join(
+        "(?:{})".format(pattern) for pattern in patterns))
+
+
+def parse_proxies(spec):
+    """Return a list of QNetworkProxy for a PAC-style proxy string.
+
+    The string is one or more entries separated by semicolons, each
+    "DIRECT", "PROXY host:port", "SOCKS host:port", or just "host:port"
+    for an HTTP proxy.  The port defaults to 8080.
+    """
+    proxies = []
+    for entry in str(spec or "").split(";"):
+        words = entry.split()
+        if not words:
+            continue
+        if words[0].upper() == "DIRECT":
+            proxies.append(QNetworkProxy(QNetworkProxy.NoProxy))
+            continue
+        kind, address = (
+            ("PROXY", words[0]) if len(words) == 1
+            else (words[0].upper(), words[1])
+        )
+        proxy_type = {
+            "PROXY": QNetworkProxy.HttpProxy,
+            "HTTP": QNetworkProxy.HttpProxy,
+            "SOCKS": QNetworkProxy.Socks5Proxy,
+            "SOCKS5": QNetworkProxy.Socks5Proxy
+        }.get(kind)
+        # Allow URLs, like the http_proxy environment variable's
+        address = address.split("://")[-1].rstrip("/")
+        host, _, port = address.rpartition(":")
+        if not host:
+            host, port = address, "8080"
+        if proxy_type is None or not port.isdigit():
+            debug("Ignoring proxy {}".format(entry.strip()))
+            continue
+        proxies.append(QNetworkProxy(proxy_type, host, int(port)))
+    return proxies
+
+
+class PacFunctions(QObject):
+    """The PAC script functions that need the network."""
+
+    @pyqtSlot(str, result=str)
+    def dnsResolve(self, host):
+        try:
+            return socket.gethostbyname(host)
+        except (socket.error, UnicodeError):
+            return ""
+
+    @pyqtSlot(result=str)
+    def myIpAddress(self):
+        return get_ip()
+
+
+class ProxyRouter(object):
+    """Decides which proxies each host is reached through.
+
+    The "proxy_rules" are checked first, in order, then the PAC script,
+    then "proxy_server"; if none of them has an answer, the connection
+    is direct.  Decisions are kept in an LRU cache by scheme and host,
+    so the rules and the script only run once for each.
+
+    A PAC script at a URL is downloaded in the background; until it
+    arrives, the rules and proxy_server are used, and the cache is
+    emptied when it does.  Qt may ask for proxies from any thread, and
+    a script engine can only be used by the thread that made it, so
+    each thread gets its own engine.
+    """
+
+    CACHE_SIZE = 256
+
+    def __init__(self, config):
+        """Constructor for the class.
+
+        args:
+          config -- the browser config dict
+        """
+        self.rules = []
+        for rule in config.get("proxy_rules") or []:
+            proxies = parse_proxies(rule.get("proxy"))
+            if rule.get("hosts") and proxies:
+                self.rules.append((host_pattern(rule.get("hosts")), proxies))
+            else:
+                debug("Ignoring proxy rule {}".format(rule))
+        self.default = parse_proxies(config.get("proxy_server"))
+        # The PAC script's source, once it's loaded, and each thread's
+        # engine for it
+        self.script = None
+        self.engines = threading.local()
+        self.pac_reply = None
+        self.proxies = lru_cache(maxsize=self.CACHE_SIZE)(self.find_proxies)
+        if config.get("proxy_pac"):
+            self.load_pac(config.get("proxy_pac"))
+
+    def load_pac(self, location):
+        """Load the PAC script from a file, or start downloading it."""
+        if ScriptEngine is None:
+            debug("Proxy auto-config needs QtQml (or QtScript on Qt 4)")
+            return
+        if "://" in location:
+            # The download goes direct; the script decides the proxies
+            self.pac_nam = QNetworkAccessManager()
+            self.pac_nam.setProxy(QNetworkProxy(QNetworkProxy.NoProxy))
+            self.pac_reply = self.pac_nam.get(QNetworkRequest(QUrl(location)))
+            self.pac_reply.finished.connect(
+                partial(self._pac_downloaded, location))
+            return
+        try:
+            with open(location, "rb") as pac_file:
+                self.set_script(location, pac_file.read())
+        except (IOError, OSError) as e:
+            debug("Can't load PAC file {}: {}".format(location, e))
+
+    def _pac_downloaded(self, location):
+        reply, self.pac_reply = self.pac_reply, None
+        reply.deleteLater()
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if reply.error() != QNetworkReply.NoError or status != 200:
+            debug("Can't load PAC file {}: {}".format(
+                location, status or reply.errorString()))
+            return
+        self.set_script(location, bytes(reply.readAll()))
+
+    def set_script(self, location, script):
+        """Start using a PAC script, if it runs without errors."""
+        script = script.decode("utf-8", "replace")
+        try:
+            engine = self.make_engine(script)
+        except ValueError as e:
+            debug("Error in PAC file {}: {}".format(location, e))
+            return
+        self.engines.engine = engine
+        self.engines.script = self.script = script
+        self.proxies.cache_clear()
+        debug("Using PAC file {}".format(location))
+
+    @staticmethod
+    def make_engine(script):
+        """Return a script engine that has run script.
+
+        Raises ValueError if the script fails.
+        """
+        engine = ScriptEngine()
+        engine.pac_functions = PacFunctions()
+        engine.globalObject().setProperty(
+            "wcg", engine.newQObject(engine.pac_functions))
+        engine.evaluate(PAC_FUNCTIONS_JS)
+        result = engine.evaluate(script)
+        if result.isError():
+            raise ValueError(result.toString())
+        return engine
+
+    def engine(self):
+        """Return this thread's engine for the current PAC script."""
+        if getattr(self.engines, "script", None) is not self.script:
+            # The script ran once already, so it won't fail here
+            self.engines.engine = self.make_engine(self.script)
+            self.engines.script = self.script
+        return self.engines.engine
+
+    def find_pac_proxies(self, scheme, host):
+        """Return the PAC script's proxies for a host, or None."""
+        # Only the scheme and host are passed, so the answer can be
+        # cached; this is what browsers do for HTTPS URLs anyway.
+        call = "FindProxyForURL({}, {})".format(
+            json.dumps("{}://{}/".format(scheme, host)), json.dumps(host))
+        result = self.engine().evaluate(call)
+        if result.isError():
+            debug("PAC error for {}: {}".format(host, result.toString()))
+            return None
+        return parse_proxies(result.toString())
+
+    def find_proxies(self, scheme, host):
+        """Return the list of proxies for scheme://host/ (uncached)."""
+        for pattern, proxies in self.rules:
+            if pattern.match(host):
+                return proxies
+        if self.script is not None:
+            proxies = self.find_pac_proxies(scheme, host)
+            if proxies:
+                return proxies
+        return self.default or [QNetworkProxy(QNetworkProxy.NoProxy)]
+
+
+class ProxyFactory(QNetworkProxyFactory):
+    """Hands a network access manager's proxy queries to a ProxyRouter.
+
+    The network access manager owns its factory, so each one gets its
+    own, while the router (and its cache) is shared.
+    """
+
+    def __init__(self, router):
+        super(ProxyFactory, self).__init__()
+        self.router = router
+
+    def queryProxy(self, query):
+        host = (query.peerHostName() or query.url().host()).lower()
+        return self.router.proxies(query.url().scheme(), host)
+
+
+def make_proxy_router(config):
+    """Return a ProxyRouter for config, or None if it uses no proxies."""
+    if not (
+            config.get("proxy_server") or config.get("proxy_rules")
+            or config.get("proxy_pac")
+    ):
+        return None
+    return ProxyRouter(config)
+
+
+class RedirectCache(object):
+    """Permanent redirects and HSTS upgrades learned from trusted hosts.
+
+    Only redirects from the start_url and bookmark hosts (and from the
+    URLs those redirect to) are learned, so patrons' browsing isn't
+    recorded.  Entries expire after ttl seconds, at most MAX_ENTRIES of
+    each kind are kept, and the file is rewritten when something new is
+    learned.
+    """
+
+    MAX_ENTRIES = 200
+    MAX_HOPS = 10
+
+    def __init__(self, filename, ttl):
+        """Constructor for the class.
+
+        args:
+          filename -- the JSON file the cache is kept in
+          ttl -- the longest time to keep an entry, in seconds
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.hosts = set()
+        # {url: [target url, expiry time]}
+        self.redirects = {}
+        # {host: [expiry time, include subdomains]}
+        self.hsts = {}
+        self.served = 0
+        self.avoided = 0
+        try:
+            with open(filename) as cache_file:
+                data = json.load(cache_file)
+            self.redirects = data.get("redirects", {})
+            self.hsts = data.get("hsts", {})
+        except (IOError, OSError, ValueError, AttributeError) as e:
+            debug("Starting a new redirect cache in {}: {}".format(
+                filename, e))
+        self.targets = set(target for target, _ in self.redirects.values())
+
+    def upgrade(self, url, now):
+        """Return url switched to HTTPS if HSTS applies to it, or None."""
+        if url.scheme() != "http":
+            return None
+        labels = url.host().split(".")
+        for i in range(len(labels)):
+            entry = self.hsts.get(".".join(labels[i:]))
+            if entry and entry[0] > now and (i == 0 or entry[1]):
+                upgraded = QUrl(url)
+                upgraded.setScheme("https")
+                if upgraded.port() == 80:
+                    upgraded.setPort(-1)
+                return upgraded
+        return None
+
+    def resolve(self, url):
+        """Return where url ends up, and the number of redirects skipped.
+
+        If the redirects loop, url is returned unchanged.
+        """
+        now = time.time()
+        seen = set([url.toString()])
+        target = url
+        for hops in range(self.MAX_HOPS + 1):
+            upgraded = self.upgrade(target, now)
+            if upgraded is None:
+                entry = self.redirects.get(target.toString())
+                if entry is None or entry[1] < now:
+                    return target, hops
+                upgraded = QUrl(entry[0])
+            target = upgraded
+            if target.toString() in seen:
+                return url, 0
+            seen.add(target.toString())
+        return target, self.MAX_HOPS
+
+    def reply(self, op, request, parent=None):
+        """Return a redirect straight to where request ends up, or None."""
+        target, hops = self.resolve(request.url())
+        if not hops:
+            return None
+        self.served += 1
+        self.avoided += hops
+        reply = BufferReply(
+            request, op, status=301, reason="Moved Permanently",
+            headers=[("Location", str(target.toString()))], parent=parent)
+        reply.setProperty("wcg_cached_redirect", True)
+        return reply
+
+    def learn(self, reply, status, hsts=True):
+        """Remember reply's permanent redirect or HSTS policy, if any.
+
+        args:
+          reply -- a finished GET reply
+          status -- its HTTP status
+          hsts -- whether the reply's HSTS header can be trusted
+        """
+        url = reply.url()
+        key = str(url.toString())
+        if (
+                reply.property("wcg_cached_redirect")
+                or url.host() not in self.hosts and key not in self.targets
+        ):
+            return
+        now = time.time()
+        changed = False
+        target = reply.attribute(QNetworkRequest.RedirectionTargetAttribute)
+        if status in (301, 308) and target is not None:
+            target = str(url.resolved(target).toString())
+            if target != key and self.redirects.get(key, [None])[0] != target:
+                self.redirects[key] = [target, now + self.ttl]
+                self.targets.add(target)
+                changed = True
+        if (
+                hsts and url.scheme() == "https"
+                and reply.hasRawHeader(b"Strict-Transport-Security")
+        ):
+            changed = self.learn_hsts(
+                url.host(), bytes(reply.rawHeader(
+                    b"Strict-Transport-Security")).decode("latin-1"),
+                now) or changed
+        if changed:
+            self.save(now)
+
+    def learn_hsts(self, host, header, now):
+        """Update host's HSTS entry from its header; True if it changed."""
+        directives = [d.strip().lower() for d in header.split(";")]
+        max_age = None
+        for directive in directives:
+            name, _, value = directive.partition("=")
+            if name.strip() == "max-age":
+                try:
+                    max_age = int(value.strip().strip('"'))
+                except ValueError:
+                    return False
+        if max_age is None:
+            return False
+        if max_age <= 0:
+            return self.hsts.pop(host, None) is not None
+        include_subdomains = "includesubdomains" in directives
+        expires = now + min(max_age, self.ttl)
+        entry = self.hsts.get(host)
+        # Sites send the header with every response; only write it out
+        # again when the entry is half used up.
+        if (
+                entry is not None and entry[1] == include_subdomains
+                and entry[0] - now > min(max_age, self.ttl) / 2
+        ):
+            return False
+        self.hsts[host] = [expires, include_subdomains]
+        return True
+
+    def save(self, now):
+        """Drop expired and excess entries, and write the cache out."""
+        for entries, expiry in (
+                (self.redirects, lambda e: e[1]), (self.hsts, lambda e: e[0])
+        ):
+            for key in [k for k, e in entries.items() if expiry(e) < now]:
+                del entries[key]
+            while len(entries) > self.MAX_ENTRIES:
+                del entries[min(entries, key=lambda k: expiry(entries[k]))]
+        self.targets = set(target for target, _ in self.redirects.values())
+        temp_name = self.filename + ".tmp"
+        try:
+            with open(temp_name, "w") as cache_file:
+                json.dump(
+                    {"redirects": self.redirects, "hsts": self.hsts},
+                    cache_file)
+            os.rename(temp_name, self.filename)
+        except (IOError, OSError) as e:
+            debug("Can't write redirect cache {}: {}".format(
+                self.filename, e))
+
+    def status(self):
+        """Return the cache's size and the redirects it has saved."""
+        return {
+            "redirects": len(self.redirects),
+            "hsts_hosts": len(self.hsts),
+            "redirects_served": self.served,
+            "redirects_avoided": self.avoided
+        }
+
+
+class LinkPrefetcher(QObject):
+    """Gets a head start on links the patron hovers over.
+
+    When the pointer has rested on a link to a trusted host (the
+    start_url host, a bookmark host or a whitelisted one) for "dwell"
+    milliseconds, the link's host is connected to ("connect" mode), or
+    the page itself is fetched ("fetch" mode).  Fetched pages are kept
+    for TTL seconds; if the link is followed, the page is served from
+    here, or handed over if it's still loading.  At most
+    "max_concurrent" fetches run at once, and each page may prefetch
+    "max_kb" kilobytes.  Only successful responses that don't forbid
+    storing are kept.
+
+    A GET carries the patron's cookies, and a link like /logout would
+    take effect without a click, so even in fetch mode only links that
+    match one of the "fetch_patterns" are fetched; the rest are only
+    connected to.  A prefetched page isn't served if the
+    request asks for a fresh copy, or if the cookies for its URL have
+    changed since it was fetched, and the pages prefetched from one
+    page are dropped when another one starts loading.
+    """
+
+    TTL = 30
+    MAX_ENTRIES = 20
+    # These describe the original transfer, not the body we serve
+    DROPPED_HEADERS = (b"content-encoding", b"content-length",
+                       b"transfer-encoding")
+
+    def __init__(self, nam, settings):
+        """Constructor for the class.
+
+        args:
+          nam -- the WcgNetworkAccessManager to prefetch with
+          settings -- the "link_prefetch" config dict
+        """
+        super(LinkPrefetcher, self).__init__(nam)
+        self.nam = nam
+        self.mode = settings.get("mode") or "connect"
+        self.max_concurrent = settings.get("max_concurrent") or 2
+        self.max_bytes = (settings.get("max_kb") or 512) * 1024
+        self.fetch_patterns = settings.get("fetch_patterns") or []
+        self.budget = self.max_bytes
+        self.in_flight = 0
+        self.hovered = None
+        # {url: {"expires": time, "reply": the prefetch while it loads,
+        #        "response": (status, reason, headers, body) once done,
+        #        "cookies": the URL's cookies when it was done}}
+        self.entries = {}
+        config = nam.config
+        self.hosts = set(
+            QUrl(url).host() for url in [config.get("start_url")] + [
+                bookmark.get("url", "")
+                for bookmark in (config.get("bookmarks") or {}).values()
+            ]
+        )
+        self.whitelist = config.get("whitelist")
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(settings.get("dwell", 200))
+        self.timer.timeout.connect(profiled(self.prefetch))
+
+    def allowed(self, url):
+        """Return True if url is a link to a trusted host."""
+        if url.scheme() not in ("http", "https") or not url.host():
+            return False
+        return url.host() in self.hosts or bool(
+            self.whitelist
+            and whitelist_pattern(self.whitelist).match(url.host()))
+
+    @staticmethod
+    def key(url):
+        return str(url.toString(QUrl.RemoveFragment))
+
+    def fetchable(self, url):
+        """Return True if url may be fetched, not just connected to."""
+        key = self.key(url)
+        return any(
+            fnmatch.fnmatchcase(key, pattern)
+            for pattern in self.fetch_patterns)
+
+    def cookies(self, url):
+        """Return the cookies the browser would send to url."""
+        return sorted(
+            bytes(cookie.toRawForm())
+            for cookie in self.nam.cookieJar().cookiesForUrl(url))
+
+    def link_hovered(self, link, *args):
+        """Start waiting to prefetch link, or stop if it's empty.
+
+        Connected to QWebPage.linkHovered.
+        """
+        url = QUrl(link)
+        if not link or not self.allowed(url):
+            self.hovered = None
+            self.timer.stop()
+            return
+        self.hovered = url
+        self.timer.start()
+
+    def new_page(self, url):
+        """Start a new page's prefetch budget, loading url.
+
+        Prefetches of other pages are dropped, since whatever the last
+        page did may have changed them.
+        """
+        self.budget = self.max_bytes
+        self.hovered = None
+        self.timer.stop()
+        keep = self.key(url)
+        for key in [key for key in self.entries if key != keep]:
+            self.discard(key)
+
+    def expire(self):
+        """Drop the prefetches nobody followed in time."""
+        now = time.time()
+        for key in [
+                key for key, entry in self.entries.items()
+                if entry["expires"] < now and entry["reply"] is None
+        ]:
+            self.discard(key)
+
+    def discard(self, key):
+        entry = self.entries.pop(key)
+        if entry["reply"] is not None:
+            entry["reply"].abort()
+        if entry["response"] is not None:
+            PREFETCH_COUNTS["wasted_bytes"] += len(entry["response"][3])
+
+    def prefetch(self):
+        """Prefetch the link the pointer is resting on."""
+        url = self.hovered
+        if url is None:
+            return
+        key = self.key(url)
+        self.expire()
+        if key in self.entries:
+            return
+        if (
+                len(self.entries) >= self.MAX_ENTRIES
+                or self.mode == "fetch" and (
+                    self.in_flight >= self.max_concurrent
+                    or self.budget <= 0)
+        ):
+            PREFETCH_COUNTS["skipped"] += 1
+            return
+        entry = self.entries[key] = {
+            "expires": time.time() + self.TTL, "reply": None,
+            "response": None, "cookies": None
+        }
+        fetch = self.mode == "fetch" and self.fetchable(url)
+        PREFETCH_COUNTS["prefetched"] += 1
+        PREFETCH_COUNTS["fetched"] += int(fetch)
+        debug("Prefetching {} ({})".format(
+            key, "fetch" if fetch else "connect"))
+        if not fetch:
+            self.nam.preconnect([url])
+            return
+        request = QNetworkRequest(url)
+        request.setRawHeader(b"Sec-Purpose", b"prefetch")
+        reply = entry["reply"] = self.nam.get(request)
+        self.in_flight += 1
+        reply.downloadProgress.connect(partial(self._progress, reply))
+        reply.finished.connect(partial(self._finished, key, reply))
+
+    def _progress(self, reply, received, total):
+        # Stop a prefetch that would go over the page's budget
+        if (
+                not reply.property("wcg_followed")
+                and max(received, total) > self.budget
+        ):
+            reply.abort()
+
+    def _finished(self, key, reply):
+        self.in_flight -= 1
+        if reply.property("wcg_followed"):
+            return
+        body = bytes(reply.readAll())
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        entry = self.entries.get(key)
+        if (
+                entry is None or entry["reply"] is not reply
+                or status != 200 or reply.error() != QNetworkReply.NoError
+                or b"no-store" in bytes(
+                    reply.rawHeader(b"Cache-Control")).lower()
+                or len(body) > self.budget
+        ):
+            PREFETCH_COUNTS["wasted_bytes"] += len(body)
+            if entry is not None and entry["reply"] is reply:
+                del self.entries[key]
+        else:
+            self.budget -= len(body)
+            entry["reply"] = None
+            entry["cookies"] = self.cookies(reply.url())
+            entry["response"] = (
+                status,
+                reply.attribute(QNetworkRequest.HttpReasonPhraseAttribute),
+                [
+                    (bytes(name).decode("latin-1"),
+                     bytes(value).decode("latin-1"))
+                    for name, value in reply.rawHeaderPairs()
+                    if bytes(name).lower() not in self.DROPPED_HEADERS
+                ],
+                body
+            )
+        reply.deleteLater()
+
+    def reply(self, op, request, parent=None):
+        """Return the prefetched page for request, or None."""
+        key = self.key(request.url())
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if (
+                entry["reply"] is None and entry["expires"] < time.time()
+                or self.wants_fresh(request)
+                or entry["response"] is not None
+                and entry["cookies"] != self.cookies(request.url())
+        ):
+            self.discard(key)
+            return None
+        del self.entries[key]
+        if entry["reply"] is not None:
+            # Still loading: hand it over
+            PREFETCH_COUNTS["hits"] += 1
+            prefetch = entry["reply"]
+            prefetch.setProperty("wcg_followed", True)
+            reply = ForwardingReply(prefetch, parent)
+            reply.taps.append(lambda reply, data: PREFETCH_COUNTS.update(
+                used_bytes=len(data)))
+            if prefetch.attribute(
+                    QNetworkRequest.HttpStatusCodeAttribute) is not None:
+                QTimer.singleShot(0, reply._metadata_changed)
+            return reply
+        if entry["response"] is None:
+            # Only connected ahead of time
+            return None
+        status, reason, headers, body = entry["response"]
+        PREFETCH_COUNTS["hits"] += 1
+        PREFETCH_COUNTS["used_bytes"] += len(body)
+        return BufferReply(
+            request, op, status=status, reason=reason, headers=headers,
+            body=body, parent=parent)
+
+    @staticmethod
+    def wants_fresh(request):
+        """Return True if request mustn't be answered from a cache."""
+        return (
+            b"no-cache" in bytes(request.rawHeader(b"Cache-Control")).lower()
+            or b"no-cache" in bytes(request.rawHeader(b"Pragma")).lower()
+            or request.attribute(QNetworkRequest.CacheLoadControlAttribute)
+            == QNetworkRequest.AlwaysNetwork
+        )
+
+
+class WcgNetworkAccessManager(QNetworkAccessManager):
+    """Overridden so we can get debug info from responses"""
+
+    def __init__(self, config=None):
+        super(WcgNetworkAccessManager, self).__init__()
+        self.config = config or {}
+        # add event listener on "load finished" event
+        self.finished.connect(self._finished)
+        self.failed_urls = []
+        # set by OfflineStore.attach() if there's an offline cache
+        self.offline_store = None
+        # the AssetBundle serving kiosk:// URLs, if there is one
+        self.asset_bundle = None
+        self.request_log = get_request_log(self.config)
+        self.redirect_cache = get_redirect_cache(self.config)
+        self.peer_cache = get_peer_cache(self.config)
+        # request_timeouts() by host
+        self.timeouts = {}
+        # connection_policy() by host
+        self.policies = {}
+        # the RequestScheduler limiting requests in flight, if there is one
+        self.request_scheduler = None
+        self.prefetcher = (
+            LinkPrefetcher(self, self.config.get("link_prefetch"))
+            if self.config.get("link_prefetch") else None
+        )
+        # Authorization headers for the origins to send credentials to
+        # without waiting to be asked
+        self.auth_headers = preemptive_headers(self.config.get("credentials"))
+
+    def _finished(self, reply):
+        if reply.url().scheme().startswith("preconnect-"):
+            # Qt's own request behind connectToHost()
+            return
+        url = reply.url().toString()
+        # getting status is bit of a pain
+        status = reply.attribute(
+            QNetworkRequest.HttpStatusCodeAttribute
+        )
+        # track the URLs that failed; a prefetch failing isn't a problem
+        # until the link is followed
+        if (
+                (status is None or status >= 400)
+                and not reply.request().hasRawHeader(b"Sec-Purpose")
+        ):
+            self.failed_urls.append(url)
+        if (
+                status == 401
+                and credential_origin(reply.url()) in self.auth_headers
+        ):
+            AUTH_COUNTS["rejected"] += 1
+        if self.request_log is not None:
+            self.log_request(reply, status)
+        if (
+                self.redirect_cache is not None
+                and reply.operation() == self.GetOperation
+        ):
+            self.redirect_cache.learn(
+                reply, status, hsts=self.config.get("ssl_mode") != "ignore")
+        if DEBUG or DEBUG_LOG:
+            headers = [
+                (str(k), str(v))
+                for k, v in reply.rawHeaderPairs()
+            ]
+            debug(
+                "Got {status} from {url}, headers: {headers}"
+                .format(status=status, headers=headers, url=url)
+            )
+
+    def _download_progress(self, received, total):
+        self.sender().setProperty("wcg_bytes", received)
+
+    def log_request(self, reply, status):
+        """Write a record of a finished reply to the request log."""
+        started = reply.property("wcg_started")
+        if started is None:
+            return
+        url = reply.url()
+        self.request_log.log(
+            operation_name(reply.operation(), reply.request()),
+            url.host(), url.path(), status,
+            reply.property("wcg_bytes") or 0,
+            (time.time() - started) * 1000
+        )
+
+    def reset_failed_urls(self):
         self.failed_urls = []
 
-    def _finished(self, reply):
-        headers = [
-            (str(k), str(v))
-            for k, v in reply.rawHeaderPairs()
-        ]
-        url = reply.url().toString()
-        # getting status is bit of a pain
-        status = reply.attribute(
-            QNetworkRequest.HttpStatusCodeAttribute
-        )
-        # track the URLs that failed
-        if status is None or status >= 400:
-            self.failed_urls.append(url)
-        debug(
-            "Got {status} from {url}, headers: {headers}"
-            .format(status=status, headers=headers, url=url)
-        )
+    def timed_out(self, reply):
+        """Count a reply that's about to be aborted as failed.
+
+        It may already have a successful status, if it stalled after
+        the response headers.
+        """
+        self.failed_urls.append(reply.url().toString())
+
+    def request_timeouts(self, host):
+        """Return the request timeouts for host, as a dict by phase.
+
+        These are the "request_timeouts" settings, with the ones for host
+        in its "hosts" dict (or the closest domain above it) on top.
+        """
+        if host not in self.timeouts:
+            timeouts = dict(self.config.get("request_timeouts") or {})
+            timeouts.update(
+                host_setting(timeouts.pop("hosts", None) or {}, host) or {})
+            self.timeouts[host] = timeouts
+        return self.timeouts[host]
+
+    def connection_policy(self, host):
+        """Return the "connections" settings for host, like the timeouts."""
+        if host not in self.policies:
+            policy = dict(self.config.get("connections") or {})
+            policy.update(
+                host_setting(policy.pop("hosts", None) or {}, host) or {})
+            self.policies[host] = policy
+        return self.policies[host]
+
+    def apply_connection_policy(self, request):
+        """Return a copy of request, set up to use its host's protocol.
+
+        "http2" allows HTTP/2 (or forbids it, for servers that get it
+        wrong); "direct" uses it without asking first over plain HTTP.
+        If "keep_alive" is False, the server is asked to close the
+        connection after each request.
+        """
+        url = request.url()
+        policy = self.connection_policy(url.host())
+        request = QNetworkRequest(request)
+        http2 = policy.get("http2")
+        if http2 is not None and HTTP2_ALLOWED is not None:
+            request.setAttribute(HTTP2_ALLOWED, bool(http2))
+            if (
+                    http2 == "direct" and url.scheme() == "http"
+                    and HTTP2_DIRECT is not None
+            ):
+                request.setAttribute(HTTP2_DIRECT, True)
+        if policy.get("keep_alive") is False:
+            request.setRawHeader(b"Connection", b"close")
+        return request
+
+    def preconnect(self, urls):
+        """Open a connection to the host of each HTTP(S) URL in urls.
+
+        Requests to those hosts soon after can skip the DNS lookup, TCP
+        connection and TLS handshake.  Qt closes connections it hasn't
+        used for two minutes.
+        """
+        if not hasattr(self, "connectToHost"):  # Qt 4
+            return
+        seen = set()
+        for url in urls:
+            url = QUrl(url)
+            key = (str(url.scheme()), str(url.host()), url.port())
+            if key in seen or not url.host():
+                continue
+            seen.add(key)
+            debug("Connecting to {}://{} ahead of time".format(*key[:2]))
+            if key[0] == "http":
+                self.connectToHost(url.host(), url.port(80))
+            elif key[0] != "https":
+                continue
+            elif (
+                    HTTP2_ALLOWED is not None
+                    and self.connection_policy(url.host()).get("http2")
+            ):
+                # Qt keeps HTTP/2 connections apart from HTTP/1.1 ones, so
+                # ask for the same protocols its requests would.
+                ssl_config = QSslConfiguration.defaultConfiguration()
+                ssl_config.setAllowedNextProtocols([
+                    b"h2", QSslConfiguration.NextProtocolHttp1_1
+                ])
+                self.connectToHostEncrypted(
+                    url.host(), url.port(443), ssl_config)
+            else:
+                self.connectToHostEncrypted(url.host(), url.port(443))
+
+    def _encrypted(self):
+        self.sender().setProperty("wcg_handshake", True)
+
+    def count_connection(self):
+        """Count a finished request's protocol and connection."""
+        reply = self.sender()
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) is None:
+            return
+        url = reply.url()
+        host = url.host()
+        if (
+                host not in CONNECTION_STATS
+                and len(CONNECTION_STATS) >= MAX_CONNECTION_HOSTS
+        ):
+            host = "(other hosts)"
+        stats = CONNECTION_STATS[host]
+        stats["requests"] += 1
+        http2 = HTTP2_WAS_USED is not None and reply.attribute(HTTP2_WAS_USED)
+        if http2:
+            stats["http2"] += 1
+        handshake = bool(reply.property("wcg_handshake"))
+        if url.scheme() == "https":
+            stats["https"] += 1
+            stats["handshakes"] += handshake
+        stats["ms"] += (time.time() - reply.property("wcg_sent")) * 1000
+        debug("{} finished over {}{}".format(
+            url.toString(), "HTTP/2" if http2 else "HTTP/1",
+            " on a new connection" if handshake else ""))
+
+    def is_from_start_page(self, request):
+        """Return True if request was made while loading the start page."""
+        frame = request.originatingObject()
+        if not hasattr(frame, "requestedUrl"):
+            return False
+        return is_start_url(
+            frame.page().mainFrame().requestedUrl(), self.config
+        )
+
+    def set_offline_cache_control(self, request):
+        """Decide whether request is saved to or served from the cache.
+
+        Start page requests are always fetched from the network but saved
+        to the offline cache; while offline, everything is loaded from it.
+        Nothing else is ever saved, even when QtWebKit has already picked
+        how to load it (as on reloads and back/forward); that choice is
+        kept.  Only the OfflineStore's own probes are left alone.
+        """
+        if request.attribute(OfflineStore.PROBE_ATTRIBUTE):
+            return
+        save = (not self.offline_store.offline
+                and self.is_from_start_page(request))
+        request.setAttribute(QNetworkRequest.CacheSaveControlAttribute, save)
+        if request.attribute(
+                QNetworkRequest.CacheLoadControlAttribute) is not None:
+            return
+        request.setAttribute(
+            QNetworkRequest.CacheLoadControlAttribute,
+            QNetworkRequest.AlwaysCache if self.offline_store.offline
+            else QNetworkRequest.AlwaysNetwork
+        )
+
+    def createRequest(self, op, request, iodata):
+        reply = self.create_reply(op, request, iodata)
+        if self.request_log is not None:
+            reply.setProperty("wcg_started", time.time())
+            reply.downloadProgress.connect(self._download_progress)
+        return reply
+
+    def send_request(self, op, request, iodata):
+        """Send a request to the network and return its reply.
+
+        Requests to hosts with preemptive credentials get an
+        Authorization header here, so a challenge isn't needed.  Only
+        the exact host, scheme and port get them -- not its subdomains,
+        other ports, plain HTTP (unless allowed), or the hosts it
+        redirects to.  If "connections" is configured, HTTP(S) requests
+        get their host's settings, and are counted in CONNECTION_STATS.
+        """
+        auth_header = self.auth_headers.get(credential_origin(request.url()))
+        if (
+                auth_header is not None
+                and not request.hasRawHeader(b"Authorization")
+        ):
+            request = QNetworkRequest(request)
+            request.setRawHeader(b"Authorization", auth_header)
+            AUTH_COUNTS["preemptive"] += 1
+        counted = (
+            bool(self.config.get("connections"))
+            and request.url().scheme() in ("http", "https")
+        )
+        if counted:
+            request = self.apply_connection_policy(request)
+        reply = super(WcgNetworkAccessManager, self).createRequest(
+            op, request, iodata)
+        if counted:
+            reply.setProperty("wcg_sent", time.time())
+            if request.url().scheme() == "https":
+                reply.encrypted.connect(self._encrypted)
+            reply.finished.connect(self.count_connection)
+        if (
+                self.config.get("request_timeouts")
+                and request.url().scheme() in ("http", "https")
+        ):
+            ReplyTimeouts(
+                reply, self.request_timeouts(request.url().host()),
+                get_timeout_wheel(), self.timed_out
+            )
+        return reply
+
+    def send_to_peer(self, op, request, iodata):
+        """Ask the peer cache for an asset; see PeerCacheReply."""
+        return PeerCacheReply(
+            self.peer_cache, request,
+            partial(self.send_request, op, request, iodata), self)
+
+    def create_reply(self, op, request, iodata):
+        """Return the reply for a request: local, replayed, or real."""
+        url = str(request.url())
+        headers = [str(x) for x in request.rawHeaderList()]
+        debug(
+            "{op} request to {url}, headers: {headers}"
+            .format(op=op, url=url, headers=headers)
+        )
+        if (
+                self.asset_bundle is not None
+                and request.url().scheme() == AssetBundle.SCHEME
+        ):
+            return self.asset_bundle.reply(op, request, self)
+        recordable = request.url().scheme() in ("http", "https")
+        if SESSION_REPLAY is not None and recordable:
+            return SESSION_REPLAY.reply(op, request, self)
+        if (
+                self.redirect_cache is not None and recordable
+                and op == self.GetOperation
+        ):
+            reply = self.redirect_cache.reply(op, request, self)
+            if reply is not None:
+                return reply
+        if (
+                self.prefetcher is not None and recordable
+                and op == self.GetOperation
+                and not request.hasRawHeader(b"Sec-Purpose")
+        ):
+            reply = self.prefetcher.reply(op, request, self)
+            if reply is not None:
+                return reply
+        if self.offline_store is not None and op == self.GetOperation:
+            request = QNetworkRequest(request)
+            self.set_offline_cache_control(request)
+        send = self.send_request
+        if (
+                self.peer_cache is not None and op == self.GetOperation
+                and self.peer_cache.handles(request)
+        ):
+            send = self.send_to_peer
+        if self.request_scheduler is not None and recordable:
+            reply = self.request_scheduler.request(
+                op, request, iodata, send, self)
+        else:
+            reply = send(op, request, iodata)
+        if (
+                self.config.get("max_image_size")
+                and op == self.GetOperation and recordable
+                and RequestScheduler.classify(request) == "image"
+        ):
+            reply = DownscalingReply(
+                reply, self.config.get("max_image_size"), self)
+        if SESSION_RECORDER is not None and recordable:
+            reply = SESSION_RECORDER.record(op, request, reply, self)
+        return reply
+
+
+def make_web_view(config, **kwargs):
+    """Return a browser view using the configured rendering engine."""
+    if config.get("rendering_engine") == "webengine":
+        if QWebEngineView is not None:
+            return WcgWebEngineView(config, **kwargs)
+        debug("QtWebEngine isn't available; using QtWebKit")
+    return WcgWebView(config, **kwargs)
+
+
+class WebViewBase(object):
+    """The parts of a browser view that don't depend on the web engine.
+
+    WcgWebView (QtWebKit) and WcgWebEngineView (QtWebEngine) both mix
+    this in.  Besides what's here, MainWindow only uses the navigation
+    methods and signals the two Qt views share, pageAction() with
+    QWebPage actions, and clear_caches().
+    """
+
+    def setup_view(self, config, kwargs):
+        """Set up the objects shared with other views, and zoom state.
+
+        Popups are made with the same kwargs, so they share them too.
+        """
+        self.kwargs = kwargs
+        self.config = config
+        self.page_cache = self.kwargs["page_cache"] = (
+            kwargs.get("page_cache") or PageCache(config)
+        )
+        self.handler_launcher = self.kwargs["handler_launcher"] = (
+            kwargs.get("handler_launcher")
+            or HandlerLauncher(config.get("max_handlers"))
+        )
+        self.zoom_store = self.kwargs["zoom_store"] = kwargs.get("zoom_store")
+        # The host being shown, and the zoom of each host visited so far
+        self.zoom_host = None
+        self.host_zooms = {}
+        self.zoomed = False
+        self.console_capture = self.kwargs["console_capture"] = (
+            kwargs.get("console_capture")
+            or ConsoleCapture(config.get("console_log_rate"))
+        )
+
+    def add_print_action(self):
+        """Add printing to the context menu."""
+        self.print_action = QAction("Print", self)
+        self.print_action.setIcon(QIcon.fromTheme("document-print"))
+        self.print_action.triggered.connect(profiled(self.print_webpage))
+        self.page().printRequested.connect(profiled(self.print_webpage))
+        self.print_action.setToolTip("Print this web page")
+
+    def configured_zoom(self, host):
+        """Return the site_zoom factor for host, or None.
+
+        Like the whitelist, a host in site_zoom covers its subdomains.
+        """
+        zoom = host_setting(self.config.get("site_zoom") or {}, host)
+        return zoom and float(zoom) or None
+
+    def site_zoom(self, host):
+        """Return the zoom factor for host: configured, learned or default."""
+        return (
+            self.configured_zoom(host)
+            or self.zoom_store is not None and self.zoom_store.zoom(host)
+            or self.config.get("zoom_factor")
+        )
+
+    def apply_site_zoom(self):
+        """Set the zoom for the host being loaded, before it's laid out.
+
+        A host gets its site zoom the first time it's visited in a
+        session, and whatever the patron zoomed it to after that.
+        """
+        host = self.requested_url().host()
+        if host == self.zoom_host:
+            return
+        self.zoom_host = host
+        if host not in self.host_zooms:
+            self.host_zooms[host] = self.site_zoom(host)
+        if self.zoomFactor() != self.host_zooms[host]:
+            self.setZoomFactor(self.host_zooms[host])
+
+    def remember_zoom(self):
+        """Keep the zoom the patron chose for the current host."""
+        self.zoomed = True
+        if self.zoom_host is not None:
+            self.host_zooms[self.zoom_host] = self.zoomFactor()
+
+    def session_zooms(self):
+        """Return the zoom of each host visited, if the session was used.
+
+        Sessions where nobody zoomed or followed a link are left out,
+        so an idle kiosk doesn't outvote its patrons, and so are hosts
+        with a configured zoom, since that always wins.
+        """
+        if not self.zoomed and self.history().count() < 2:
+            return {}
+        return dict(
+            (host, zoom) for host, zoom in self.host_zooms.items()
+            if self.configured_zoom(host) is None
+        )
+
+    def make_popup(self):
+        """Open a popup window sharing this view's objects, and return it."""
+        popup = type(self)(self.config, **self.kwargs)
+        # This assumes the window manager has an "X" icon
+        # for closing the window somewhere to the right.
+        popup.setObjectName("web_content")
+        # Remember which main window (seat) this popup belongs to
+        popup.main_window = getattr(
+            self.window(), "main_window", self.window()
+        )
+        popup.setWindowTitle(
+            "Click the 'X' to close this window! ---> "
+        )
+        popup.page().windowCloseRequested.connect(popup.close)
+        popup.show()
+        return popup
+
+    def contextMenuEvent(self, event):
+        """Handle requests for a context menu in the browser.
+
+        Overridden from QWebView,
+        to provide right-click functions according to user settings.
+        """
+        menu = QMenu(self)
+        for action in [
+                QWebPage.Back, QWebPage.Forward,
+                QWebPage.Reload, QWebPage.Stop
+        ]:
+            action = self.pageAction(action)
+            if action.isEnabled():
+                menu.addAction(action)
+        if self.config.get("allow_printing"):
+            menu.addAction(self.print_action)
+        menu.exec_(event.globalPos())
+
+    def authenticate(self, url, authenticator):
+        """Handle requests for HTTP authentication
 
-    def reset_failed_urls(self):
-        self.failed_urls = []
+        This is called when a page requests authentication.
+        It might be nice to actually have a dialog here,
+        but for now we just use the credentials from the config file.
+        A host in "credentials" only gets its own, and only on the
+        origins they're for; the default ones only go to other hosts
+        that are allowed by the whitelist.
+        """
+        debug("Auth required on {}".format(url.toString()))
+        AUTH_COUNTS["challenged"] += 1
+        credentials = self.config.get("credentials") or {}
+        settings = credential_origins(credentials).get(credential_origin(url))
+        if settings:
+            authenticator.setUser(settings.get("user") or "")
+            authenticator.setPassword(settings.get("password") or "")
+            return
+        if str(url.host()) in credentials or not self.url_allowed(url):
+            debug("Not sending credentials to {}".format(url.toString()))
+            return
+        default_user = self.config.get("default_user")
+        default_password = self.config.get("default_password")
+        if (default_user):
+            authenticator.setUser(default_user)
+        if (default_password):
+            authenticator.setPassword(default_password)
 
+    def url_allowed(self, url):
+        """Return False if url's host isn't on the whitelist.
 
-    def createRequest(self, op, request, iodata):
-        url = str(request.url())
-        headers = [str(x) for x in request.rawHeaderList()]
-        debug(
-            "{op} request to {url}, headers: {headers}"
-            .format(op=op, url=url, headers=headers)
-        )
-        return super(WcgNetworkAccessManager, self).createRequest(op, request, iodata)
+        The start_url host, blank pages and kiosk pages are always
+        allowed.
+        """
+        if (
+            self.config.get("whitelist")
+            and not (url.host() ==
+                     QUrl(self.config.get("start_url")).host())
+            and not str(url.toString()) == 'about:blank'
+            and not url.scheme() == AssetBundle.SCHEME
+        ):
+            pattern = whitelist_pattern(self.config.get("whitelist"))
+            if not pattern.match(url.host()):
+                debug("Site violates whitelist: {}, {}".format(
+                    url.host(), url.toString())
+                )
+                return False
+        return True
+
+    def onLinkClick(self, url):
+        """Handle clicked hyperlinks.
+
+        Overridden from QWebView.
+        Called whenever the browser navigates to a URL;
+        handles the whitelisting logic and does some debug logging.
+        """
+        debug("Request URL: {}".format(url.toString()))
+        if not url.isEmpty():
+            # If whitelisting is enabled, and this isn't the start_url host,
+            # check the url to see if the host's domain matches.
+            if not self.url_allowed(url):
+                self.setHtml(self.page_cache.page("page_unavailable_html"))
+            if not url.isValid():
+                debug("Invalid URL {}".format(url.toString()))
+            else:
+                debug("Load URL {}".format(url.toString()))
+
+    def print_webpage(self):
+        """Print the webpage to a printer.
+
+        Callback for the print action.
+        Should show a print dialog and print the webpage to the printer.
+        Silent prints are handed to the print queue, so the GUI
+        isn't held up while the printer does its work.
+        """
+        print_queue = self.kwargs.get("print_queue")
+        if print_queue is None:
+            print_queue = self.kwargs["print_queue"] = PrintQueue(
+                self.config.get("print_settings", {})
+            )
+
+        if print_queue.silent:
+            print_queue.submit(self)
+            return True
+
+        # Show a print dialog, unless we want silent printing
+        printer = print_queue.make_printer()
+        print_dialog = QPrintDialog(printer, self)
+        print_dialog.setWindowTitle("Print Page")
+        if not print_dialog.exec_() == QDialog.Accepted:
+            return False
 
+        self.print_(printer)
+        return True
 
-class WcgWebView(QWebView):
+
+class WcgWebView(WebViewBase, QWebView):
     """This is the webview for the application.
 
     It represents a browser window, either the main one or a popup.
@@ -724,11 +5194,22 @@ class WcgWebView(QWebView):
     def __init__(self, config, parent=None, **kwargs):
         """Constructor for the class"""
         super(WcgWebView, self).__init__(parent)
-        self.kwargs = kwargs
-        self.config = config
-        self.nam = (kwargs.get('networkAccessManager')
-                    or WcgNetworkAccessManager())
-        self.setPage(WCGWebPage(config=config))
+        self.setup_view(config, kwargs)
+        self.nam = kwargs.get('networkAccessManager')
+        if not self.nam:
+            self.nam = WcgNetworkAccessManager(config)
+            if kwargs.get("offline_store"):
+                kwargs["offline_store"].attach(self.nam)
+            self.nam.asset_bundle = kwargs.get("asset_bundle")
+            self.nam.request_scheduler = kwargs.get("request_scheduler")
+            # Set up the proxies, if there are any
+            proxy_router = self.kwargs["proxy_router"] = (
+                kwargs.get("proxy_router") or make_proxy_router(config)
+            )
+            if proxy_router is not None:
+                self.nam.setProxyFactory(ProxyFactory(proxy_router))
+        self.setPage(
+            WCGWebPage(config=config, console=self.console_capture))
         self.page().setNetworkAccessManager(self.nam)
         self.settings().setAttribute(
             QWebSettings.JavascriptCanOpenWindows,
@@ -752,6 +5233,7 @@ class WcgWebView(QWebView):
             QWebSettings.PluginsEnabled,
             config.get("allow_plugins")
         )
+        self.apply_performance_profile(config.get("performance_profile"))
         self.page().setForwardUnsupportedContent(
             config.get("allow_external_content")
         )
@@ -759,34 +5241,63 @@ class WcgWebView(QWebView):
 
         # add printing to context menu if it's allowed
         if config.get("allow_printing"):
-            self.print_action = QAction("Print", self)
-            self.print_action.setIcon(QIcon.fromTheme("document-print"))
-            self.print_action.triggered.connect(self.print_webpage)
-            self.page().printRequested.connect(self.print_webpage)
-            self.print_action.setToolTip("Print this web page")
-
-        # Set up the proxy if there is one set
-        if config.get("proxy_server"):
-            if ":" in config["proxy_server"]:
-                proxyhost, proxyport = config["proxy_server"].split(":")
-            else:
-                proxyhost = config["proxy_server"]
-                proxyport = 8080
-            self.nam.setProxy(QNetworkProxy(
-                QNetworkProxy.HttpProxy, proxyhost, int(proxyport)
-            ))
+            self.add_print_action()
 
         # connections for wcgwebview
         self.page().networkAccessManager().authenticationRequired.connect(
-            self.auth_dialog
+            profiled(self.auth_dialog)
         )
-        self.page().unsupportedContent.connect(self.handle_unsupported_content, type=Qt.QueuedConnection)
-        self.page().downloadRequested.connect(self.download)
+        self.page().unsupportedContent.connect(
+            profiled(self.handle_unsupported_content),
+            type=Qt.QueuedConnection
+        )
+        self.page().downloadRequested.connect(profiled(self.download))
         self.page().networkAccessManager().sslErrors.connect(
-            self.sslErrorHandler
+            profiled(self.sslErrorHandler)
         )
-        self.urlChanged.connect(self.onLinkClick)
-        self.loadFinished.connect(self.onLoadFinished)
+        self.urlChanged.connect(profiled(self.onLinkClick))
+        self.loadFinished.connect(profiled(self.onLoadFinished))
+        if config.get("site_zoom") or self.zoom_store is not None:
+            self.loadStarted.connect(profiled(self.apply_site_zoom))
+        if self.nam.prefetcher is not None:
+            self.page().linkHovered.connect(
+                profiled(self.nam.prefetcher.link_hovered))
+            self.loadStarted.connect(profiled(self.new_prefetch_page))
+
+    def new_prefetch_page(self):
+        """Tell the link prefetcher a new page is loading."""
+        self.nam.prefetcher.new_page(self.requested_url())
+
+    def requested_url(self):
+        """Return the URL being loaded, before any redirects."""
+        return self.page().mainFrame().requestedUrl()
+
+    def clear_caches(self):
+        """Empty WebKit's in-memory caches."""
+        QWebSettings.clearMemoryCaches()
+
+    def apply_performance_profile(self, name):
+        """Apply the WebKit settings of a performance profile."""
+        profile = PERFORMANCE_PROFILES.get(name) or {}
+        for setting, value in profile.get("settings", {}).items():
+            attribute = getattr(QWebSettings, setting, None)
+            if attribute is None:
+                debug("QWebSettings.{} isn't available here".format(setting))
+                continue
+            self.settings().setAttribute(attribute, value)
+        if profile.get("stop_animations") and not self.config.get("user_css"):
+            self.settings().setUserStyleSheetUrl(QUrl(NO_ANIMATIONS_CSS))
+        if profile.get("max_frame_rate"):
+            script = FRAME_RATE_LIMIT_JS.format(
+                fps=profile.get("max_frame_rate"))
+            self.page().frameCreated.connect(
+                partial(self.limit_frame_rate, script=script))
+            self.limit_frame_rate(self.page().mainFrame(), script)
+
+    def limit_frame_rate(self, frame, script):
+        """Install the frame rate limit in frame's pages as they load."""
+        frame.javaScriptWindowObjectCleared.connect(
+            partial(frame.evaluateJavaScript, script))
 
     def createWindow(self, type):
         """Handle requests for a new browser window.
@@ -797,40 +5308,11 @@ class WcgWebView(QWebView):
         """
         if self.config.get("allow_popups"):
             self.kwargs["networkAccessManager"] = self.nam
-            self.popup = WcgWebView(
-                self.config,
-                **self.kwargs
-            )
-            # This assumes the window manager has an "X" icon
-            # for closing the window somewhere to the right.
-            self.popup.setObjectName("web_content")
-            self.popup.setWindowTitle(
-                "Click the 'X' to close this window! ---> "
-            )
-            self.popup.page().windowCloseRequested.connect(self.popup.close)
-            self.popup.show()
+            self.popup = self.make_popup()
             return self.popup
         else:
             debug("Popup not loaded on {}".format(self.url().toString()))
 
-    def contextMenuEvent(self, event):
-        """Handle requests for a context menu in the browser.
-
-        Overridden from QWebView,
-        to provide right-click functions according to user settings.
-        """
-        menu = QMenu(self)
-        for action in [
-                QWebPage.Back, QWebPage.Forward,
-                QWebPage.Reload, QWebPage.Stop
-        ]:
-            action = self.pageAction(action)
-            if action.isEnabled():
-                menu.addAction(action)
-        if self.config.get("allow_printing"):
-            menu.addAction(self.print_action)
-        menu.exec_(event.globalPos())
-
     def sslErrorHandler(self, reply, errorList):
         """Handle SSL errors in the browser.
 
@@ -844,25 +5326,12 @@ class WcgWebView(QWebView):
             debug(", ".join([str(error.errorString()) for error in errorList]))
         else:
             self.setHtml(
-                CERTIFICATE_ERROR.format(
-                    url=reply.url().toString(),
-                    start_url=self.config.get("start_url")
-                ))
+                self.page_cache.certificate_error(reply.url().toString())
+            )
 
     def auth_dialog(self, reply, authenticator):
-        """Handle requests for HTTP authentication
-
-        This is called when a page requests authentication.
-        It might be nice to actually have a dialog here,
-        but for now we just use the default credentials from the config file.
-        """
-        debug("Auth required on {}".format(reply.url().toString()))
-        default_user = self.config.get("default_user")
-        default_password = self.config.get("default_password")
-        if (default_user):
-            authenticator.setUser(default_user)
-        if (default_password):
-            authenticator.setPassword(default_password)
+        """Handle requests for HTTP authentication from the network."""
+        self.authenticate(reply.url(), authenticator)
 
     def download(self, request):
         """Handle a download request
@@ -937,54 +5406,17 @@ class WcgWebView(QWebView):
         if myfile.open():
             myfile.write(self.reply.readAll())
             myfile.close()
-            subprocess.Popen([
+            self.handler_launcher.launch(
                 (self.config.get("content_handlers")
                  .get(str(self.content_type))),
                 myfile.fileName()
-            ])
+            )
 
             # Sometimes downloading files opens an empty window.
             # So if the current window has no URL, close it.
             if(str(self.url().toString()) in ('', 'about:blank')):
                 self.close()
 
-    def onLinkClick(self, url):
-        """Handle clicked hyperlinks.
-
-        Overridden from QWebView.
-        Called whenever the browser navigates to a URL;
-        handles the whitelisting logic and does some debug logging.
-        """
-        debug("Request URL: {}".format(url.toString()))
-        if not url.isEmpty():
-            # If whitelisting is enabled, and this isn't the start_url host,
-            # check the url to see if the host's domain matches.
-            if (
-                self.config.get("whitelist")
-                and not (url.host() ==
-                         QUrl(self.config.get("start_url")).host())
-                and not str(url.toString()) == 'about:blank'
-            ):
-                site_ok = False
-                pattern = re.compile(str("(^|.*\.)(" + "|".join(
-                    [re.escape(w)
-                     for w
-                     in self.config.get("whitelist")]
-                ) + ")$"))
-                debug("Whitelist pattern: {}".format(pattern.pattern))
-                if re.match(pattern, url.host()):
-                    site_ok = True
-                if not site_ok:
-                    debug("Site violates whitelist: {}, {}".format(
-                        url.host(), url.toString())
-                    )
-                    self.setHtml(self.config.get("page_unavailable_html")
-                                 .format(**self.config))
-            if not url.isValid():
-                debug("Invalid URL {}".format(url.toString()))
-            else:
-                debug("Load URL {}".format(url.toString()))
-
     def onLoadFinished(self, ok):
         """Handle loadFinished events.
 
@@ -1000,99 +5432,38 @@ class WcgWebView(QWebView):
 
         # Check the WcgNetworkAccessManager's failed_urls to see if our requested
         # url failed to load.  If it's not in there, load anyway.
+        # (If the page never arrived, url() is still the previous page's.)
+        requested = self.requested_url()
         if not ok:
-            if self.url().toString() not in self.nam.failed_urls:
+            if (
+                self.url().toString() not in self.nam.failed_urls
+                and requested.toString() not in self.nam.failed_urls
+            ):
                 ok = True
+        offline_store = self.kwargs.get("offline_store")
         if not ok:
             if (
-                self.url().host() == QUrl(self.config.get("start_url")).host()
-                and str(self.url().path()).rstrip("/") ==
-                    str(QUrl(self.config.get("start_url")).path()).rstrip("/")
+                is_start_url(requested, self.config)
+                and offline_store
+                and not offline_store.offline
+                and offline_store.has_start_page()
             ):
-                self.setHtml(self.config.get("network_down_html")
-                             .format(**self.config), QUrl())
+                # Show the saved copy until the network comes back
+                offline_store.go_offline()
+                self.load(QUrl(self.config.get("start_url")))
+            elif is_start_url(requested, self.config):
+                self.setHtml(
+                    self.page_cache.page("network_down_html"), QUrl())
                 debug("Start Url doesn't seem to be available;"
                       " displaying error")
             else:
                 debug("**PAGE LOAD FAILED, URL: {}" .format(self.url().toString()))
                 self.setHtml(
-                    self.config.get("page_unavailable_html")
-                    .format(**self.config), QUrl()
+                    self.page_cache.page("page_unavailable_html"), QUrl()
                 )
         self.nam.reset_failed_urls()
         return True
 
-    def print_webpage(self):
-        """Print the webpage to a printer.
-
-        Callback for the print action.
-        Should show a print dialog and print the webpage to the printer.
-        """
-        print_settings = self.config.get("print_settings", {})
-
-        if print_settings.get("mode") == "high":
-            printer = QPrinter(mode=QPrinter.HighResolution)
-        else:
-            printer = QPrinter(mode=QPrinter.ScreenResolution)
-
-        # set which printer
-        # FIXME: This isn't documented, because it doesn't seem to work...
-        if print_settings.get("printer_name"):
-            debug(
-                "Setting printer to: {}".format(
-                    print_settings.get("printer_name"))
-            )
-            printer.setPrinterName(print_settings.get("printer_name"))
-            debug("Printer is now: {}".format(printer.printerName()))
-
-        # Set the units
-        unit_name = print_settings.get("size_unit", 'Millimeter').title()
-        try:
-            unit = getattr(QPrinter, unit_name)
-        except AttributeError:
-            debug(
-                "Specified print size unit '{}' not found, using default."
-                .format(unit_name)
-            )
-            unit = QPrinter.Millimeter
-
-        # Set the margins
-        margins = list(
-            print_settings.get("margins", printer.getPageMargins(unit))
-        )
-        margins.append(unit)
-        printer.setPageMargins(*margins)
-
-        # Set the Orientation
-        orientation = print_settings.get("orientation", 'Portrait').title()
-        printer.setOrientation(
-            getattr(QPrinter, orientation, QPrinter.Portrait)
-        )
-
-        # Set the paper size
-        paper_size = print_settings.get("paper_size")
-        if type(paper_size) in (list, tuple):
-            # Assume it's a width/height spec
-            printer.setPaperSize(QSizeF(*paper_size), unit)
-        elif paper_size is not None:  # Assume it's a size name
-            printer.setPaperSize(getattr(QPrinter, paper_size, 'AnsiA'))
-        # If paper_size is None, we just leave it at the printer's default
-
-        # Set the resolution
-        resolution = print_settings.get("resolution")
-        if resolution:
-            printer.setResolution(int(resolution))
-
-        # Show a print dialog, unless we want silent printing
-        if not print_settings.get("silent"):
-            print_dialog = QPrintDialog(printer, self)
-            print_dialog.setWindowTitle("Print Page")
-            if not print_dialog.exec_() == QDialog.Accepted:
-                return False
-
-        self.print_(printer)
-        return True
-
 # ### END WCGWEBVIEW DEFINITION ### #
 
 # ### WCGWEBPAGE #### #
@@ -1103,10 +5474,15 @@ class WCGWebPage(QWebPage):
 
     This was subclassed so that some functions can be overridden.
     """
-    def __init__(self, parent=None, config=None):
-        """Constructor for the class"""
+    def __init__(self, parent=None, config=None, console=None):
+        """Constructor for the class
+
+        args:
+          console -- the ConsoleCapture to send console messages to
+        """
         super(WCGWebPage, self).__init__(parent)
         self.config = config or {}
+        self.console = console
 
     def javaScriptConsoleMessage(self, message, line, sourceid):
         """Handle console.log messages from javascript.
@@ -1114,8 +5490,15 @@ class WCGWebPage(QWebPage):
         Overridden from QWebPage so that we can
         send javascript errors to debug.
         """
-        debug('Javascript Error in "{}" line {}: {}'.format(
-            sourceid, line, message)
+        if self.console is None:
+            debug('Javascript Error in "{}" line {}: {}'.format(
+                sourceid, line, message)
+            )
+            return
+        self.console.message(
+            str(self.mainFrame().url().toString(
+                QUrl.RemoveQuery | QUrl.RemoveFragment)),
+            sourceid, line, message
         )
 
     def javaScriptConfirm(self, frame, msg):
@@ -1148,8 +5531,410 @@ class WCGWebPage(QWebPage):
 
 # ### END WCGWEBPAGE DEFINITION ### #
 
+# ### QTWEBENGINE BACKEND ### #
+
+# Only defined when QtWebEngine could be imported; see make_web_view().
+if QWebEngineView is not None:
+
+    # The QtWebEngine profiles, keyed by seat and privacy_mode, so that
+    # seats don't share cookies; see get_web_engine_profile().
+    WEB_ENGINE_PROFILES = {}
+
+    def get_web_engine_profile(config, seat=None):
+        """Return the QWebEngineProfile for a seat's config.
+
+        In privacy mode the profile is off the record, so nothing is
+        written to disk; otherwise each seat has its own storage.
+        Either way, clear_caches() forgets the cookies, cache and
+        visited links of each session, for that seat only.
+        """
+        private = bool(config.get("privacy_mode"))
+        if (seat, private) not in WEB_ENGINE_PROFILES:
+            profile = (
+                QWebEngineProfile() if private
+                else QWebEngineProfile("wcgbrowser" if seat is None
+                                       else "wcgbrowser-seat{}".format(seat))
+            )
+            profile.downloadRequested.connect(
+                profiled(web_engine_download))
+            WEB_ENGINE_PROFILES[(seat, private)] = profile
+            # QtWebEngine only follows the application proxy, not
+            # proxy_rules or proxy_pac.
+            proxies = parse_proxies(config.get("proxy_server"))
+            if proxies:
+                QNetworkProxy.setApplicationProxy(proxies[0])
+        profile = WEB_ENGINE_PROFILES[(seat, private)]
+        if config.get("user_agent"):
+            profile.setHttpUserAgent(config.get("user_agent"))
+        return profile
+
+    def web_engine_download(item):
+        """Hand a download to the view it was started from."""
+        page = item.page()
+        view = page.view() if page is not None else None
+        if isinstance(view, WcgWebEngineView):
+            view.download(item)
+        else:
+            item.cancel()
+
+    class WcgWebEngineView(WebViewBase, QWebEngineView):
+        """A browser view rendered by QtWebEngine instead of QtWebKit.
+
+        QtWebEngine is Chromium, with a current JavaScript engine, and
+        renders pages in separate processes, so a page that crashes
+        can't take the browser down with it.  It has its own network
+        stack, so the features of WcgNetworkAccessManager (kiosk://
+        pages, the offline cache, request timeouts, scheduling, logging
+        and so on) don't apply.
+        """
+
+        # The QWebPage actions MainWindow asks for, and their equivalents
+        PAGE_ACTIONS = {
+            QWebPage.Back: QWebEnginePage.Back,
+            QWebPage.Forward: QWebEnginePage.Forward,
+            QWebPage.Reload: QWebEnginePage.Reload,
+            QWebPage.Stop: QWebEnginePage.Stop
+        }
+
+        def __init__(self, config, parent=None, **kwargs):
+            """Constructor for the class"""
+            super(WcgWebEngineView, self).__init__(parent)
+            self.setup_view(config, kwargs)
+            # Popups are in the same seat, so they get the same profile
+            self.profile = self.kwargs["web_engine_profile"] = (
+                kwargs.get("web_engine_profile")
+                or get_web_engine_profile(config, kwargs.get("seat"))
+            )
+            self.setPage(WcgWebEnginePage(
+                self.profile, self, config=config,
+                console=self.console_capture
+            ))
+            self.settings().setAttribute(
+                QWebEngineSettings.JavascriptCanOpenWindows,
+                config.get("allow_popups")
+            )
+            self.settings().setAttribute(
+                QWebEngineSettings.LocalStorageEnabled, True)
+            self.settings().setAttribute(
+                QWebEngineSettings.PluginsEnabled,
+                config.get("allow_plugins")
+            )
+            if config.get('user_css'):
+                self.add_style_sheet(config.get('user_css'))
+            self.apply_performance_profile(config.get("performance_profile"))
+            self.setZoomFactor(config.get("zoom_factor"))
+
+            # add printing to context menu if it's allowed
+            if config.get("allow_printing"):
+                self.add_print_action()
+
+            self.page().authenticationRequired.connect(
+                profiled(self.authenticate))
+            self.page().renderProcessTerminated.connect(
+                profiled(self.render_process_terminated))
+            self.urlChanged.connect(profiled(self.onLinkClick))
+            self.loadFinished.connect(profiled(self.onLoadFinished))
+            if config.get("site_zoom") or self.zoom_store is not None:
+                self.loadStarted.connect(profiled(self.apply_site_zoom))
+
+        def requested_url(self):
+            """Return the URL being loaded, before any redirects."""
+            return self.page().requestedUrl()
+
+        def pageAction(self, action):
+            """Return the page's action for a QWebPage action."""
+            return super(WcgWebEngineView, self).pageAction(
+                self.PAGE_ACTIONS.get(action, action))
+
+        def clear_caches(self):
+            """Forget the last session's cookies, cache and visited links."""
+            profile = self.page().profile()
+            profile.cookieStore().deleteAllCookies()
+            profile.clearHttpCache()
+            profile.clearAllVisitedLinks()
+
+        def add_script(self, name, source, injection_point=None):
+            """Run a script in every frame of each page this view loads."""
+            script = QWebEngineScript()
+            script.setName(name)
+            script.setSourceCode(source)
+            script.setInjectionPoint(
+                injection_point or QWebEngineScript.DocumentCreation)
+            script.setWorldId(QWebEngineScript.MainWorld)
+            script.setRunsOnSubFrames(True)
+            self.page().scripts().insert(script)
+
+        def add_style_sheet(self, url):
+            """Add the style sheet at url to each page this view loads."""
+            self.add_script(
+                "wcg_style_sheet",
+                STYLE_SHEET_JS.format(url=json.dumps(str(url))),
+                QWebEngineScript.DocumentReady
+            )
+
+        def apply_performance_profile(self, name):
+            """Apply a performance profile's settings that exist here."""
+            profile = PERFORMANCE_PROFILES.get(name) or {}
+            for setting, value in profile.get("settings", {}).items():
+                attribute = getattr(QWebEngineSettings, setting, None)
+                if attribute is None:
+                    debug("QWebEngineSettings.{} isn't available".format(
+                        setting))
+                    continue
+                self.settings().setAttribute(attribute, value)
+            if (
+                    profile.get("stop_animations")
+                    and not self.config.get("user_css")
+            ):
+                self.add_style_sheet(NO_ANIMATIONS_CSS)
+            if profile.get("max_frame_rate"):
+                self.add_script("wcg_frame_rate", FRAME_RATE_LIMIT_JS.format(
+                    fps=profile.get("max_frame_rate")))
+
+        def createWindow(self, type):
+            """Handle requests for a new browser window.
+
+            Overridden from QWebEngineView to allow for popup windows,
+            if enabled.
+            """
+            if self.config.get("allow_popups"):
+                self.popup = self.make_popup()
+                return self.popup
+            else:
+                debug("Popup not loaded on {}".format(self.url().toString()))
+
+        def onLinkClick(self, url):
+            """Check the whitelist, except for the browser's own pages.
+
+            setHtml() pages have data: URLs here.
+            """
+            if url.scheme() != "data":
+                super(WcgWebEngineView, self).onLinkClick(url)
+
+        def onLoadFinished(self, ok):
+            """Show our own error page if a page failed to load."""
+            if ok or self.url().scheme() == "data":
+                return True
+            if is_start_url(self.requested_url(), self.config):
+                self.setHtml(
+                    self.page_cache.page("network_down_html"), QUrl())
+                debug("Start Url doesn't seem to be available;"
+                      " displaying error")
+            else:
+                debug("**PAGE LOAD FAILED, URL: {}".format(
+                    self.requested_url().toString()))
+                self.setHtml(
+                    self.page_cache.page("page_unavailable_html"), QUrl())
+            return True
+
+        def render_process_terminated(self, status, exit_code):
+            """Show the error page if the page's renderer died."""
+            if status == QWebEnginePage.NormalTerminationStatus:
+                return
+            debug("Renderer for {} exited with status {}, code {}".format(
+                self.url().toString(), status, exit_code))
+            QTimer.singleShot(0, partial(
+                self.setHtml, self.page_cache.page("page_unavailable_html"),
+                QUrl()))
+
+        def download(self, item):
+            """Open a download with its content handler.
+
+            Like handle_unsupported_content() for QtWebKit, but the file
+            is downloaded by QtWebEngine.
+            """
+            content_type = str(item.mimeType())
+            file_name = os.path.basename(item.path())
+            url = item.url().toString()
+            handler = (self.config.get("content_handlers") or {}).get(
+                content_type)
+            debug("Loading url {} of type {}".format(url, content_type))
+            if not handler or not self.config.get("allow_external_content"):
+                item.cancel()
+                self.setHtml(UNKNOWN_CONTENT_TYPE.format(
+                    mime_type=content_type, file_name=file_name, url=url))
+                return
+            item.setPath(os.path.join(
+                tempfile.mkdtemp(prefix="wcgbrowser_"),
+                file_name or "download"))
+            # Sometimes downloading files opens an empty window.
+            # If so, it's closed when the download is done.
+            blank = str(self.url().toString()) in ('', 'about:blank')
+            item.finished.connect(partial(
+                self.display_downloaded_content, item, handler, blank))
+            item.accept()
+            if blank:
+                self.setHtml(DOWNLOADING_MESSAGE.format(
+                    filename=file_name, mime_type=content_type, url=url))
+
+        def display_downloaded_content(self, item, handler, close=False):
+            """Open a finished download in a separate application.
+
+            args:
+              close -- close this window afterwards
+            """
+            if item.state() != item.DownloadCompleted:
+                debug("Download of {} failed".format(item.url().toString()))
+                return
+            self.handler_launcher.launch(handler, item.path())
+            if close:
+                self.close()
+
+        def print_(self, printer):
+            """Print the page, waiting until it has been rendered."""
+            loop = QEventLoop()
+            self.page().print(printer, lambda ok: loop.quit())
+            loop.exec_()
+
+    class WcgWebEnginePage(QWebEnginePage):
+        """The QtWebEngine version of WCGWebPage."""
+
+        def __init__(self, profile, parent=None, config=None, console=None):
+            """Constructor for the class
+
+            args:
+              profile -- the QWebEngineProfile to use
+              console -- the ConsoleCapture to send console messages to
+            """
+            super(WcgWebEnginePage, self).__init__(profile, parent)
+            self.config = config or {}
+            self.console = console
+
+        def acceptNavigationRequest(self, url, navigation_type, main_frame):
+            """Stop pages off the whitelist before they're requested."""
+            view = self.view()
+            if (
+                    main_frame and isinstance(view, WcgWebEngineView)
+                    and url.scheme() != "data" and not view.url_allowed(url)
+            ):
+                QTimer.singleShot(0, partial(
+                    view.setHtml,
+                    view.page_cache.page("page_unavailable_html")))
+                return False
+            return True
+
+        def certificateError(self, error):
+            """Handle SSL errors according to the ssl_mode."""
+            if self.config.get("ssl_mode") == 'ignore':
+                debug("SSL error ignored")
+                debug(error.errorDescription())
+                return True
+            view = self.view()
+            if isinstance(view, WcgWebEngineView):
+                QTimer.singleShot(0, partial(
+                    view.setHtml, view.page_cache.certificate_error(
+                        error.url().toString())))
+            return False
+
+        def javaScriptConsoleMessage(self, level, message, line, sourceid):
+            """Send console messages to the ConsoleCapture."""
+            self.console.message(
+                str(self.url().toString(
+                    QUrl.RemoveQuery | QUrl.RemoveFragment)),
+                sourceid, line, message
+            )
+
+        def javaScriptConfirm(self, origin, msg):
+            """Handle javascript confirm() dialogs, like WCGWebPage."""
+            if self.config.get("force_js_confirm") == "accept":
+                return True
+            elif self.config.get("force_js_confirm") == "deny":
+                return False
+            else:
+                return QWebEnginePage.javaScriptConfirm(self, origin, msg)
+
+        def javaScriptAlert(self, origin, msg):
+            if not self.config.get("suppress_alerts"):
+                return QWebEnginePage.javaScriptAlert(self, origin, msg)
+
+# ### END QTWEBENGINE BACKEND ### #
+
 # ######## Main application code begins here ################## #
 
+def scroll_benchmark(config, url, frames=200, step=40):
+    """Time scrolling through url with each performance profile.
+
+    Returns a dict of frame time statistics, in milliseconds, for each
+    profile.  A frame is one scroll step and the repaint that follows it,
+    so this works on the "offscreen" Qt platform, with no display.
+    """
+    results = {}
+    for profile in sorted(PERFORMANCE_PROFILES):
+        view = WcgWebView(dict(config, performance_profile=profile))
+        view.resize(1024, 768)
+        view.show()
+        loop = QEventLoop()
+        view.loadFinished.connect(loop.quit)
+        QTimer.singleShot(30000, loop.quit)
+        view.load(QUrl(url))
+        loop.exec_()
+        frame = view.page().mainFrame()
+        times = []
+        for i in range(frames):
+            start = time.time()
+            if (frame.scrollBarValue(Qt.Vertical)
+                    >= frame.scrollBarMaximum(Qt.Vertical)):
+                frame.setScrollBarValue(Qt.Vertical, 0)
+            else:
+                frame.scroll(0, step)
+            QApplication.processEvents()
+            times.append((time.time() - start) * 1000)
+        times.sort()
+        results[profile] = {
+            "frames": frames,
+            "mean": round(sum(times) / len(times), 2),
+            "median": round(times[len(times) // 2], 2),
+            "p95": round(times[int(len(times) * 0.95)], 2),
+            "max": round(times[-1], 2)
+        }
+        view.close()
+        view.deleteLater()
+    return results
+
+
+def load_benchmark(config, url, runs=5):
+    """Time loading url with each rendering engine available.
+
+    Returns a dict of load time statistics, in milliseconds, for each
+    engine, with the memory used by the browser and its helper
+    processes after the last load.  QtWebEngine renders pages in
+    separate processes, so get_tree_rss() counts those too.
+    """
+    results = {}
+    engines = ["webkit"] + (
+        ["webengine"] if QWebEngineView is not None else [])
+    for engine in engines:
+        rss_before = get_tree_rss()
+        view = make_web_view(dict(config, rendering_engine=engine))
+        view.resize(1024, 768)
+        view.show()
+        times = []
+        for i in range(runs):
+            loop = QEventLoop()
+            view.loadFinished.connect(loop.quit)
+            QTimer.singleShot(30000, loop.quit)
+            start = time.time()
+            view.load(QUrl(url))
+            loop.exec_()
+            times.append((time.time() - start) * 1000)
+            view.loadFinished.disconnect(loop.quit)
+        rss_after = get_tree_rss()
+        first = times[0]
+        times.sort()
+        results[engine] = {
+            "loads": runs,
+            "first": round(first, 1),
+            "median": round(times[len(times) // 2], 1),
+            "max": round(times[-1], 1),
+            "rss_kb": rss_after,
+            "rss_added_kb": rss_after - rss_before
+        }
+        view.close()
+        view.deleteLater()
+        QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+    return results
+
+
 if __name__ == "__main__":
     # Create the qapplication object,
     # so it can interpret the qt-specific CLI args
@@ -1237,6 +6022,61 @@ if __name__ == "__main__":
         "--proxy_server", action="store", dest="proxy_server", default=None,
         help="Specify a proxy server string, in the form host:port"
     )
+    parser.add_argument(  # Scroll benchmark
+        "--benchmark", action="store", dest="benchmark", default=None,
+        help="Time scrolling through the specified URL with each"
+        " performance profile, print the results and exit"
+    )
+    parser.add_argument(  # Load benchmark
+        "--load_benchmark", action="store", dest="load_benchmark",
+        default=None, help="Time loading the specified URL with each"
+        " rendering engine, print the results and exit"
+    )
+    parser.add_argument(  # Rendering engine
+        "--rendering_engine", action="store", dest="rendering_engine",
+        default=None, choices=["webkit", "webengine"],
+        help="Render pages with QtWebKit or QtWebEngine"
+    )
+    parser.add_argument(  # Compiled config cache
+        "--config_cache", action="store", dest="config_cache", default=None,
+        help="Cache the parsed configuration in the specified file,"
+        " to speed up startup"
+    )
+    parser.add_argument(  # Remote control socket
+        "--control_socket", action="store", dest="control_socket",
+        default=None,
+        help="Listen for remote control commands on the specified"
+        " local socket"
+    )
+    parser.add_argument(  # Event loop profiler
+        "--profile", action="store", dest="profile", default=None,
+        help="Measure event loop lag and slow callbacks, and write a"
+        " flamegraph-compatible profile to the specified filename"
+    )
+    parser.add_argument(  # Slow callback threshold
+        "--profile_threshold", action="store", type=int, default=50,
+        dest="profile_threshold",
+        help="Milliseconds before a callback is reported as slow"
+        " (default 50)"
+    )
+    session = parser.add_mutually_exclusive_group()
+    session.add_argument(  # Session recorder
+        "--record_session", action="store", dest="record_session",
+        default=None,
+        help="Record all HTTP requests and responses to the specified"
+        " archive file"
+    )
+    session.add_argument(  # Session replay
+        "--replay_session", action="store", dest="replay_session",
+        default=None,
+        help="Answer HTTP requests from the specified archive file"
+        " instead of the network"
+    )
+    parser.add_argument(  # Recorded body size limit
+        "--record_body_limit", action="store", type=int, default=512,
+        dest="record_body_limit",
+        help="Kilobytes of each response body to record (default 512)"
+    )
 
     # rather than parse sys.argv here, we're parsing app.arguments
     # so that qt-specific args are removed.
@@ -1246,8 +6086,47 @@ if __name__ == "__main__":
     DEBUG_LOG = args.debug_log
     if not args.config_file:
         debug("No config file found or specified; using defaults.")
+    if args.profile:
+        PROFILER = EventLoopProfiler(args.profile, args.profile_threshold)
+        PROFILER.start()
+        app.aboutToQuit.connect(PROFILER.stop)
+    if args.record_session:
+        SESSION_RECORDER = SessionRecorder(
+            args.record_session, args.record_body_limit * 1024)
+        app.aboutToQuit.connect(SESSION_RECORDER.close)
+    if args.replay_session:
+        SESSION_REPLAY = ReplayArchive(args.replay_session)
+
+    # The benchmarks run without a main window, so it isn't loading
+    # the start page in the background while they're timed
+    if args.benchmark or args.load_benchmark:
+        loader = ConfigLoader()
+        loader.load_config(args)
+    if args.benchmark:
+        results = scroll_benchmark(loader.config, args.benchmark)
+        for profile, frame_times in sorted(results.items()):
+            print("{}: {}".format(profile, json.dumps(frame_times)))
+        sys.exit(0)
+    if args.load_benchmark:
+        results = load_benchmark(loader.config, args.load_benchmark)
+        for engine, load_times in sorted(results.items()):
+            print("{}: {}".format(engine, json.dumps(load_times)))
+        sys.exit(0)
 
     # run the actual application
     mainwin = MainWindow(args)
     mainwin.show()
+    debug("Main window ready; process RSS {} kB".format(get_rss()))
+    # In multi-seat mode, open a window for each of the remaining seats.
+    # They share the process's Qt runtime, fonts and compiled whitelists.
+    seat_windows = [mainwin]
+    for seat in range(1, len(mainwin.config.get("seats"))):
+        seat_windows.append(MainWindow(args, seat=seat))
+        seat_windows[-1].show()
+        debug("Seat {} ready; process RSS {} kB".format(
+            seat + 1, get_rss()))
+    if mainwin.config.get("control_socket"):
+        control_server = ControlServer(
+            mainwin.config.get("control_socket"), seat_windows
+        )
     app.exec_()
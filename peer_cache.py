@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""LAN cache of static assets, shared by the WCGBrowser kiosks at a branch.
+
+Every kiosk at a branch downloads the same stylesheets, scripts, images
+and fonts from the same few sites.  This service keeps one copy of them
+on disk and serves it to all the kiosks over the LAN, so each asset
+crosses the branch's uplink once.  Kiosks ask for an asset with
+
+    GET /?url=<the asset's URL>
+
+and get it from the cache, or fetched and cached if it's missing.
+Copies past their freshness are revalidated upstream with their ETag or
+Last-Modified date, and two kiosks asking for the same missing asset
+share one upstream fetch.  Responses that vary by request headers
+(other than Accept-Encoding) are passed on but not cached, since one
+copy can't suit every kiosk.  Only the static file types in STATIC_TYPES,
+from the hosts given on the command line, are served; anything else,
+including a redirect to another host, is refused, so this isn't an open
+proxy.  Any upstream problem is answered
+with a 502, and the kiosk fetches the asset itself.
+
+This module doesn't need Qt, so it can run on a kiosk or any machine on
+the branch LAN:
+
+    python peer_cache.py --cache-dir /var/cache/wcgbrowser \\
+        --host catalog.example.com --host www.example.org
+
+GET /status returns the cache's counts as JSON.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate, parsedate_tz, mktime_tz
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+    from urllib2 import Request, urlopen, HTTPError
+
+# The file types that are shared
+STATIC_TYPES = (
+    ".css", ".js", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp",
+    ".ico", ".woff", ".woff2", ".ttf", ".eot"
+)
+# The response headers kept with a cached asset
+KEPT_HEADERS = (
+    "cache-control", "content-language", "content-type", "etag", "expires",
+    "last-modified"
+)
+# The request headers passed upstream
+FORWARDED_HEADERS = ("accept", "accept-language", "user-agent")
+# The Vary header fields a cached copy can ignore; urllib doesn't ask
+# for compressed responses, so the copy is always the identity encoding
+IGNORED_VARY = ("accept-encoding",)
+
+
+def static_asset(url):
+    """Return True if url is an HTTP(S) URL of a static file type."""
+    parts = urlsplit(url)
+    return (
+        parts.scheme in ("http", "https")
+        and parts.path.lower().endswith(STATIC_TYPES)
+    )
+
+
+def varies(vary):
+    """Return True if a response with Vary header vary can't be shared."""
+    return any(
+        field.strip().lower() not in IGNORED_VARY
+        for field in vary.split(",") if field.strip())
+
+
+def expiry(headers, now, ttl):
+    """Return when a response with headers goes stale, or None.
+
+    None means it mustn't be kept.  Responses that don't say how long
+    they're fresh for are kept for ttl seconds.
+    """
+    directives = [
+        d.strip().lower()
+        for d in headers.get("cache-control", "").split(",")
+    ]
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return now
+    for directive in directives:
+        name, _, value = directive.partition("=")
+        if name.strip() == "max-age":
+            try:
+                return now + int(value.strip().strip('"'))
+            except ValueError:
+                return now
+    if headers.get("expires"):
+        expires = parsedate_tz(headers["expires"])
+        return mktime_tz(expires) if expires else now
+    return now + ttl
+
+
+class AssetCache(object):
+    """Assets kept on disk by URL, within a size limit.
+
+    Each asset is a body file and a JSON file of its headers and
+    freshness, named after a hash of its URL.  When the cache is over
+    its size, the assets used longest ago are removed.
+    """
+
+    def __init__(self, directory, hosts, size_mb=512, ttl=3600, timeout=30):
+        """Constructor for the class.
+
+        args:
+          directory -- the directory to keep assets in
+          hosts -- the hosts (and their subdomains) to serve assets from
+          size_mb -- the most megabytes of assets to keep
+          ttl -- seconds to keep assets that don't say, before
+                 revalidating them
+          timeout -- seconds to wait for an upstream server
+        """
+        self.directory = directory
+        self.hosts = set(host.lower() for host in hosts)
+        self.max_size = size_mb * 1024 * 1024
+        self.ttl = ttl
+        self.timeout = timeout
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        # {key: [lock, users]} for each asset being looked up, so it's
+        # only fetched once; removed when the last user is done with it
+        self.fetches = {}
+        # {key: the asset's metadata}
+        self.entries = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            key, extension = os.path.splitext(name)
+            if extension != ".json":
+                continue
+            try:
+                with open(self.path(key, ".json")) as meta_file:
+                    meta = json.load(meta_file)
+                meta["used"] = os.path.getmtime(self.path(key, ".json"))
+                meta["size"] = os.path.getsize(self.path(key, ".body"))
+            except (IOError, OSError, ValueError) as e:
+                sys.stderr.write("Skipping {}: {}\n".format(name, e))
+                continue
+            self.entries[key] = meta
+        self.size = sum(meta["size"] for meta in self.entries.values())
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def allowed(self, url):
+        """Return True if url is a static asset on one of the hosts."""
+        if not static_asset(url):
+            return False
+        host = (urlsplit(url).hostname or "").lower()
+        labels = host.split(".")
+        return any(
+            ".".join(labels[i:]) in self.hosts for i in range(len(labels)))
+
+    def lookup(self, url, request_headers):
+        """Return the metadata and body of url, fetching it if needed.
+
+        args:
+          url -- the asset's URL
+          request_headers -- the kiosk's request headers, as a dict with
+                             lowercase names
+
+        The metadata's "state" is "hit", "revalidated", "miss" (fetched
+        and cached) or "pass" (fetched, but not allowed to be cached).
+        Upstream errors are raised.
+        """
+        key = self.key(url)
+        with self.lock:
+            fetch = self.fetches.setdefault(key, [threading.Lock(), 0])
+            fetch[1] += 1
+        try:
+            return self._lookup(url, key, request_headers, fetch[0])
+        finally:
+            with self.lock:
+                fetch[1] -= 1
+                if not fetch[1]:
+                    del self.fetches[key]
+
+    def _lookup(self, url, key, request_headers, fetch):
+        with fetch:
+            now = time.time()
+            meta = self.entries.get(key)
+            body = None
+            if meta is not None:
+                try:
+                    with open(self.path(key, ".body"), "rb") as body_file:
+                        body = body_file.read()
+                except (IOError, OSError):
+                    meta = None
+            if meta is not None and meta["expires"] > now:
+                state = "hit"
+            else:
+                meta, body, state = self.fetch(
+                    url, key, request_headers, meta, body, now)
+            if meta is not None and state != "pass":
+                meta["used"] = now
+            self.counts[state] += 1
+            return dict(meta, state=state), body
+
+    def fetch(self, url, key, request_headers, meta, body, now):
+        """Fetch or revalidate url upstream, and cache the result."""
+        headers = dict(
+            (name, value) for name, value in request_headers.items()
+            if name in FORWARDED_HEADERS
+        )
+        if meta is not None:
+            if meta["headers"].get("etag"):
+                headers["If-None-Match"] = meta["headers"]["etag"]
+            if meta["headers"].get("last-modified"):
+                headers["If-Modified-Since"] = (
+                    meta["headers"]["last-modified"])
+        try:
+            response = urlopen(Request(url, headers=headers),
+                               timeout=self.timeout)
+        except HTTPError as e:
+            if e.code != 304 or meta is None:
+                raise
+            meta["expires"] = max(
+                expiry(meta["headers"], now, self.ttl) or now, now)
+            self.save(key, meta)
+            return meta, body, "revalidated"
+        if response.geturl() != url and not self.allowed(response.geturl()):
+            response.close()
+            raise ValueError(
+                "redirected to {}, which isn't shared".format(
+                    response.geturl()))
+        try:
+            body = response.read()
+            vary = response.info().get("Vary") or ""
+            kept = dict(
+                (name.lower(), value)
+                for name, value in response.info().items()
+                if name.lower() in KEPT_HEADERS
+            )
+        finally:
+            response.close()
+        expires = expiry(kept, now, self.ttl)
+        meta = {"url": url, "headers": kept, "expires": expires}
+        if (
+                expires is None or varies(vary)
+                or len(body) > self.max_size // 10
+        ):
+            return meta, body, "pass"
+        self.store(key, meta, body)
+        return meta, body, "miss"
+
+    def store(self, key, meta, body):
+        """Write an asset to disk, and remove old ones if there's no room."""
+        temp_name = self.path(key, ".body.tmp")
+        with open(temp_name, "wb") as body_file:
+            body_file.write(body)
+        os.rename(temp_name, self.path(key, ".body"))
+        self.save(key, meta)
+        with self.lock:
+            old = self.entries.get(key)
+            self.size += len(body) - (old["size"] if old else 0)
+            meta["size"] = len(body)
+            self.entries[key] = meta
+            while self.size > self.max_size and len(self.entries) > 1:
+                oldest = min(
+                    (k for k in self.entries if k != key),
+                    key=lambda k: self.entries[k]["used"])
+                self.remove(oldest)
+
+    def save(self, key, meta):
+        temp_name = self.path(key, ".json.tmp")
+        with open(temp_name, "w") as meta_file:
+            json.dump(
+                dict((k, meta[k]) for k in ("url", "headers", "expires")),
+                meta_file)
+        os.rename(temp_name, self.path(key, ".json"))
+
+    def remove(self, key):
+        """Forget an asset.  Call with the lock held."""
+        meta = self.entries.pop(key)
+        self.size -= meta["size"]
+        for extension in (".json", ".body"):
+            try:
+                os.remove(self.path(key, extension))
+            except OSError:
+                pass
+
+    def status(self):
+        """Return the cache's size and counts."""
+        status = dict(self.counts)
+        status.update({
+            "assets": len(self.entries),
+            "bytes": self.size,
+            "hosts": sorted(self.hosts)
+        })
+        return status
+
+
+def not_modified(meta, request_headers):
+    """Return True if the kiosk's copy of an asset is still good."""
+    etag = meta["headers"].get("etag")
+    if "if-none-match" in request_headers:
+        return etag is not None and etag in [
+            tag.strip() for tag in request_headers["if-none-match"].split(",")
+        ]
+    since = parsedate_tz(request_headers.get("if-modified-since", ""))
+    modified = parsedate_tz(meta["headers"].get("last-modified", ""))
+    return bool(since and modified and mktime_tz(modified) <= mktime_tz(since))
+
+
+class PeerCacheHandler(BaseHTTPRequestHandler):
+    """Answers kiosks' requests for assets."""
+
+    def do_GET(self):
+        cache = self.server.cache
+        parts = urlsplit(self.path)
+        if parts.path == "/status":
+            self.send_body(200, {"Content-Type": "application/json"},
+                           json.dumps(cache.status()).encode("utf-8"))
+            return
+        url = parse_qs(parts.query).get("url", [""])[0]
+        if not cache.allowed(url):
+            cache.counts["refused"] += 1
+            self.send_error(403, "Not a shared asset")
+            return
+        request_headers = dict(
+            (name.lower(), value) for name, value in self.headers.items())
+        try:
+            meta, body = cache.lookup(url, request_headers)
+        except Exception as e:
+            cache.counts["errors"] += 1
+            self.log_error("Can't fetch %s: %s", url, e)
+            self.send_error(502, "Can't fetch the asset")
+            return
+        headers = dict(meta["headers"])
+        headers["X-Peer-Cache"] = meta["state"]
+        if not_modified(meta, request_headers):
+            self.send_body(304, headers, b"")
+        else:
+            self.send_body(200, headers, body)
+
+    def send_body(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Date", formatdate(usegmt=True))
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PeerCacheServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main(argv=None):
+    """Run the peer cache service."""
+    parser = argparse.ArgumentParser(
+        description="Share static assets between the kiosks on a LAN.")
+    parser.add_argument(
+        "--cache-dir", required=True, help="the directory to keep assets in")
+    parser.add_argument(
+        "--host", action="append", required=True, dest="hosts",
+        help="a host (with its subdomains) to share assets from; repeat "
+        "for more hosts")
+    parser.add_argument(
+        "--bind", default="0.0.0.0", help="the address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=8765, help="the port to listen on")
+    parser.add_argument(
+        "--size", type=int, default=512,
+        help="the most megabytes of assets to keep")
+    parser.add_argument(
+        "--ttl", type=int, default=3600,
+        help="seconds before revalidating assets that don't say")
+    parser.add_argument(
+        "--clear", action="store_true",
+        help="empty the cache directory before starting")
+    args = parser.parse_args(argv)
+    if args.clear and os.path.isdir(args.cache_dir):
+        shutil.rmtree(args.cache_dir)
+    server = PeerCacheServer((args.bind, args.port), PeerCacheHandler)
+    server.cache = AssetCache(args.cache_dir, args.hosts, args.size, args.ttl)
+    sys.stderr.write("Sharing assets from {} on {}:{}\n".format(
+        ", ".join(args.hosts), args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""Structured request log for WCGBrowser, kept in a fixed-size ring buffer.
+
+The log is a memory-mapped file holding a header and a fixed number of
+fixed-size records, one per request.  When it's full, the oldest records
+are overwritten, so the file never grows.  Successful requests can be
+sampled; each record remembers how many requests it stands for, so the
+totals in the summary are still estimates of the real traffic.
+
+This module doesn't need Qt, so logs can be read on any machine:
+
+    python request_log.py dump /var/log/wcgbrowser/requests.log
+    python request_log.py summary /var/log/wcgbrowser/requests.log
+"""
+
+import argparse
+import datetime
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from collections import defaultdict
+
+MAGIC = b"WCGRLOG1"
+# magic, record size, capacity, next slot, records written
+HEADER = struct.Struct("<8sIIQQ")
+HEADER_SIZE = 64
+# time, duration (ms), bytes, status, weight, method, host, path
+RECORD = struct.Struct("<dIQHH8s64s128s")
+
+
+def status_class(status):
+    """Return the sampling class of an HTTP status, like "2xx"."""
+    if not status:
+        return "error"
+    return "{}xx".format(status // 100)
+
+
+class RequestLog(object):
+    """Writes request records to a memory-mapped ring buffer file."""
+
+    def __init__(self, filename, size_kb=1024, sampling=None):
+        """Constructor for the class.
+
+        args:
+          filename -- the log file, created if it doesn't exist
+          size_kb -- the size of the log file in kilobytes
+          sampling -- a dict of sampling rates (0 to 1) by status class
+                      ("2xx", "3xx"...), with an optional "hosts" dict of
+                      rates by host.  Errors (4xx, 5xx, and failed
+                      requests) are always logged.
+        """
+        self.filename = filename
+        self.sampling = dict(sampling or {})
+        self.host_sampling = self.sampling.pop("hosts", None) or {}
+        self.capacity = max(
+            (size_kb * 1024 - HEADER_SIZE) // RECORD.size, 1)
+        size = HEADER_SIZE + self.capacity * RECORD.size
+        mode = "r+b" if os.path.exists(filename) else "w+b"
+        self.file = open(filename, mode)
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        magic, record_size, capacity, self.next, self.written = (
+            HEADER.unpack_from(self.map, 0))
+        if (magic, record_size, capacity) != (
+                MAGIC, RECORD.size, self.capacity):
+            # A new log, or one made with different settings
+            self.next = self.written = 0
+            self.map[:] = b"\0" * size
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(
+            self.map, 0, MAGIC, RECORD.size, self.capacity,
+            self.next, self.written)
+
+    def sample_rate(self, host, status):
+        """Return the fraction of requests like this one to log."""
+        if not status or status >= 400:
+            return 1.0
+        if host in self.host_sampling:
+            return float(self.host_sampling[host])
+        return float(self.sampling.get(status_class(status), 1.0))
+
+    def log(self, method, host, path, status, size, duration):
+        """Log a request, if it's chosen by the sampling rate.
+
+        args:
+          method -- the HTTP method
+          host, path -- from the request URL
+          status -- the HTTP status, or None if the request failed
+          size -- the number of bytes received
+          duration -- the time the request took, in milliseconds
+        """
+        rate = min(self.sample_rate(host, status), 1.0)
+        if rate <= 0 or random.random() >= rate:
+            return False
+        RECORD.pack_into(
+            self.map, HEADER_SIZE + self.next * RECORD.size,
+            time.time(), int(min(duration, 0xffffffff)),
+            int(size or 0), int(status or 0),
+            int(min(round(1 / rate), 0xffff)),
+            method.encode("latin-1", "replace")[:8],
+            host.encode("utf-8")[:64],
+            path.encode("utf-8")[:128]
+        )
+        self.next = (self.next + 1) % self.capacity
+        self.written += 1
+        self._write_header()
+        return True
+
+    def close(self):
+        """Close the log file."""
+        self.map.close()
+        self.file.close()
+
+
+def read_records(filename):
+    """Return the records in a log file as dicts, oldest first."""
+    with open(filename, "rb") as log_file:
+        data = log_file.read()
+    magic, record_size, capacity, next_slot, written = (
+        HEADER.unpack_from(data, 0))
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("{} is not a request log".format(filename))
+    if written > capacity:
+        slots = list(range(next_slot, capacity)) + list(range(next_slot))
+    else:
+        slots = range(written)
+    records = []
+    for slot in slots:
+        (timestamp, duration, size, status, weight,
+         method, host, path) = RECORD.unpack_from(
+            data, HEADER_SIZE + slot * RECORD.size)
+        records.append({
+            "time": timestamp,
+            "method": method.rstrip(b"\0").decode("latin-1"),
+            "host": host.rstrip(b"\0").decode("utf-8", "replace"),
+            "path": path.rstrip(b"\0").decode("utf-8", "replace"),
+            "status": status or None,
+            "bytes": size,
+            "ms": duration,
+            "weight": weight
+        })
+    return records
+
+
+def dump(records, out=sys.stdout):
+    """Print records as tab-separated lines."""
+    for record in records:
+        out.write("\t".join(str(x) for x in (
+            datetime.datetime.utcfromtimestamp(
+                record["time"]).isoformat() + "Z",
+            record["method"], record["status"] or "-", record["host"],
+            record["path"], record["bytes"], record["ms"]
+        )) + "\n")
+
+
+def percentile(durations, fraction):
+    """Return the duration fraction of the weight falls at or below.
+
+    durations is a sorted list of (ms, weight) pairs.
+    """
+    target = sum(weight for ms, weight in durations) * fraction
+    total = 0
+    for ms, weight in durations:
+        total += weight
+        if total > target:
+            return ms
+    return durations[-1][0]
+
+
+def summarize(records):
+    """Return estimated per-host totals for records.
+
+    Each record counts for as many requests as it was sampled from, in
+    the request times as well as the totals.
+    """
+    hosts = defaultdict(lambda: {
+        "requests": 0, "errors": 0, "bytes": 0, "durations": []})
+    for record in records:
+        host = hosts[record["host"]]
+        host["requests"] += record["weight"]
+        host["bytes"] += record["bytes"] * record["weight"]
+        if status_class(record["status"]) in ("4xx", "5xx", "error"):
+            host["errors"] += record["weight"]
+        host["durations"].append((record["ms"], record["weight"]))
+    summary = {}
+    for name, host in hosts.items():
+        durations = sorted(host.pop("durations"))
+        host["median_ms"] = percentile(durations, 0.5)
+        host["p95_ms"] = percentile(durations, 0.95)
+        summary[name] = host
+    return summary
+
+
+def main(argv=None):
+    """Command line reader for request logs."""
+    parser = argparse.ArgumentParser(
+        description="Read a WCGBrowser request log.")
+    parser.add_argument(
+        "command", choices=("dump", "summary"),
+        help="dump the records, or summarize them by host")
+    parser.add_argument("filename", help="the request log file")
+    parser.add_argument(
+        "--host", help="only include requests to this host")
+    parser.add_argument(
+        "--errors", action="store_true",
+        help="only include failed requests and 4xx/5xx responses")
+    args = parser.parse_args(argv)
+    records = read_records(args.filename)
+    if args.host:
+        records = [r for r in records if r["host"] == args.host]
+    if args.errors:
+        records = [
+            r for r in records
+            if status_class(r["status"]) in ("4xx", "5xx", "error")
+        ]
+    if args.command == "dump":
+        dump(records)
+        return
+    print("{:<40} {:>9} {:>7} {:>12} {:>9} {:>9}".format(
+        "host", "requests", "errors", "bytes", "median_ms", "p95_ms"))
+    for name, host in sorted(
+            summarize(records).items(), key=lambda x: -x[1]["requests"]):
+        print("{:<40} {requests:>9} {errors:>7} {bytes:>12} "
+              "{median_ms:>9} {p95_ms:>9}".format(name[:40], **host))
+
+
+if __name__ == "__main__":
+    main()